@@ -0,0 +1,55 @@
+# See LICENSE for license details.
+
+"""
+Simmani command line
+
+  python -m simmani <command> [arguments]
+
+A command imports its module only when it runs, and heavy libraries
+(sklearn, matplotlib) are imported only by the stages using them,
+so quick commands start fast.
+"""
+
+import sys
+import runpy
+from importlib import import_module
+
+# command, module, function called with arguments (None to run the module), help
+COMMANDS = [
+    ('cluster', 'cluster', None, 'select signals by clustering toggles'),
+    ('train', 'train', None, 'train power models of selected signals'),
+    ('sweep', 'sweep', None, 'cluster and train for each window, and select the best model'),
+    ('test', 'test', None, 'test power models on benchmarks'),
+    ('validate', 'validate', None, 'score candidate power models on benchmarks'),
+    ('plot-power', 'plot_power', None, 'plot power traces from FPGA runs'),
+    ('serve', 'serve', None, 'serve power models over a Unix socket'),
+    ('bench', 'bench', None, 'benchmark on synthetic traces'),
+    ('signals', 'files', 'list_signals', 'list signals of a VCD, toggle, or model file'),
+    ('model', 'files', 'show_model', 'summarize a power model'),
+    ('convert', 'files', 'convert_toggles', 'convert VCDs or a toggle file to a toggle file'),
+]
+
+def usage():
+    lines = ["usage: python -m simmani <command> [arguments]", "", "commands:"]
+    lines.extend("  %-12s %s" % (name, _help) for name, _, _, _help in COMMANDS)
+    lines.append("")
+    lines.append("See python -m simmani <command> -h for the arguments of a command.")
+    return "\n".join(lines)
+
+def main(argv):
+    if not argv or argv[0] in ['-h', '--help']:
+        print(usage())
+        return
+    commands = dict((name, (module, function)) for name, module, function, _ in COMMANDS)
+    if argv[0] not in commands:
+        sys.exit("unknown command: %s\n\n%s" % (argv[0], usage()))
+    module, function = commands[argv[0]]
+    if function is None:
+        # as `python -m simmani.<module>`
+        sys.argv = [argv[0]] + argv[1:]
+        runpy.run_module("%s.%s" % (__package__, module), run_name="__main__", alter_sys=True)
+    else:
+        getattr(import_module("." + module, __package__), function)(argv[1:])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,437 @@
+# See LICENSE for license details.
+
+"""
+Benchmarks on synthetic traces
+
+Generates deterministic VCDs and power waveforms at several scales
+(cached in the output directory) and times the main pipeline stages.
+Results are stored in JSON to compare against a previous run.
+With --validate, memory and numerical differences of float32 toggles,
+power traces, and features are reported against float64 instead,
+the scan of value changes is checked against the line parser, and
+csv traces with blank lines and CRLF line endings are checked.
+"""
+
+import os
+import sys
+import json
+import platform
+import argparse
+import logging
+import warnings
+import subprocess
+import multiprocessing
+from time import time
+import numpy as np
+import scipy
+from .utils import average_rows, sum_rows, normalize_toggles, digest, set_precision
+from .utils.vcd import VCDReader, read_toggles_vcd
+from .utils.stream import VCDStream, stream_windows
+from .utils.power import read_power_out
+from .utils.data import store_trace, Trace
+from .utils.synth import synth_trace, SYNTH_VERSION
+from .model.clustering import spectral_clustering
+from .model.regression import polynomial_regression, get_terms
+
+SCALES = {
+    'small': dict(signals=32, cycles=5000, depth=2),
+    'medium': dict(signals=128, cycles=20000, depth=3),
+    'large': dict(signals=512, cycles=50000, depth=4),
+}
+
+BENCHMARKS = [
+    'read_toggles_vcd', 'stream_toggles_vcd', 'read_power_out', 'average_rows',
+    'get_terms', 'spectral_clustering', 'polynomial_regression'
+]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Simmani Benchmarks')
+    parser.add_argument("-s", "--scales", dest="scales", type=str, nargs='+',
+                        help="scales (%s)" % ','.join(SCALES), default=['small', 'medium'])
+    parser.add_argument("-b", "--benchmarks", dest="benchmarks", type=str, nargs='+',
+                        help="benchmarks to run", default=BENCHMARKS)
+    parser.add_argument("--signals", dest="signals", type=int,
+                        help="# of signals (overrides scales)")
+    parser.add_argument("--cycles", dest="cycles", type=int,
+                        help="# of cycles (overrides scales)")
+    parser.add_argument("--density", dest="density", type=float,
+                        help="fraction of signals changing every cycle", default=0.2)
+    parser.add_argument("--depth", dest="depth", type=int,
+                        help="module hierarchy depth (overrides scales)")
+    parser.add_argument("--widths", dest="widths", type=int, nargs='+',
+                        help="bus widths", default=[1, 1, 4, 8, 16, 32])
+    parser.add_argument("--seed", dest="seed", type=int,
+                        help="random seed for traces", default=0)
+    parser.add_argument("-w", "--window", dest="window", type=int,
+                        help="window size (in cycle)", default=64)
+    parser.add_argument("--max-k", dest="max_k", type=int,
+                        help="max # of clusters", default=16)
+    parser.add_argument("--terms", dest="terms", type=int,
+                        help="# of signals for term expansion and regression", default=16)
+    parser.add_argument("--precision", dest="precision", type=str,
+                        help="floating-point type of toggles and power (float64 or float32)",
+                        default="float64")
+    parser.add_argument("--validate", dest="validate",
+                        help="compare float32 with float64 instead of timing",
+                        action="store_true", default=False)
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int,
+                        help="# of runs per benchmark", default=3)
+    parser.add_argument("-d", "--dir", dest="dir", type=str,
+                        help='directory for traces and results', default='bench')
+    parser.add_argument("-o", "--output", dest="output", type=str,
+                        help='results file (default: <dir>/bench.json)')
+    parser.add_argument("--baseline", dest="baseline", type=str,
+                        help='results file of a previous run to compare')
+    parser.add_argument("--log", dest="log", type=str,
+                        help="log level", default="info")
+
+    args, _ = parser.parse_known_args(argv)
+    assert all(scale in SCALES or scale == 'custom' for scale in args.scales), \
+        "unknown scale: %s" % ','.join(args.scales)
+    assert all(benchmark in BENCHMARKS for benchmark in args.benchmarks), \
+        "unknown benchmark: %s" % ','.join(args.benchmarks)
+    assert args.log in ['info', 'debug']
+    os.makedirs(args.dir, exist_ok=True)
+    if not args.output:
+        args.output = os.path.join(args.dir, 'bench.json')
+    return args
+
+def scale_params(args, scale):
+    """ Trace parameters of a scale with command-line overrides """
+    params = dict(SCALES.get(scale, SCALES['small']))
+    for key in ['signals', 'cycles', 'depth']:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    params['density'] = args.density
+    params['widths'] = list(args.widths)
+    params['seed'] = args.seed
+    return params
+
+def get_trace(dirname, params):
+    """ Generate a synthetic trace unless already generated """
+    key = digest([], SYNTH_VERSION, *sorted(params.items()))[:12]
+    vcd_filename = os.path.join(dirname, 'synth-%s.vcd' % key)
+    out_filename = os.path.join(dirname, 'synth-%s.out' % key)
+    if not os.path.exists(vcd_filename) or not os.path.exists(out_filename):
+        start_time = time()
+        synth_trace(vcd_filename, out_filename, **params)
+        logging.info("Generation time: %.2f s", time() - start_time)
+    return vcd_filename, out_filename
+
+def stream_trace(dirname, params, window):
+    """
+    Stream toggles of a synthetic VCD written into a named pipe
+    by another process, as from a running simulation
+    (so the time includes generating the trace)
+    Outputs:
+      - # of windows
+    """
+    fifo = os.path.join(dirname, 'stream.vcd')
+    if os.path.exists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo)
+    writer = multiprocessing.Process(
+        target=synth_trace, args=(fifo, os.path.join(dirname, 'stream.out')), kwargs=params)
+    writer.start()
+    try:
+        reader = VCDStream(fifo, window=window)
+        windows = sum(block.shape[0] for block in stream_windows(reader))
+        reader.close()
+    finally:
+        writer.join()
+        os.remove(fifo)
+    return windows
+
+def timeit(func, repeat):
+    """
+    Run func repeat times
+    Outputs:
+      - times (in sec), result of the last run
+    """
+    times = list()
+    for _ in range(repeat):
+        start_time = time()
+        result = func()
+        times.append(time() - start_time)
+    return times, result
+
+def run_scale(args, scale):
+    """
+    Run benchmarks at a scale
+    Outputs:
+      - records of benchmarks
+    """
+    params = scale_params(args, scale)
+    logging.info("[%s] %s", scale, ', '.join("%s: %s" % x for x in sorted(params.items())))
+    vcd_filename, out_filename = get_trace(args.dir, params)
+    window = args.window
+
+    # Inputs of later benchmarks are computed once even if not timed
+    _, _, _, toggles, _ = read_toggles_vcd(vcd_filename)
+    _, _, _, powers = read_power_out(out_filename)
+    A = average_rows(toggles, window)
+    y = average_rows(powers[:1], window)[0]
+    n = min(A.shape[1], len(y))
+    X = A.A.T[:n, :min(args.terms, A.shape[0])]
+    idxs = [(i,) for i in range(X.shape[1])] + \
+           [(i, j) for i in range(X.shape[1]) for j in range(i, X.shape[1])]
+    max_k = min(args.max_k, A.shape[0] - 1)
+
+    benchmarks = {
+        'read_toggles_vcd': (
+            lambda: read_toggles_vcd(vcd_filename, window=window),
+            {'file_mb': os.path.getsize(vcd_filename) / 1e6}),
+        'stream_toggles_vcd': (
+            lambda: stream_trace(args.dir, params, window),
+            {'file_mb': os.path.getsize(vcd_filename) / 1e6}),
+        'read_power_out': (
+            lambda: read_power_out(out_filename),
+            {'file_mb': os.path.getsize(out_filename) / 1e6}),
+        'average_rows': (
+            lambda: (average_rows(toggles, window), average_rows(powers, window)),
+            {'toggles': list(toggles.shape) + [toggles.nnz], 'powers': list(powers.shape)}),
+        'get_terms': (
+            lambda: get_terms(X, idxs),
+            {'A': list(X.shape), 'terms': len(idxs)}),
+        'spectral_clustering': (
+            lambda: spectral_clustering(A, 2, max_k),
+            {'A': list(A.shape), 'max_k': max_k}),
+        'polynomial_regression': (
+            lambda: polynomial_regression(X, y[:n], 2),
+            {'A': list(X.shape), 'degree': 2}),
+    }
+
+    records = list()
+    for name in args.benchmarks:
+        func, sizes = benchmarks[name]
+        # Pipeline logs are only shown in the debug mode
+        level = logging.getLogger().level
+        logging.getLogger().setLevel(max(level, logging.WARNING) if args.log != 'debug' else level)
+        try:
+            times, _ = timeit(func, args.repeat)
+        finally:
+            logging.getLogger().setLevel(level)
+        logging.info("[%s] %s: best %.3f s, median %.3f s",
+                     scale, name, min(times), np.median(times))
+        records.append({
+            'scale': scale,
+            'benchmark': name,
+            'params': dict(params, window=window),
+            'sizes': sizes,
+            'times': times,
+            'best': min(times),
+            'median': float(np.median(times))
+        })
+    return records
+
+def nbytes(A):
+    """ Memory of dense or sparse matrices in bytes """
+    if hasattr(A, 'indptr'):
+        return A.data.nbytes + A.indices.nbytes + A.indptr.nbytes
+    return A.nbytes
+
+def differences(x, y):
+    """ Max absolute and relative differences """
+    diff = np.abs(np.asarray(x, dtype=float) - np.asarray(y, dtype=float))
+    scale = np.abs(np.asarray(y, dtype=float))
+    return float(diff.max(initial=0.0)), \
+           float((diff / np.maximum(scale, 1e-30)).max(initial=0.0))
+
+class _LineReader(VCDReader):
+    # never scans value changes (see VCDReader._changes)
+    scannable = False
+
+def _windows(reader):
+    toggles = np.array([cur_toggles for _, cur_toggles in reader.windows()])
+    reader.close()
+    return toggles
+
+def validate_scan(dirname, vcd_filename, window):
+    """
+    Compare toggles of a few signals from the scan of value changes with
+    the line parser, also with various whitespace between vector values
+    and identifier codes
+    Outputs:
+      - # of differing toggles for each VCD
+    """
+    spaced_filename = os.path.join(dirname, 'spaced.vcd')
+    with open(vcd_filename, "r") as _f, open(spaced_filename, "w") as _o:
+        for i, line in enumerate(_f):
+            tokens = line.split()
+            if len(tokens) == 2 and tokens[0][0] == 'b':
+                line = tokens[0] + ["  ", "\t", " \t "][i % 3] + tokens[1] + "\n"
+            _o.write(line)
+    differences = dict()
+    for filename in [vcd_filename, spaced_filename]:
+        reader = VCDReader(filename)
+        signals = set(reader.signals[::16])
+        reader.close()
+        scanned = _windows(VCDReader(filename, signals, window))
+        parsed = _windows(_LineReader(filename, signals, window))
+        assert scanned.shape == parsed.shape, "%s != %s" % (str(scanned.shape), str(parsed.shape))
+        differences[os.path.basename(filename)] = int(np.count_nonzero(scanned != parsed))
+    os.remove(spaced_filename)
+    return differences
+
+def validate_csv(dirname, toggles):
+    """
+    Compare csv traces with blank lines and CRLF line endings
+    with the plain csv trace of a few windows of toggles
+    Outputs:
+      - # of differing values for each variant
+    """
+    csv_filename = os.path.join(dirname, 'trace.csv')
+    store_trace(csv_filename, [str(i) for i in range(toggles.shape[1])], toggles, window=1)
+    expected = Trace(csv_filename).data
+    with open(csv_filename, "r") as _f:
+        text = _f.read()
+    lines = text.split('\n')
+    variants = {
+        'trailing': text + '\n \n\n',
+        'blank': '\n'.join(lines[:4] + ['', '\t'] + lines[4:]),
+        'crlf': text.replace('\n', '\r\n') + '\r\n',
+    }
+    differences = dict()
+    for name, variant in variants.items():
+        with open(csv_filename, "w", newline='') as _f:
+            _f.write(variant)
+        data = Trace(csv_filename).data
+        assert data.shape == expected.shape, "%s != %s" % (str(data.shape), str(expected.shape))
+        differences[name] = int(np.count_nonzero(data != expected))
+    os.remove(csv_filename)
+    return differences
+
+def validate_scale(args, scale):
+    """
+    Compare pipeline inputs and outputs in float32 against float64
+    Outputs:
+      - record of memory and differences
+    """
+    params = scale_params(args, scale)
+    logging.info("[%s] %s", scale, ', '.join("%s: %s" % x for x in sorted(params.items())))
+    vcd_filename, out_filename = get_trace(args.dir, params)
+    window = args.window
+
+    counts = None
+    outputs = dict()
+    for precision in ['float64', 'float32']:
+        set_precision(precision)
+        if counts is None:
+            _, _, _, counts, widths = read_toggles_vcd(vcd_filename, normalize=False)
+        toggles = normalize_toggles(counts, 1, widths)
+        _, _, _, powers = read_power_out(out_filename)
+        A = normalize_toggles(sum_rows(counts, window, np.uint32), window, widths)
+        y = average_rows(powers[:1], window)[0]
+        n = min(A.shape[1], len(y))
+        X = A.A.T[:n, :min(args.terms, A.shape[0])]
+        _, _, _, y_hat, _ = polynomial_regression(X, y[:n], 2)
+        r2 = 1.0 - np.var(y[:n] - y_hat) / np.var(y[:n])
+        outputs[precision] = (toggles, powers, y_hat, r2)
+    set_precision(args.precision)
+
+    toggles64, powers64, y_hat64, r2_64 = outputs['float64']
+    toggles32, powers32, y_hat32, r2_32 = outputs['float32']
+    record = {
+        'scale': scale,
+        'params': dict(params, window=window),
+        'memory': {
+            'toggle_counts': nbytes(counts),
+            'toggles_float64': nbytes(toggles64),
+            'toggles_float32': nbytes(toggles32),
+            'powers_float64': nbytes(powers64),
+            'powers_float32': nbytes(powers32),
+        },
+        'differences': {
+            'toggles': differences(toggles32.data, toggles64.data),
+            'powers': differences(powers32, powers64),
+            'predictions': differences(y_hat32, y_hat64),
+            'r2': [float(r2_64), float(r2_32)],
+        },
+        'scan': validate_scan(args.dir, vcd_filename, window),
+        'csv': validate_csv(args.dir, counts[:, :64].T.toarray())
+    }
+    memory = record['memory']
+    logging.info("[%s] toggles: %d bytes (counts), %d (float64), %d (float32)",
+                 scale, memory['toggle_counts'], memory['toggles_float64'], memory['toggles_float32'])
+    logging.info("[%s] powers: %d bytes (float64), %d (float32)",
+                 scale, memory['powers_float64'], memory['powers_float32'])
+    for name in ['toggles', 'powers', 'predictions']:
+        logging.info("[%s] %s: max abs diff: %e, max rel diff: %e",
+                     scale, name, *record['differences'][name])
+    logging.info("[%s] R^2: %f (float64), %f (float32)", scale, r2_64, r2_32)
+    for filename, count in record['scan'].items():
+        logging.info("[%s] scan of %s: %d toggles differ from the line parser",
+                     scale, filename, count)
+    assert all(count == 0 for count in record['scan'].values()), \
+        "scan differs from the line parser: %s" % str(record['scan'])
+    for name, count in record['csv'].items():
+        logging.info("[%s] csv trace (%s): %d values differ", scale, name, count)
+    assert all(count == 0 for count in record['csv'].values()), \
+        "csv traces differ: %s" % str(record['csv'])
+    return record
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(records, filename):
+    """ Print speedups over the baseline results """
+    logging.info("Baseline: %s", filename)
+    with open(filename) as _f:
+        baseline = json.load(_f)
+    logging.info("Baseline revision: %s", baseline.get('revision'))
+    base = dict(((record['scale'], record['benchmark']), record)
+                for record in baseline['results'])
+    for record in records:
+        key = (record['scale'], record['benchmark'])
+        if key not in base:
+            continue
+        if base[key]['params'] != record['params']:
+            logging.info("[%s] %s: different parameters, skipped", *key)
+            continue
+        logging.info("[%s] %s: %.3f s -> %.3f s (%.2fx)", key[0], key[1],
+                     base[key]['best'], record['best'], base[key]['best'] / record['best'])
+
+def main(argv):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.DEBUG if args.log == 'debug' else logging.INFO
+    )
+
+    set_precision(args.precision)
+    records = list()
+    validation = list()
+    for scale in args.scales:
+        if args.validate:
+            validation.append(validate_scale(args, scale))
+        else:
+            records.extend(run_scale(args, scale))
+
+    logging.info("Results file: %s", args.output)
+    with open(args.output, 'w') as _f:
+        json.dump({
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'precision': args.precision,
+            'results': records,
+            'validation': validation
+        }, _f, indent=2)
+
+    if args.baseline:
+        compare(records, args.baseline)
+
+if __name__ == "__main__":
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        main(sys.argv[1:])
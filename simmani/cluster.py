@@ -1,5 +1,3 @@
-#!/usr/bin/env python3
-
 # See LICENSE for license details.
 
 import os.path
@@ -10,8 +8,12 @@ import warnings
 from time import time
 import csv
 import numpy as np
-from utils.toggle import read_toggles
-from model.clustering import spectral_clustering
+from .utils.toggle import read_toggles, sketch_toggles
+from .utils import digest, set_precision
+from .model.clustering import pca, spectral_clustering, load_projection, store_projection
+from .model.sketch import SKETCHES
+from .utils.resources import set_cpus, log_budget
+from .utils.profile import PROFILER, profiled
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description='Signal Clustering')
@@ -25,15 +27,47 @@ def parse_args(argv):
                         help='min # of clusters', default=2)
     parser.add_argument("-w", "--window", dest="window", type=int,
                         help="clustering window size (in cycle)", default=64)
+    parser.add_argument("--sketch", dest="sketch", type=int,
+                        help="stream VCDs into a sketch of this size "
+                             "instead of reading the whole toggle matrix")
+    parser.add_argument("--sketch-method", dest="sketch_method", type=str,
+                        help="sketch method", choices=sorted(SKETCHES),
+                        default="fd")
+    parser.add_argument("--stream", dest="stream",
+                        help="read VCDs from running simulations (named pipes or files being written) "
+                             "into the sketch",
+                        action="store_true", default=False)
+    parser.add_argument("--idle", dest="idle", type=float,
+                        help="seconds without data before a VCD file being written ends for --stream",
+                        default=10.0)
+    parser.add_argument("--no-cache", dest="no_cache",
+                        help="do not reuse or store PCA projections",
+                        action="store_true", default=False)
+    parser.add_argument("--cpus", dest="cpus", type=int,
+                        help="# of cores for the run (SIMMANI_CPUS or all cores by default)")
+    parser.add_argument("--precision", dest="precision", type=str,
+                        help="floating-point type of toggles and power (float64 or float32)",
+                        default="float64")
+    parser.add_argument("--profile", dest="profile", type=str,
+                        help="profile report file (.json or .csv)")
     parser.add_argument("--log", dest="log", type=str,
                         help="log level", default="info")
 
     args, _ = parser.parse_known_args(argv)
     assert args.vcd or args.toggle
+    assert not args.sketch or args.vcd, "--sketch needs VCD files"
+    assert not args.stream or args.sketch, "--stream needs --sketch"
+    # streams are read only once
+    args.no_cache |= args.stream
     assert args.log in ['info', 'debug']
     os.makedirs(args.dir, exist_ok=True)
     return args
 
+def max_clusters(num_signals, min_k):
+    return 200 if num_signals > 200 else \
+           min(min_k + 10, int(num_signals / 2))
+
+@profiled("cluster write")
 def store_clusters(filename, signals, labels, centers):
     logging.info("Cluster file: %s", filename)
     assert len(signals) == len(labels)
@@ -58,28 +92,16 @@ def store_clusters(filename, signals, labels, centers):
         for row in np.array(clusters).T:
             writer.writerow(row.tolist())
 
-def main(argv):
-    args = parse_args(argv)
-
-    logging.basicConfig(
-        format="%(message)s",
-        level=logging.DEBUG if args.log == 'debug' else logging.INFO
-    )
-
-    # Read VCD
-    vcd_cycle_list, reset_cycle_list, bus_signals, toggles, _ = \
-        read_toggles(args.toggle, args.vcd, args.window)
-    logging.info("Cycles: %d", sum(vcd_cycle_list))
-    logging.info("Reset Cycles: %d", sum(reset_cycle_list))
-    logging.info("# Signals: %d", len(bus_signals))
-    sys.stdout.flush()
-
-    # Clustering
-    min_k = args.K
-    max_k = 200 if len(bus_signals) > 200 else \
-            min(args.K + 10, int(toggles.shape[0] / 2))
+def cluster_signals(dirname, window, bus_signals, A_max_k, min_k, max_k):
+    """
+    Select signals by spectral clustering and store them in dirname
+    Inputs:
+      - A_max_k: projections of signals to max_k singular vectors
+    Outputs:
+      - selected signals
+    """
     start_time = time()
-    centers, labels = spectral_clustering(toggles, min_k, max_k)
+    centers, labels = spectral_clustering(None, min_k, max_k, A_max_k)
     signals = bus_signals[centers]
     end_time = time()
     logging.info("Total clustering time: %.2f s", end_time - start_time)
@@ -88,12 +110,70 @@ def main(argv):
         logging.info("- %s", signal)
     sys.stdout.flush()
 
-    signal_filename = os.path.join(args.dir, 'signals_%d.csv' % args.window)
+    signal_filename = os.path.join(dirname, 'signals_%d.csv' % window)
     logging.info('Signal file: %s', signal_filename)
     np.savetxt(signal_filename, sorted(signals), fmt='%s', delimiter=',')
 
-    cluster_filename = os.path.join(args.dir, 'clusters_%d.csv' % args.window)
+    cluster_filename = os.path.join(dirname, 'clusters_%d.csv' % window)
     store_clusters(cluster_filename, bus_signals, labels, signals)
+    return signals
+
+def main(argv):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.DEBUG if args.log == 'debug' else logging.INFO
+    )
+
+    set_precision(args.precision)
+    set_cpus(args.cpus)
+    log_budget()
+    if args.profile:
+        PROFILER.enable()
+
+    # Reuse projections from previous runs
+    pca_filename = os.path.join(args.dir, 'pca_%d.npz' % args.window)
+    key = digest([args.toggle] if args.toggle else args.vcd, args.window,
+                 args.sketch, args.sketch_method if args.sketch else None)
+    cache = load_projection(pca_filename, key) if not args.no_cache else None
+    if cache is not None:
+        bus_signals, A_max_k, _ = cache
+        max_k = max_clusters(len(bus_signals), args.K)
+        # singular values are ascending, so the top max_k are the last ones
+        A_max_k = A_max_k[:, -max_k:] if A_max_k.shape[1] >= max_k else None
+    if cache is None or A_max_k is None:
+        # Read VCD
+        if args.sketch:
+            vcd_cycle_list, reset_cycle_list, bus_signals, sketch, _ = \
+                sketch_toggles(args.vcd, args.window, lambda m: SKETCHES[args.sketch_method](
+                    m, max(args.sketch, max_clusters(m, args.K))),
+                    stream=args.stream, idle=args.idle)
+        else:
+            vcd_cycle_list, reset_cycle_list, bus_signals, toggles, _ = \
+                read_toggles(args.toggle, args.vcd, args.window)
+        logging.info("Cycles: %d", sum(vcd_cycle_list))
+        logging.info("Reset Cycles: %d", sum(reset_cycle_list))
+
+        # Dimension reduction
+        max_k = max_clusters(len(bus_signals), args.K)
+        start_time = time()
+        if args.sketch:
+            logging.info("Sketch: %s, size: %d", args.sketch_method, sketch.l)
+            A_max_k, s = sketch.projection(max_k)
+        else:
+            A_max_k, s = pca(toggles, max_k)
+        end_time = time()
+        logging.info("Dimension reduction time: %.2f s", end_time - start_time)
+        if not args.no_cache:
+            store_projection(pca_filename, key, bus_signals, A_max_k, s)
+    logging.info("# Signals: %d", len(bus_signals))
+    sys.stdout.flush()
+
+    cluster_signals(args.dir, args.window, bus_signals, A_max_k, args.K, max_k)
+
+    if args.profile:
+        PROFILER.store(args.profile)
 
 if __name__ == "__main__":
     np.seterr(divide='raise')
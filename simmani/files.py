@@ -0,0 +1,105 @@
+# See LICENSE for license details.
+
+"""
+Quick commands on trace and model files
+
+They read only what they print (e.g. VCD and toggle file headers),
+and import neither sklearn nor matplotlib, so they start fast.
+"""
+
+import argparse
+import csv
+import numpy as np
+from scipy.sparse import hstack
+from .utils.vcd import VCDReader, read_toggles_vcd
+from .utils.toggle import read_toggle_header, read_toggles_csv, read_toggles_bin, store_toggles
+from .model.evaluator import MODEL_MAGIC, load_model
+
+def _is_model(filename):
+    if filename.endswith(".bin"):
+        with open(filename, "rb") as _f:
+            return _f.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+    with open(filename, "r") as _f:
+        return next(csv.reader(_f), [''])[0] == 'signals'
+
+def list_signals(argv):
+    """
+    Signals (and widths) of a VCD, toggle file, or model
+    """
+    parser = argparse.ArgumentParser(
+        prog='simmani signals', description='List signals of a VCD, toggle, or model file')
+    parser.add_argument("file", type=str, help='vcd, toggle (.csv or binary), or model file')
+    parser.add_argument("--widths", dest="widths", action="store_true",
+                        help='print widths with signals')
+    args = parser.parse_args(argv)
+
+    if args.file.endswith(".vcd"):
+        reader = VCDReader(args.file)
+        signals, widths = reader.signals, reader.widths
+        reader.close()
+    elif _is_model(args.file):
+        signals, widths, _, _, _ = load_model(args.file)
+    else:
+        _, _, _, signals, widths = read_toggle_header(args.file)
+    for signal, width in zip(signals, widths):
+        print("%s,%d" % (signal, width) if args.widths else signal)
+
+def show_model(argv):
+    """
+    Modules of a model with their # of terms and constants
+    """
+    parser = argparse.ArgumentParser(
+        prog='simmani model', description='Summarize a power model')
+    parser.add_argument("model", type=str, help='model file (.csv or .bin)')
+    parser.add_argument("--module", dest="module", type=str,
+                        help='list terms and coefficients of a module')
+    args = parser.parse_args(argv)
+
+    signals, _, modules, terms, models = load_model(args.model)
+    print("# signals: %d, # terms: %d, # modules: %d" % (
+        len(signals), len(terms), len(modules)))
+    for module, model in zip(modules, models):
+        print("%s: %d terms, const: %f" % (module, np.count_nonzero(model[1:]), model[0]))
+    if args.module:
+        assert args.module in modules, "%s not in %s" % (args.module, str(modules))
+        model = models[modules.index(args.module)]
+        for i in np.flatnonzero(model[1:]):
+            print("%s,%s" % ('*'.join(signals[x] for x in terms[i]), model[i+1]))
+
+def convert_toggles(argv):
+    """
+    Toggle file (as from vcd_reader) from VCDs, or from another toggle file
+    """
+    parser = argparse.ArgumentParser(
+        prog='simmani convert', description='Convert VCDs or a toggle file to a toggle file')
+    parser.add_argument("-i", "--input", dest="input", type=str, nargs='+', required=True,
+                        help='vcd files or a toggle file (.csv or binary)')
+    parser.add_argument("-o", "--output", dest="output", type=str, required=True,
+                        help='toggle file (.csv or binary)')
+    parser.add_argument("-w", "--window", dest="window", type=int,
+                        help='window size (in cycle) of vcd files')
+    args = parser.parse_args(argv)
+
+    if all(filename.endswith(".vcd") for filename in args.input):
+        assert args.window, "window is required for vcd files"
+        cycles, reset_cycles, toggles = list(), list(), list()
+        signals = None
+        for vcd in args.input:
+            _cycles, _reset_cycles, _signals, _toggles, _widths = read_toggles_vcd(
+                vcd, window=args.window, normalize=False)
+            if signals is None:
+                signals, widths = _signals, _widths
+            assert signals == _signals, "%s: signals differ" % vcd
+            assert all(widths == _widths), "%s: widths differ" % vcd
+            cycles.append(_cycles)
+            reset_cycles.append(_reset_cycles)
+            toggles.append(_toggles)
+        window, toggles = args.window, hstack(toggles)
+    else:
+        assert len(args.input) == 1, "only one toggle file can be converted"
+        toggle_file = args.input[0]
+        window, cycles, reset_cycles, signals, toggles, widths = \
+            read_toggles_csv(toggle_file, False) if toggle_file.endswith(".csv") else \
+            read_toggles_bin(toggle_file, False)
+        assert args.window is None or args.window == window, "%d != %d" % (args.window, window)
+    store_toggles(args.output, window, cycles, reset_cycles, signals, toggles, widths)
@@ -1,10 +1,13 @@
+import os.path
 import sys
 import logging
 from time import time
 import numpy as np
 from scipy.sparse.linalg import svds
-from sklearn.cluster import KMeans
+from ..utils.profile import profiled, span
+from ..utils.resources import threads
 
+@profiled("pca")
 def pca(A, k):
     """
     Principle Component Analysis
@@ -14,16 +17,47 @@ def pca(A, k):
       - k: # of components
 
     Outputs:
-      - projections to k singular vectors
+      - projections to k singular vectors (ascending singular values)
+      - k singular values
     """
 
     m = A.shape[0]
-    Vt = svds(A, k=k)[2]
+    _, s, Vt = svds(A, k=k)
+    order = np.argsort(s)
+    s, Vt = s[order], Vt[order]
     A_k = A.dot(Vt.T)
     assert A_k.shape == (m, k)
-    return A_k
+    return A_k, s
 
-def spectral_clustering(A, min_k, max_k):
+def store_projection(filename, key, signals, A_k, s):
+    """
+    Cache projections from `pca` so clustering can be rerun with
+    different k bounds without reading toggles again
+    """
+    logging.info("Projection file: %s", filename)
+    with open(filename, "wb") as _f:
+        np.savez(_f, key=np.array(key), signals=np.array(signals),
+                 projection=A_k, singular_values=s)
+
+def load_projection(filename, key):
+    """
+    Load cached projections if they were computed from the same inputs
+
+    Outputs:
+      - signals, projections, singular values (ascending)
+        or None if the cache is missing or stale
+    """
+    if not os.path.isfile(filename):
+        return None
+    with np.load(filename) as cache:
+        if str(cache['key']) != key:
+            logging.info("Stale projection file: %s", filename)
+            return None
+        logging.info("Projection file: %s", filename)
+        return cache['signals'], cache['projection'], cache['singular_values']
+
+@profiled("spectral clustering")
+def spectral_clustering(A, min_k, max_k, A_max_k=None):
     """
     Spectral clustering with model selection
 
@@ -31,21 +65,28 @@ def spectral_clustering(A, min_k, max_k):
       - A: data (CSR matrix)
       - min_k: min # of clusters
       - max_k: max # of clusters
+      - A_max_k: precomputed projections to max_k singular vectors
+                 (e.g. from a sketch), A is not used if given
     Outputs:
       - cluster centers
     """
 
-    n = A.shape[0]
-    # Dimension reduction
-    start_time = time()
-    A_max_k = pca(A, max_k)
-    end_time = time()
-    logging.info("[Spectral Clustering] dimension reduction time: %.2fs",
-                 end_time - start_time)
+    if A_max_k is None:
+        # Dimension reduction
+        start_time = time()
+        A_max_k, _ = pca(A, max_k)
+        end_time = time()
+        logging.info("[Spectral Clustering] dimension reduction time: %.2fs",
+                     end_time - start_time)
+    assert A_max_k.shape[1] >= max_k, "%d < %d" % (A_max_k.shape[1], max_k)
+    n = A_max_k.shape[0]
+
+    from sklearn.cluster import KMeans
 
     def clustering(A, k):
-        # Run k-menas multiple times
-        kmeans = KMeans(n_clusters=k, n_jobs=8).fit(A)
+        # Run k-menas multiple times (n_init=10) in OpenMP threads
+        with threads("k-means"):
+            kmeans = KMeans(n_clusters=k).fit(A)
 
         # compute BIC
         sig = kmeans.inertia_ / (n - k)
@@ -82,7 +123,8 @@ def spectral_clustering(A, min_k, max_k):
         start_time = time()
         A_k = A_max_k[:, :k]
         score_k = -float('inf')
-        centers_k, score_k, labels_k = clustering(A_k, k)
+        with span("kmeans", k=k, points=A_k):
+            centers_k, score_k, labels_k = clustering(A_k, k)
         delta = score_k - score
         end_time = time()
         logging.info("[Spectral Clustering] k: %d, BIC: %.2f, delta: %.2f, time: %.2fs",
@@ -0,0 +1,63 @@
+import logging
+import numpy as np
+from ..utils.profile import profiled
+
+@profiled("coreset")
+def select_windows(A, y, budget, clusters=8, bins=4, seed=0):
+    """
+    Weighted coreset of windows for regression training, stratified by
+    toggle-space clusters and power ranges. Windows are sampled uniformly
+    within each stratum, and weighted by the # of windows they represent.
+
+    Inputs:
+      - A: windows x signals toggles
+      - y: power of windows (e.g. total power)
+      - budget: # of windows to select
+      - clusters: # of clusters in the toggle space
+      - bins: # of power ranges (quantiles)
+        (clusters x bins is reduced to at most budget strata)
+    Outputs:
+      - indices of selected windows (ascending), weights (mean 1)
+    """
+    n = A.shape[0]
+    if budget >= n:
+        return np.arange(n), np.ones(n)
+
+    from sklearn.cluster import KMeans
+    # at most `budget` strata, so that each gets a window within the budget
+    bins = min(bins, budget)
+    clusters = min(clusters, max(1, budget // bins))
+    rs = np.random.RandomState(seed)
+    # Clusters are fit on a sample so that the cost is fixed for long traces
+    sample = np.sort(rs.choice(n, min(n, 20 * budget), replace=False))
+    kmeans = KMeans(n_clusters=clusters, n_init=1,
+                    random_state=seed).fit(A[sample])
+    labels = kmeans.predict(A)
+    edges = np.unique(np.quantile(y, np.linspace(0.0, 1.0, bins + 1)[1:-1]))
+    strata = labels * bins + np.searchsorted(edges, y, side='right')
+    _, inverse, sizes = np.unique(strata, return_inverse=True, return_counts=True)
+
+    # Proportional allocation with at least one window per stratum
+    shares = budget * sizes / n
+    quotas = np.minimum(np.maximum(1, np.floor(shares)).astype(int), sizes)
+    while quotas.sum() > budget:
+        quotas[np.argmax(np.where(quotas > 1, quotas - shares, -np.inf))] -= 1
+    for i in np.argsort(quotas - shares):
+        if quotas.sum() >= budget:
+            break
+        if quotas[i] < sizes[i]:
+            quotas[i] += 1
+
+    idxs = list()
+    weights = list()
+    for i, (size, quota) in enumerate(zip(sizes, quotas)):
+        idxs.append(rs.choice(np.flatnonzero(inverse == i), quota, replace=False))
+        weights.append(np.full(quota, size / quota))
+    idxs = np.concatenate(idxs)
+    weights = np.concatenate(weights)
+    order = np.argsort(idxs)
+    idxs, weights = idxs[order], weights[order]
+    assert len(idxs) <= budget, "%d > %d windows" % (len(idxs), budget)
+    logging.info("[Coreset] %d of %d windows, %d strata, weights: %.1f - %.1f",
+                 len(idxs), n, len(sizes), weights.min(), weights.max())
+    return idxs, weights * len(weights) / weights.sum()
@@ -0,0 +1,233 @@
+import os.path
+import csv
+import json
+import mmap
+import struct
+import logging
+import numpy as np
+from scipy.sparse import csc_matrix, issparse
+from ..utils.profile import profiled
+
+MODEL_MAGIC = b"SIMMANI\x01"
+
+class Terms(object):
+    """
+    Terms stored as flat index arrays, term i is idxs[ptr[i]:ptr[i+1]]
+    """
+
+    def __init__(self, ptr, idxs):
+        self.ptr = ptr
+        self.idxs = idxs
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def __getitem__(self, i):
+        return self.idxs[self.ptr[i]:self.ptr[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def store_model_bin(filename, signals, widths, modules, terms, models):
+    """
+    Store a model as a binary file: a JSON header with signal names,
+    widths and modules followed by aligned raw arrays
+    """
+    logging.info("Binary model file: %s", filename)
+    assert models.shape == (len(modules), len(terms)+1)
+    ptr = np.cumsum([0] + [len(term) for term in terms]).astype(np.int32)
+    idxs = np.array([i for term in terms for i in term], dtype=np.int32)
+    arrays = [
+        ('ptr', ptr),
+        ('idxs', idxs),
+        ('models', np.ascontiguousarray(models, dtype=np.float64)),
+    ]
+    header = {
+        'signals': list(signals),
+        'widths': [int(width) for width in widths],
+        'modules': list(modules),
+        'arrays': dict()
+    }
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = [array.dtype.str, array.shape, offset]
+        offset += -(-array.nbytes // 64) * 64
+    header = json.dumps(header).encode("utf-8")
+    start = -(-(len(MODEL_MAGIC) + 8 + len(header)) // 64) * 64
+    with open(filename, "wb") as _f:
+        _f.write(MODEL_MAGIC)
+        _f.write(struct.pack("<Q", len(header)))
+        _f.write(header)
+        for _, array in arrays:
+            _f.write(b"\0" * (start - _f.tell()))
+            _f.write(array.tobytes())
+            start += -(-array.nbytes // 64) * 64
+
+def load_model_bin(filename):
+    """
+    Load a binary model without copying its arrays
+    """
+    logging.info("Binary model file: %s", filename)
+    assert os.path.isfile(filename), "%s not found" % (filename)
+    assert os.path.getsize(filename) > 0, "%s: model not trained (placeholder)" % (filename)
+    assert _is_model_bin(filename), "%s: not a model file" % (filename)
+    with open(filename, "rb") as _f:
+        buf = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+    size = struct.unpack_from("<Q", buf, len(MODEL_MAGIC))[0]
+    begin = len(MODEL_MAGIC) + 8
+    header = json.loads(buf[begin:begin+size].decode("utf-8"))
+    start = -(-(begin + size) // 64) * 64
+    arrays = dict()
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(
+            buf, dtype=dtype, count=count, offset=start+offset).reshape(shape)
+    signals, widths, modules = header['signals'], header['widths'], header['modules']
+    terms = Terms(arrays['ptr'], arrays['idxs'])
+    models = arrays['models']
+    assert len(signals) == len(widths)
+    assert models.shape == (len(modules), len(terms)+1)
+    return signals, widths, modules, terms, models
+
+def _is_model_bin(filename):
+    with open(filename, "rb") as _f:
+        return _f.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+
+def model_bin_filename(filename):
+    return os.path.splitext(filename)[0] + ".bin"
+
+def load_model(filename):
+    if filename.endswith(".bin"):
+        return load_model_bin(filename)
+    bin_filename = model_bin_filename(filename)
+    # placeholders (see store_empty_model) are not loaded
+    if os.path.isfile(bin_filename) and \
+       os.path.getmtime(bin_filename) >= os.path.getmtime(filename) and \
+       _is_model_bin(bin_filename):
+        return load_model_bin(bin_filename)
+    logging.info("Model file: %s", filename)
+    assert os.path.isfile(filename), "%s not found" % (filename)
+    assert os.path.getsize(filename) > 0, "%s: model not trained (placeholder)" % (filename)
+    terms = list()
+    models = list()
+    def _int(lst):
+        return [int(x) for x in lst]
+    def _float(lst):
+        return [float(x) for x in lst]
+    with open(filename, "r") as _f:
+        reader = csv.reader(_f)
+        for line in reader:
+            if line[0] == 'signals':
+                signals = line[1:]
+                lookup = dict((signal, i) for i, signal in enumerate(signals))
+            elif line[0] == 'widths':
+                widths = _int(line[1:])
+            elif line[0] == 'modules':
+                modules = line[1:]
+            else:
+                assert len(line) == len(modules) + 1
+                if line[0] != 'const':
+                    term = [lookup[s] for s in line[0].split('*')]
+                    terms.append(term)
+                models.append(_float(line[1:]))
+    models = np.array(models).T
+    assert len(signals) == len(widths)
+    assert models.shape == (len(modules), len(terms)+1)
+    return signals, widths, modules, terms, models
+
+class Evaluator(object):
+    """
+    Power models of all modules compiled for batched evaluation
+
+    Only terms with a nonzero coefficient in some module are kept and
+    terms with the same signal product are merged. Each product is built
+    from its longest already computed prefix, and all modules are
+    predicted with one (sparse) matrix product, so evaluation time is
+    proportional to the number of nonzero coefficients.
+    """
+
+    def __init__(self, signals, terms, models):
+        assert models.shape[1] == len(terms) + 1
+        self.signals = list(signals)
+        self.const = models[:, 0]
+        coefs = dict() # signal product -> coefficients for modules
+        for term, coef in zip(terms, models[:, 1:].T):
+            if np.count_nonzero(coef) > 0:
+                product = tuple(sorted(term))
+                coefs[product] = coefs.get(product, 0.0) + coef
+        self.products = sorted(coefs, key=lambda x: (len(x), x))
+        self.coefs = np.array([coefs[product] for product in self.products]) \
+                     .reshape(len(self.products), len(self.const))
+
+        # plan: product = columns[left] * signal
+        self._idxs = list(range(len(self.signals)))
+        self._plan = list()
+        columns = dict()
+        for product in self.products:
+            self._add(product, columns)
+        self._outputs = [columns[product] for product in self.products]
+        logging.info("[Evaluator] # of terms: %d, # of products: %d, "
+                     "# of steps: %d", len(terms), len(self.products), len(self._plan))
+
+    def _add(self, product, columns):
+        if product in columns:
+            return columns[product]
+        left = self._add(product[:-1], columns) if len(product) > 1 else None
+        columns[product] = len(self._plan)
+        self._plan.append((left, product[-1]))
+        return columns[product]
+
+    def bind(self, signals):
+        """
+        Evaluate toggles whose columns are ordered by `signals`
+        """
+        lookup = dict((signal, i) for i, signal in enumerate(signals))
+        self._idxs = [lookup[signal] for signal in self.signals]
+        return self
+
+    def terms(self, A):
+        """
+        Materialize products (windows x products) from toggles (windows x signals)
+        """
+        if issparse(A):
+            return self._terms_sparse(csc_matrix(A))
+        n = A.shape[0]
+        idxs = self._idxs
+        columns = np.empty((n, len(self._plan)), dtype=A.dtype)
+        for i, (left, var) in enumerate(self._plan):
+            if left is None:
+                columns[:, i] = A[:, idxs[var]]
+            else:
+                np.multiply(columns[:, left], A[:, idxs[var]], out=columns[:, i])
+        return columns[:, self._outputs]
+
+    def _terms_sparse(self, A):
+        def _col(j):
+            low, high = A.indptr[j], A.indptr[j+1]
+            return A.indices[low:high], A.data[low:high]
+        columns = list()
+        for left, var in self._plan:
+            idx, val = _col(self._idxs[var])
+            if left is not None:
+                _idx, _val = columns[left]
+                idx, i, j = np.intersect1d(_idx, idx, assume_unique=True, return_indices=True)
+                val = _val[i] * val[j]
+            columns.append((idx, val))
+        outputs = [columns[i] for i in self._outputs]
+        indptr = np.cumsum([0] + [len(idx) for idx, _ in outputs])
+        indices = np.concatenate([idx for idx, _ in outputs]) if outputs else []
+        data = np.concatenate([val for _, val in outputs]) if outputs else []
+        return csc_matrix((data, indices, indptr), shape=(A.shape[0], len(outputs)))
+
+    @profiled("predict")
+    def predict(self, A):
+        """
+        Predict power for all modules
+        Inputs:
+          - A: toggles (windows x signals), dense or sparse
+        Outputs:
+          - windows x modules predictions
+        """
+        return np.asarray(self.terms(A).dot(self.coefs)) + self.const
@@ -3,22 +3,50 @@ from functools import reduce
 from itertools import combinations, repeat
 import numpy as np
 from scipy.sparse import csr_matrix, issparse, isspmatrix_csr
-from sklearn.linear_model import LassoCV
-# from sklearn.linear_model import LassoLarsCV as LassoCV
-from sklearn.linear_model import ElasticNetCV
-from sklearn.preprocessing import StandardScaler
+from ..utils import float_dtype, index_dtype
+from ..utils.profile import profiled
+from ..utils.resources import parallel
+# sklearn is imported by solvers so that commands without fitting start fast
 
-def lasso(A, y, positive=True):
-    A_scaler = StandardScaler().fit(A[:, 1:])
-    y_scaler = StandardScaler().fit(y.reshape(-1, 1))
-    A_new = A_scaler.transform(A[:, 1:])
-    y_new = y_scaler.transform(y.reshape(-1, 1)).reshape(-1)
-    clf = LassoCV(
-        cv=5,
-        n_jobs=8,
-        normalize=False,
-        fit_intercept=False,
-        positive=positive).fit(A_new, y_new)
+def _standardize(A, y, weights=None):
+    """
+    Standardize features (except the constant) and targets. With weights,
+    moments are weighted and rows are scaled by sqrt(weights) so that
+    least squares on the outputs minimize the weighted errors.
+    Outputs:
+      - A_new, y_new, feature means, feature scales, target mean, target scale
+    """
+    if weights is None:
+        from sklearn.preprocessing import StandardScaler
+        A_scaler = StandardScaler().fit(A[:, 1:])
+        y_scaler = StandardScaler().fit(y.reshape(-1, 1))
+        A_new = A_scaler.transform(A[:, 1:])
+        y_new = y_scaler.transform(y.reshape(-1, 1)).reshape(-1)
+        return A_new, y_new, A_scaler.mean_, A_scaler.scale_, y_scaler.mean_, y_scaler.scale_
+
+    A_mean = np.average(A[:, 1:], axis=0, weights=weights)
+    A_scale = np.sqrt(np.average((A[:, 1:] - A_mean) ** 2, axis=0, weights=weights))
+    A_scale[A_scale == 0.0] = 1.0
+    y_mean = np.average(y, weights=weights).reshape(1)
+    y_scale = np.sqrt(np.average((y - y_mean) ** 2, weights=weights)).reshape(1)
+    y_scale[y_scale == 0.0] = 1.0
+    w = np.sqrt(weights)
+    A_new = ((A[:, 1:] - A_mean) / A_scale) * w.reshape(-1, 1)
+    y_new = ((y - y_mean) / y_scale) * w
+    return A_new, y_new, A_mean, A_scale, y_mean, y_scale
+
+@profiled("solver fit")
+def lasso(A, y, positive=True, weights=None):
+    from sklearn.linear_model import LassoCV
+    # from sklearn.linear_model import LassoLarsCV as LassoCV
+    A_new, y_new, A_mean, A_scale, y_mean, y_scale = _standardize(A, y, weights)
+    with parallel(5, "LASSO CV") as n_jobs:
+        clf = LassoCV(
+            cv=5,
+            n_jobs=n_jobs,
+            normalize=False,
+            fit_intercept=False,
+            positive=positive).fit(A_new, y_new)
     score = clf.score(A_new, y_new)
     df = np.count_nonzero(clf.coef_)
     logging.info("[LASSO] # iter: %d, alpha: %e, # of terms: %d, score: %f",
@@ -30,22 +58,23 @@ def lasso(A, y, positive=True):
     nonzero = abs(clf.coef_) > 0.0
     coef = np.zeros_like(clf.coef_)
     # coef[nonzero] = ((y_scaler.var_ / A_scaler.var_[nonzero]) ** 0.5) * clf.coef_[nonzero]
-    coef[nonzero] = (y_scaler.scale_ / A_scaler.scale_[nonzero]) * clf.coef_[nonzero]
-    intercept = y_scaler.mean_ - np.dot(A_scaler.mean_, coef)
-    return np.append(intercept, coef), df
+    coef[nonzero] = (y_scale / A_scale[nonzero]) * clf.coef_[nonzero]
+    intercept = y_mean - np.dot(A_mean, coef)
+    return np.append(intercept, coef), df, (clf.alpha_, 1.0)
 
-def elastic_net(A, y, positive=True):
-    A_scaler = StandardScaler().fit(A[:, 1:])
-    y_scaler = StandardScaler().fit(y.reshape(-1, 1))
-    A_new = A_scaler.transform(A[:, 1:])
-    y_new = y_scaler.transform(y.reshape(-1, 1)).reshape(-1)
-    clf = ElasticNetCV(
-        l1_ratio=[0.1, 0.5, 1.0],
-        cv=5,
-        n_jobs=8,
-        normalize=False,
-        fit_intercept=False,
-        positive=positive).fit(A_new, y_new)
+@profiled("solver fit")
+def elastic_net(A, y, positive=True, weights=None):
+    from sklearn.linear_model import ElasticNetCV
+    A_new, y_new, A_mean, A_scale, y_mean, y_scale = _standardize(A, y, weights)
+    # 5 folds of each l1_ratio
+    with parallel(15, "ElasticNet CV") as n_jobs:
+        clf = ElasticNetCV(
+            l1_ratio=[0.1, 0.5, 1.0],
+            cv=5,
+            n_jobs=n_jobs,
+            normalize=False,
+            fit_intercept=False,
+            positive=positive).fit(A_new, y_new)
     score = clf.score(A_new, y_new)
     # Approximate assuming the elastic net is very close to the lasso
     df = np.count_nonzero(clf.coef_)
@@ -57,17 +86,14 @@ def elastic_net(A, y, positive=True):
     logging.debug(str(clf.mse_path_))
     nonzero = abs(clf.coef_) > 0.0
     coef = np.zeros_like(clf.coef_)
-    coef[nonzero] = (y_scaler.scale_ / A_scaler.scale_[nonzero]) * clf.coef_[nonzero]
-    intercept = y_scaler.mean_ - np.dot(A_scaler.mean_, coef)
-    return np.append(intercept, coef), df
+    coef[nonzero] = (y_scale / A_scale[nonzero]) * clf.coef_[nonzero]
+    intercept = y_mean - np.dot(A_mean, coef)
+    return np.append(intercept, coef), df, (clf.alpha_, clf.l1_ratio_)
 
-def polynomial_regression(A, y, degree, positive=True, use_elastic_net=True):
+def polynomial_terms(m, degree):
     """
-    Regression with high-order terms
+    Column index sets of the terms of m variables up to degree
     """
-    n, m = A.shape
-    assert n == y.shape[0], "%d != %d" % (n, y.shape[0])
-    ones = np.ones((n, 1), dtype=A.dtype)
     terms = [(x,) for x in range(m)]
     # Cross terms
     for k in range(2, degree+1):
@@ -75,13 +101,37 @@ def polynomial_regression(A, y, degree, positive=True, use_elastic_net=True):
     # High-order terms
     for k in range(2, degree+1):
         terms.extend([tuple(repeat(x, k)) for x in range(m)])
+    return terms
+
+def polynomial_regression(A, y, degree, positive=True, use_elastic_net=True, weights=None):
+    """
+    Regression with high-order terms
+    (features are expanded in float_dtype())
+    weights: weights of rows (e.g. from `select_windows`)
+    Outputs:
+      - model, terms, # of terms, y_hat, (alpha, l1_ratio) selected by CV
+    """
+    A = A.astype(float_dtype(), copy=False)
+    n, m = A.shape
+    assert n == y.shape[0], "%d != %d" % (n, y.shape[0])
+    ones = np.ones((n, 1), dtype=A.dtype)
+    terms = polynomial_terms(m, degree)
     A_ = np.append(ones, get_terms(A, terms), axis=1)
     logging.info("[Polynomial Regression] Total # of terms: %d, "
                  "matrix shape: %s", len(terms), str(A_.shape))
-    model, df = elastic_net(A_, y, positive) \
-        if use_elastic_net else lasso(A_, y, positive)
-    return model, terms, df, A_.dot(model)
+    model, df, params = elastic_net(A_, y, positive, weights) \
+        if use_elastic_net else lasso(A_, y, positive, weights)
+    return model, terms, df, A_.dot(model), params
+
+def predict(A, terms, model):
+    """
+    Predict with a model from `polynomial_regression` expanding only
+    the terms with nonzero coefficients
+    """
+    nonzero = np.flatnonzero(model[1:])
+    return model[0] + get_terms(A, [terms[i] for i in nonzero]).dot(model[1:][nonzero])
 
+@profiled("term expansion")
 def get_terms(A, idxs):
     """
     Get high-order terms from idxs
@@ -106,8 +156,9 @@ def get_terms(A, idxs):
             indices.extend(term.indices)
             indptr.append(indptr[-1] + term.indices.shape[0])
         data = np.array(data, dtype=A.dtype)
-        indices = np.array(indices, dtype=np.int64)
-        indptr = np.array(indptr, dtype=np.int64)
+        dtype = index_dtype(max(n, len(data)))
+        indices = np.array(indices, dtype=dtype)
+        indptr = np.array(indptr, dtype=dtype)
         shape = len(idxs), n
         return csr_matrix((data, indices, indptr), shape=shape).T
 
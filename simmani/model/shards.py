@@ -0,0 +1,225 @@
+"""
+Sufficient statistics of polynomial regression
+
+A shard keeps, for a signal set, a window, and polynomial terms,
+the Gram matrix X^T X of the terms (with the constant), X^T y and
+sum(y^2) of each module, so elastic nets can be fit on any subset of
+shards without their traces. Statistics are additive across shards.
+"""
+
+import os.path
+import logging
+import numpy as np
+from .regression import get_terms
+from ..utils.profile import profiled
+
+@profiled("shard statistics")
+def regression_stats(A, ys, terms, chunk=4096):
+    """
+    Inputs:
+      - A: windows x signals toggles
+      - ys: modules x windows power
+      - terms: polynomial terms from `polynomial_terms`
+    Outputs:
+      - gram: X^T X, xy: modules x (X^T y), y_sq: sum(y^2) of modules
+    """
+    ys = np.asarray(ys, dtype=float)
+    p = len(terms) + 1
+    gram = np.zeros((p, p))
+    xy = np.zeros((ys.shape[0], p))
+    for begin in range(0, A.shape[0], chunk):
+        end = min(begin + chunk, A.shape[0])
+        X = np.append(np.ones((end - begin, 1)),
+                      get_terms(np.asarray(A[begin:end], dtype=float), terms), axis=1)
+        gram += X.T.dot(X)
+        xy += ys[:, begin:end].dot(X)
+    return gram, xy, np.sum(ys ** 2, axis=1)
+
+def model_state_filename(filename):
+    """ Training state (merged statistics) of a model for updates """
+    return os.path.join(os.path.dirname(filename), "model-state.npz")
+
+def store_shard(filename, name, signals, widths, window, modules, misc, terms, stats,
+                models=None, params=None):
+    """
+    Store statistics from `regression_stats` of a benchmark,
+    or of all training data with models and their (alpha, l1_ratio)
+    as a training state
+    """
+    logging.info("Shard file: %s", filename)
+    degree = max(len(term) for term in terms) if terms else 1
+    padded = np.full((len(terms), degree), -1, dtype=np.int32)
+    for i, term in enumerate(terms):
+        padded[i, :len(term)] = term
+    gram, xy, y_sq = stats
+    state = dict() if models is None else dict(models=np.array(models), params=np.array(params))
+    with open(filename, "wb") as _f:
+        np.savez(_f, name=np.array(name), signals=np.array(signals),
+                 widths=np.array(widths), window=np.array(window),
+                 modules=np.array(modules), misc=np.array(misc),
+                 terms=padded, gram=gram, xy=xy, y_sq=y_sq, **state)
+
+def load_shard(filename):
+    """
+    Outputs:
+      - dict of name, signals, widths, window, modules, misc, terms, gram, xy, y_sq
+        (and models, params of a training state)
+    """
+    logging.info("Shard file: %s", filename)
+    assert os.path.isfile(filename), "%s not found" % filename
+    with np.load(filename) as data:
+        shard = dict((key, data[key]) for key in data.files)
+    for key in ['name', 'window', 'misc']:
+        shard[key] = shard[key].item()
+    for key in ['signals', 'modules']:
+        shard[key] = shard[key].tolist()
+    shard['widths'] = shard['widths'].tolist()
+    shard['terms'] = [tuple(x for x in term if x >= 0) for term in shard['terms'].tolist()]
+    return shard
+
+def _standardize(shards, target):
+    """
+    Statistics of standardized features and target of each shard, with
+    the moments of all shards (as StandardScaler on all windows does)
+    Outputs:
+      - [(n, X^T X, X^T y, y^T y)] of shards, feature means, feature scales,
+        target mean, target scale
+    """
+    n = sum(shard['gram'][0, 0] for shard in shards)
+    sums = sum(shard['gram'][0, 1:] for shard in shards)
+    squares = sum(np.diag(shard['gram'])[1:] for shard in shards)
+    y_sum = sum(shard['xy'][target, 0] for shard in shards)
+    y_sq = sum(shard['y_sq'][target] for shard in shards)
+    mean = sums / n
+    scale = np.sqrt(np.maximum(squares / n - mean ** 2, 0.0))
+    scale[scale == 0.0] = 1.0
+    y_mean = y_sum / n
+    y_scale = np.sqrt(max(y_sq / n - y_mean ** 2, 0.0)) or 1.0
+
+    stats = list()
+    for shard in shards:
+        gram, xy = shard['gram'], shard['xy'][target]
+        n_k, s_k, sy_k = gram[0, 0], gram[0, 1:], xy[0]
+        Z = (gram[1:, 1:] - np.outer(s_k, mean) - np.outer(mean, s_k) +
+             n_k * np.outer(mean, mean)) / np.outer(scale, scale)
+        c = (xy[1:] - mean * sy_k - s_k * y_mean + n_k * mean * y_mean) / (scale * y_scale)
+        t = (shard['y_sq'][target] - 2 * y_mean * sy_k + n_k * y_mean ** 2) / y_scale ** 2
+        stats.append((n_k, Z, c, t))
+    return stats, mean, scale, y_mean, y_scale
+
+def _merge(stats):
+    return tuple(sum(x) for x in zip(*stats))
+
+def merge_shards(shards, name):
+    """
+    A shard of all statistics in shards
+    """
+    shard = dict(shards[0], name=name)
+    for key in ['gram', 'xy', 'y_sq']:
+        shard[key] = sum(_shard[key] for _shard in shards)
+    return shard
+
+def _path(stats, l1_ratio, alphas, positive, coef_init=None):
+    """
+    Elastic net path from (n, X^T X, X^T y, y^T y). Least squares on
+    R, r with R^T R = X^T X and R^T r = X^T y have the same solutions,
+    so alphas are rescaled by n / (# of rows of R).
+    """
+    from sklearn.linear_model import enet_path
+    n, Z, c, _ = stats
+    lam, V = np.linalg.eigh(Z)
+    keep = lam > max(lam.max(), 0.0) * 1e-12
+    R = np.sqrt(lam[keep]).reshape(-1, 1) * V[:, keep].T
+    r = V[:, keep].T.dot(c) / np.sqrt(lam[keep])
+    _, coefs, _ = enet_path(np.asfortranarray(R), r, l1_ratio=l1_ratio,
+                            alphas=alphas * n / R.shape[0], positive=positive,
+                            coef_init=coef_init)
+    return coefs.T
+
+def _sse(stats, coef):
+    _, Z, c, t = stats
+    return t - 2.0 * coef.dot(c) + coef.dot(Z).dot(coef)
+
+def _model(total, coef, mean, scale, y_mean, y_scale):
+    """
+    Model in the original scale and (R^2, BIC) from standardized coefficients
+    """
+    n = total[0]
+    df = np.count_nonzero(coef)
+    sse = _sse(total, coef)
+    r2 = 1.0 - sse / total[3]
+    bic = sse * y_scale ** 2 / (y_scale ** 2 + np.finfo('float64').eps) + np.log(n) * df
+    nonzero = abs(coef) > 0.0
+    _coef = np.zeros_like(coef)
+    _coef[nonzero] = (y_scale / scale[nonzero]) * coef[nonzero]
+    intercept = y_mean - np.dot(mean, _coef)
+    return np.append(intercept, _coef), df, (r2, bic)
+
+@profiled("shard fit")
+def fit_shards(shards, target, positive=True, l1_ratios=(0.1, 0.5, 1.0), n_alphas=100, eps=1e-3):
+    """
+    Elastic net on merged shards for a target (module index).
+    alpha and l1_ratio are selected by leave-one-shard-out CV,
+    or by BIC if there is only one shard.
+    Outputs:
+      - model, # of terms, (R^2, BIC), (alpha, l1_ratio),
+        NRMSE of each shard held out (None without CV)
+    """
+    stats, mean, scale, y_mean, y_scale = _standardize(shards, target)
+    total = _merge(stats)
+    n = total[0]
+    best = None
+    for l1_ratio in l1_ratios:
+        alpha_max = np.abs(total[2]).max() / (n * l1_ratio)
+        alphas = np.logspace(np.log10(alpha_max), np.log10(alpha_max * eps), n_alphas) \
+                 if alpha_max > 0.0 else np.array([1.0])
+        if len(stats) > 1:
+            folds = list()
+            errors = np.zeros(len(alphas))
+            for k, held_out in enumerate(stats):
+                coefs = _path(_merge(stats[:k] + stats[k+1:]), l1_ratio, alphas, positive)
+                sses = np.array([_sse(held_out, coef) for coef in coefs])
+                folds.append(sses)
+                errors += sses
+            i = np.argmin(errors)
+            held_outs = [sses[i] for sses in folds]
+        else:
+            coefs = _path(total, l1_ratio, alphas, positive)
+            errors = np.array([_sse(total, coef) + np.log(n) * np.count_nonzero(coef)
+                               for coef in coefs])
+            i = np.argmin(errors)
+            held_outs = None
+        if best is None or errors[i] < best[0]:
+            best = (errors[i], l1_ratio, alphas, i, held_outs)
+
+    _, l1_ratio, alphas, i, held_outs = best
+    coef = _path(total, l1_ratio, alphas[:i+1], positive)[-1]
+    model, df, score = _model(total, coef, mean, scale, y_mean, y_scale)
+    logging.info("[ElasticNet] alpha: %e, l1_ratio: %.2f, # of terms: %d, score: %f",
+                 alphas[i], l1_ratio, df, score[0])
+
+    nrmses = None
+    if held_outs is not None:
+        nrmses = list()
+        for shard, (n_k, _, _, _), sse_k in zip(shards, stats, held_outs):
+            y_mean_k = shard['xy'][target, 0] / n_k
+            nrmses.append(np.sqrt(max(sse_k, 0.0) * y_scale ** 2 / n_k) / max(abs(y_mean_k), 1e-30))
+    return model, df, score, (alphas[i], l1_ratio), nrmses
+
+@profiled("shard fit")
+def refit_shards(shards, target, model, params, positive=True):
+    """
+    Elastic net on merged shards for a target (module index) with the
+    alpha and l1_ratio of a previous model, warm-started from it
+    Outputs:
+      - model, # of terms, (R^2, BIC)
+    """
+    alpha, l1_ratio = params
+    stats, mean, scale, y_mean, y_scale = _standardize(shards, target)
+    total = _merge(stats)
+    coef_init = np.asarray(model[1:]) * scale / y_scale
+    coef = _path(total, l1_ratio, np.array([alpha]), positive, coef_init)[-1]
+    model, df, score = _model(total, coef, mean, scale, y_mean, y_scale)
+    logging.info("[ElasticNet] alpha: %e, l1_ratio: %.2f, # of terms: %d, score: %f",
+                 alpha, l1_ratio, df, score[0])
+    return model, df, score
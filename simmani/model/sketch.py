@@ -0,0 +1,92 @@
+import numpy as np
+
+class _Sketch(object):
+    """
+    Sketch of an m x n matrix A whose columns arrive one window at a time.
+    Keeps an m x l matrix B such that B B^T approximates A A^T, so the
+    left singular structure of A (all spectral clustering needs) can be
+    recovered in O(m x l) memory.
+
+    Subclasses add columns (m or m x k) with `append(a)`, and return
+    the m x l' sketch B with `matrix()`.
+    """
+
+    def __init__(self, m, l):
+        self.m = m
+        self.l = l
+        self.n = 0
+
+    def projection(self, k):
+        """
+        Projections to k singular vectors, same as `pca(A, k)`
+        Inputs:
+          - k: # of components
+        Outputs:
+          - m x k matrix (ascending singular values) and singular values
+        """
+        B = self.matrix()
+        assert k <= min(B.shape), "k: %d > sketch: %s" % (k, str(B.shape))
+        U, s, _ = np.linalg.svd(B, full_matrices=False)
+        U, s = U[:, k-1::-1], s[k-1::-1]
+        return U * s, s
+
+class FrequentDirections(_Sketch):
+    """
+    Frequent directions (Liberty, KDD'13) over the columns of A.
+    Columns are buffered in a 2l-wide matrix which is shrunk by SVD
+    when full, giving O(m x l) amortized update cost per column.
+    """
+
+    def __init__(self, m, l):
+        super(FrequentDirections, self).__init__(m, l)
+        self.B = np.zeros((m, 2 * l))
+        self.next = 0
+
+    def _shrink(self):
+        U, s, _ = np.linalg.svd(self.B[:, :self.next], full_matrices=False)
+        l = min(self.l, len(s))
+        delta = s[l-1] ** 2
+        s = np.sqrt(np.maximum(s[:l] ** 2 - delta, 0.0))
+        self.B[:, :] = 0.0
+        self.B[:, :l] = U[:, :l] * s
+        self.next = np.count_nonzero(s)
+
+    def append(self, a):
+        a = a.reshape(self.m, -1)
+        self.n += a.shape[1]
+        start = 0
+        while start < a.shape[1]:
+            if self.next == self.B.shape[1]:
+                self._shrink()
+            end = min(a.shape[1], start + self.B.shape[1] - self.next)
+            self.B[:, self.next:self.next+end-start] = a[:, start:end]
+            self.next += end - start
+            start = end
+
+    def matrix(self):
+        return self.B[:, :max(self.next, self.l)]
+
+class RandomProjection(_Sketch):
+    """
+    Gaussian random projection B = A G with G ~ N(0, 1/l), n x l.
+    Rows of G are drawn as columns arrive, so B is updated in place.
+    """
+
+    def __init__(self, m, l, seed=0):
+        super(RandomProjection, self).__init__(m, l)
+        self.B = np.zeros((m, l))
+        self.random = np.random.RandomState(seed)
+
+    def append(self, a):
+        a = a.reshape(self.m, -1)
+        self.n += a.shape[1]
+        G = self.random.normal(scale=1.0 / np.sqrt(self.l), size=(a.shape[1], self.l))
+        self.B += a.dot(G)
+
+    def matrix(self):
+        return self.B
+
+SKETCHES = {
+    'fd': FrequentDirections,
+    'rp': RandomProjection,
+}
@@ -1,5 +1,3 @@
-#!/usr/bin/env python3
-
 # See LICENSE for license details.
 
 import os
@@ -7,13 +5,11 @@ import sys
 import csv
 import argparse
 import logging
-from operator import add
-from functools import reduce
 import numpy as np
-from utils import read_modules
-from utils.power import read_power_files
-from utils.data import plot_power, dump_power_bars
-from analyze_samples import load_power_trace
+from .utils import read_modules
+from .utils.power import read_power_files, split_powers
+from .utils.data import plot_power, dump_power_bars
+from .utils.fpga import load_power_trace, align_powers, power_errors
 
 def parse_args(argv):
     parser = argparse.ArgumentParser()
@@ -36,7 +32,10 @@ def parse_args(argv):
 
 def plot_trace(benchmark, args, trace, out=None):
     window, _modules, ps = load_power_trace(trace)
-    p = reduce(add, ps[1:]) if len(ps) > 1 else ps[0]
+    # Skipped cycles are not read from the power out file
+    start_idx = (args.skip // window) if args.skip else 0
+    ps = [p[start_idx:] for p in ps]
+    p = np.sum(ps[1:], axis=0) if len(ps) > 1 else ps[0]
 
     if out is None:
         # Power Plot
@@ -46,42 +45,21 @@ def plot_trace(benchmark, args, trace, out=None):
     else:
         # Read module hierarchy
         module_filter, misc_module, children, labels = read_modules(args.modules)
-        modules, powers = read_power_files([out], window, module_filter=module_filter)
+        modules, powers = read_power_files(
+            [out], window, module_filter=module_filter,
+            cycles=(start_idx * window, None) if start_idx else None)
 
         assert len(p) - len(powers[0]) < 3, "%d != %d" % (len(p), len(powers[0]))
-        p_size = min(len(p), len(powers[0]))
+        names, targets = split_powers(modules, powers, children, labels, misc_module)
+        assert all(module in names for module in _modules), \
+            "%s != %s" % (str(_modules), str(names))
+        P, Y = align_powers(ps, [targets[names.index(module)] for module in _modules])
+        p_size = P.shape[1]
         total_cycles = p_size * window
-
-        ys = [powers[0]]
-        if children:
-            label_ys = dict()
-            for module, power in zip(modules[1:], powers[1:]):
-                assert module in children
-                idxs = [modules.index(child) for child in children[module]]
-                label = labels[module]
-                if label not in label_ys:
-                    label_ys[label] = 0.0
-                power -= np.array(powers)[idxs].sum(axis=0)
-                label_ys[label] += power
-
-            for module in _modules[1:-1]:
-                ys.append(label_ys[module])
-
-        if misc_module:
-            ys.append(ys[0] - np.sum(ys[1:], axis=0))
-
-        y = reduce(add, ys[1:]) if len(ys) > 1 else ys[0]
-
-        assert len(ps) == len(ys)
+        ys = list(Y)
+        y = Y[1:].sum(axis=0) if len(ys) > 1 else ys[0]
 
     # Power Plot
-    if args.skip:
-        start_idx = (args.skip // window)
-        total_cycles -= start_idx * window
-        y = y[start_idx:] if y is not None else None
-        p = p[start_idx:]
-        ys = [y[start_idx:] for y in ys] if ys is not None else None
-        ps = [p[start_idx:] for p in ps]
     png_filename = os.path.join(args.dir, "%s-trace.png" % benchmark)
     plot_power(png_filename, [y, p], total_cycles, window, benchmark)
 
@@ -95,20 +73,16 @@ def plot_trace(benchmark, args, trace, out=None):
     if args.out is None:
         return None, None
 
+    rmses, avges = power_errors(P, Y)
     stat_filename = os.path.join(args.dir, "%s-stats.csv" % benchmark)
     logging.info("Statistics file: %s", stat_filename)
     with open(stat_filename, "w") as _f:
         writer = csv.writer(_f)
         writer.writerow(["Module", "NRMSE (%)", "AVGE (%)"])
-        for i, (module, p, y) in enumerate(zip(_modules, ps, ys)):
-            sse = np.sum((p[:p_size] - y[:p_size]) ** 2)
-            rmse = np.sqrt(sse / p_size) / y.mean()
-            avge = abs((y.mean() - p.mean()) / y.mean())
+        for module, rmse, avge in zip(_modules, rmses, avges):
             writer.writerow([module, "%.2f" % (100 * rmse), "%.2f" % (100 * avge)])
-            if i == 0:
-                total_rmse, total_avge = rmse, avge
 
-    return total_rmse, total_avge
+    return rmses[0], avges[0]
 
 def main(argv):
     args = parse_args(argv)
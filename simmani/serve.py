@@ -0,0 +1,248 @@
+# See LICENSE for license details.
+
+"""
+Power model server for online power estimation
+
+Loads power models once and serves predictions over a Unix socket.
+All integers are little-endian.
+
+Request:  'SMRQ', model (u32), windows (u32), window size (u32), signals (u32)
+          followed by windows x signals toggle counts (u32) in the order
+          of the model signals. windows = 0 requests statistics instead.
+Response: 'SMRS', status (u32), windows (u32), modules (u32)
+          followed by windows x modules predicted power in mW (f64).
+          For statistics or errors (status != 0), windows is the length
+          of a UTF-8 (JSON) payload and modules is 0.
+"""
+
+import os
+import sys
+import json
+import struct
+import socket
+import argparse
+import logging
+import threading
+import socketserver
+from queue import Queue
+from concurrent.futures import Future
+from time import time, sleep
+import numpy as np
+from .model.evaluator import load_model, Evaluator
+
+REQUEST = struct.Struct("<4sIIII")
+RESPONSE = struct.Struct("<4sIII")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Power Model Server')
+    parser.add_argument("-m", "--model", dest="model", type=str,
+                        help='power model file names', nargs='+', required=True)
+    parser.add_argument("-s", "--socket", dest="socket", type=str,
+                        help='unix socket path', default='simmani.sock')
+    parser.add_argument("--workers", dest="workers", type=int,
+                        help="# of evaluation threads", default=1)
+    parser.add_argument("--queue", dest="queue", type=int,
+                        help="max # of queued batches", default=64)
+    parser.add_argument("--report", dest="report", type=float,
+                        help="metrics report interval (in sec)", default=10.0)
+    parser.add_argument("--log", dest="log", type=str,
+                        help="log level", default="info")
+
+    args, _ = parser.parse_known_args(argv)
+    assert args.log in ['info', 'debug']
+    return args
+
+def _recv(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while size > 0:
+        n = sock.recv_into(view, size)
+        if n == 0:
+            raise EOFError
+        view = view[n:]
+        size -= n
+    return buf
+
+class PowerModels(object):
+    """
+    Loaded power models evaluated by worker threads from a bounded queue
+    """
+
+    def __init__(self, filenames, workers, queue_size):
+        self.models = list()
+        for filename in filenames:
+            signals, widths, modules, terms, models = load_model(filename)
+            self.models.append((
+                filename, signals, np.array(widths), modules,
+                Evaluator(signals, terms, models)))
+        self.queue = Queue(queue_size)
+        self.lock = threading.Lock()
+        self.start_time = time()
+        self.batches = 0
+        self.windows = 0
+        self.busy = 0.0
+        self.latency = 0.0
+        self.max_depth = 0
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            future, model, counts, window, start_time = self.queue.get()
+            begin = time()
+            try:
+                _, _, widths, _, evaluator = self.models[model]
+                future.set_result(evaluator.predict(counts / (window * widths)))
+            except Exception as e: # pylint: disable=broad-except
+                future.set_exception(e)
+            end = time()
+            with self.lock:
+                self.batches += 1
+                self.windows += counts.shape[0]
+                self.busy += end - begin
+                self.latency += end - start_time
+
+    def submit(self, model, counts, window):
+        assert model < len(self.models), "unknown model: %d" % model
+        assert window > 0, "invalid window size: %d" % window
+        assert counts.shape[1] == len(self.models[model][1]), \
+            "%d != %d signals" % (counts.shape[1], len(self.models[model][1]))
+        future = Future()
+        self.queue.put((future, model, counts, window, time()))
+        depth = self.queue.qsize()
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+        return future
+
+    def stats(self):
+        with self.lock:
+            elapsed = time() - self.start_time
+            return {
+                'models': [
+                    {'file': filename, 'signals': signals, 'modules': modules}
+                    for filename, signals, _, modules, _ in self.models
+                ],
+                'uptime': elapsed,
+                'batches': self.batches,
+                'windows': self.windows,
+                'batches_per_sec': self.batches / elapsed,
+                'windows_per_sec': self.windows / elapsed,
+                'avg_latency_ms': 1e3 * self.latency / max(self.batches, 1),
+                'avg_eval_ms': 1e3 * self.busy / max(self.batches, 1),
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_depth,
+            }
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        models = self.server.models
+        while True:
+            try:
+                magic, model, windows, window, signals = \
+                    REQUEST.unpack(_recv(self.request, REQUEST.size))
+                assert magic == b"SMRQ", "bad request: %s" % str(magic)
+                if windows == 0:
+                    self._send(0, json.dumps(models.stats()).encode("utf-8"))
+                    continue
+                counts = np.frombuffer(
+                    _recv(self.request, 4 * windows * signals),
+                    dtype='<u4').reshape(windows, signals)
+                y_hats = models.submit(model, counts, window).result()
+                self.request.sendall(
+                    RESPONSE.pack(b"SMRS", 0, windows, y_hats.shape[1]) +
+                    y_hats.astype('<f8').tobytes())
+            except EOFError:
+                return
+            except (AssertionError, ValueError) as e:
+                logging.info("Bad request: %s", str(e))
+                self._send(1, str(e).encode("utf-8"))
+                return
+            except Exception as e: # pylint: disable=broad-except
+                # e.g. errors of evaluators, reported to the client
+                logging.info("Request failed: %s: %s", type(e).__name__, str(e))
+                self._send(1, ("%s: %s" % (type(e).__name__, str(e))).encode("utf-8"))
+                return
+
+    def _send(self, status, payload):
+        self.request.sendall(RESPONSE.pack(b"SMRS", status, len(payload), 0) + payload)
+
+class PowerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, models):
+        self.models = models
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+class PowerClient(object):
+    """
+    Client for simulators and scripts
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def close(self):
+        self.sock.close()
+
+    def _recv_response(self):
+        _, status, size, modules = RESPONSE.unpack(_recv(self.sock, RESPONSE.size))
+        if status != 0 or modules == 0:
+            payload = _recv(self.sock, size).decode("utf-8")
+            assert status == 0, payload
+            return json.loads(payload)
+        return np.frombuffer(_recv(self.sock, 8 * size * modules),
+                             dtype='<f8').reshape(size, modules)
+
+    def predict(self, counts, window, model=0):
+        """
+        Predict power from toggle counts (windows x signals)
+        """
+        counts = np.ascontiguousarray(counts, dtype='<u4')
+        self.sock.sendall(REQUEST.pack(b"SMRQ", model, counts.shape[0],
+                                       window, counts.shape[1]) + counts.tobytes())
+        return self._recv_response()
+
+    def stats(self):
+        self.sock.sendall(REQUEST.pack(b"SMRQ", 0, 0, 0, 0))
+        return self._recv_response()
+
+def main(argv):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.DEBUG if args.log == 'debug' else logging.INFO
+    )
+
+    models = PowerModels(args.model, args.workers, args.queue)
+    for i, (filename, signals, _, modules, _) in enumerate(models.models):
+        logging.info("Model %d: %s, %d signals, modules: %s",
+                     i, filename, len(signals), ','.join(modules))
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = PowerServer(args.socket, models)
+    logging.info("Listening on %s", args.socket)
+
+    def _report():
+        while True:
+            sleep(args.report)
+            stats = models.stats()
+            logging.info("[Server] batches: %d, windows/s: %.1f, latency: %.3f ms, "
+                         "queue depth: %d (max %d)",
+                         stats['batches'], stats['windows_per_sec'],
+                         stats['avg_latency_ms'], stats['queue_depth'],
+                         stats['max_queue_depth'])
+    threading.Thread(target=_report, daemon=True).start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
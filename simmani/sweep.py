@@ -0,0 +1,241 @@
+# See LICENSE for license details.
+
+"""
+Window sweep for signal selection
+
+Reads toggles and power once, then clusters signals and trains power
+models for every clustering window, and selects the model with the
+lowest BIC. Toggles are read at the finest window (the gcd of all
+windows) and aggregated for coarser windows.
+"""
+
+import os.path
+import sys
+import csv
+import shutil
+import argparse
+import logging
+import warnings
+from functools import reduce, partial
+from math import gcd
+from time import time
+import numpy as np
+from scipy.sparse import csr_matrix, hstack
+from scipy.stats.mstats import gmean
+from .utils import read_modules, sum_rows, count_dtype, normalize_toggles, set_precision, digest
+from .utils.traces import read_traces
+from .model.clustering import pca, load_projection, store_projection
+from .model.evaluator import model_bin_filename
+from .cluster import max_clusters, cluster_signals
+from .train import train_models, store_empty_model
+from .utils.resources import fork_pool, set_cpus, log_budget
+from .utils.profile import PROFILER, call_profiled
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Window Sweep for Signal Selection')
+    parser.add_argument("-t", "--toggle", dest="toggle", type=str,
+                        help='toggle file name at the finest window')
+    parser.add_argument("-v", "--vcd", dest="vcd", type=str,
+                        help='vcd file names', nargs='+')
+    parser.add_argument("-o", "--out", dest="out", type=str,
+                        help='power waveform from PrimeTime',
+                        nargs='+', required=True)
+    parser.add_argument("-d", "--dir", dest="dir", type=str,
+                        help='output directory', default=os.path.curdir)
+    parser.add_argument("-n", "--num", dest="K", type=int,
+                        help='min # of clusters', default=2)
+    parser.add_argument("--windows", dest="windows", type=int, nargs='+',
+                        help="clustering window sizes (in cycle)", default=[64, 128, 256])
+    parser.add_argument("-w", "--window", dest="window", type=int,
+                        help="regression window size (in cycle)", default=128)
+    parser.add_argument("--modules", dest="modules", type=str,
+                        help="module hierarchy")
+    parser.add_argument("--degree", dest="degree", type=int,
+                        help='degree of polynomial', default=2)
+    parser.add_argument("--max", dest="max", type=int,
+                        help="max number of signals")
+    parser.add_argument("--coreset", dest="coreset", type=int,
+                        help="# of representative windows for training (all windows by default)")
+    parser.add_argument("--no-cache", dest="no_cache",
+                        help="do not reuse or store PCA projections",
+                        action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int,
+                        help="# of windows processed in parallel", default=1)
+    parser.add_argument("--cpus", dest="cpus", type=int,
+                        help="# of cores for the run (SIMMANI_CPUS or all cores by default)")
+    parser.add_argument("--precision", dest="precision", type=str,
+                        help="floating-point type of toggles and power (float64 or float32)",
+                        default="float64")
+    parser.add_argument("--profile", dest="profile", type=str,
+                        help="profile report file (.json or .csv)")
+    parser.add_argument("--log", dest="log", type=str,
+                        help="log level", default="info")
+
+    args, _ = parser.parse_known_args(argv)
+    assert args.vcd or args.toggle
+    assert args.log in ['info', 'debug']
+    os.makedirs(args.dir, exist_ok=True)
+    return args
+
+def coarsen(toggles, counts, finest, window, widths):
+    """
+    Toggle rates in windows from raw toggle counts at the finest window
+    Inputs:
+      - toggles: raw toggle counts, signals x windows (CSR) of all traces
+      - counts: # of windows of each trace
+    """
+    dtype = count_dtype(window * int(np.max(widths)))
+    blocks = list()
+    offset = 0
+    for count in counts:
+        # windows are aggregated within each trace
+        blocks.append(sum_rows(toggles[:, offset:offset+count], window // finest, dtype))
+        offset += count
+    return normalize_toggles(csr_matrix(hstack(blocks)), window, widths)
+
+def model_score(scores):
+    """
+    Score of a model for selection from (R^2, BIC) of its modules
+    """
+    if len(scores) > 1:
+        return gmean([r2 for r2, _ in scores[1:]]), sum(bic for _, bic in scores[1:])
+    return scores[0]
+
+# Shared by all windows (and forked workers)
+SWEEP = None
+
+def sweep_window(window):
+    """
+    Cluster signals and train models for a clustering window
+    Outputs:
+      - window, # of selected signals, R^2, BIC (None if not trained)
+    """
+    args, bus_signals, widths, toggles, counts, finest, modules, powers, hierarchy, cycles, key = SWEEP
+    dirname = os.path.join(args.dir, 'window-%d' % window)
+    os.makedirs(dirname, exist_ok=True)
+    handler = logging.FileHandler(os.path.join(dirname, 'sweep.out'), 'w')
+    logging.getLogger().addHandler(handler)
+    try:
+        logging.info("[Window %d] Clustering", window)
+        start_time = time()
+        max_k = max_clusters(len(bus_signals), args.K)
+        # Reuse projections from previous sweeps (e.g. with other K bounds)
+        pca_filename = os.path.join(dirname, 'pca_%d.npz' % window)
+        pca_key = digest([], key, window)
+        cache = load_projection(pca_filename, pca_key) if not args.no_cache else None
+        A_max_k = None
+        if cache is not None and list(cache[0]) == list(bus_signals) and cache[1].shape[1] >= max_k:
+            # singular values are ascending, so the top max_k are the last ones
+            A_max_k = cache[1][:, -max_k:]
+        if A_max_k is None:
+            A_max_k, s = pca(coarsen(toggles, counts, finest, window, widths), max_k)
+            if not args.no_cache:
+                store_projection(pca_filename, pca_key, bus_signals, A_max_k, s)
+        end_time = time()
+        logging.info("Dimension reduction time: %.2f s", end_time - start_time)
+        signals = cluster_signals(dirname, window, bus_signals, A_max_k, args.K, max_k)
+
+        if args.max and args.max < len(signals):
+            logging.info("# signal: %d > max: %d", len(signals), args.max)
+            store_empty_model(dirname)
+            open(os.path.join(dirname, "model-stats.csv"), 'w').close()
+            return window, len(signals), None, None
+
+        logging.info("[Window %d] Training", window)
+        selected = np.isin(bus_signals, signals)
+        A = coarsen(toggles[selected], counts, finest, args.window, widths[selected]).A.T
+        _, scores = train_models(
+            dirname, args.window, bus_signals[selected], widths[selected], A,
+            modules, powers.copy(), hierarchy, args.degree, cycles, coreset=args.coreset)
+        r2, bic = model_score(scores)
+        return window, len(signals), r2, bic
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+def main(argv):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.DEBUG if args.log == 'debug' else logging.INFO
+    )
+
+    set_precision(args.precision)
+    set_cpus(args.cpus)
+    log_budget()
+    if args.profile:
+        PROFILER.enable()
+
+    finest = reduce(gcd, args.windows + [args.window])
+    logging.info("Windows: %s, regression window: %d, finest window: %d",
+                 ','.join(str(window) for window in args.windows), args.window, finest)
+
+    # Read toggles and power once, keeping raw toggle counts until coarsened
+    hierarchy = read_modules(args.modules)
+    (vcd_cycle_list, reset_cycle_list, bus_signals, toggles, widths, modules, powers) = \
+        read_traces(args.toggle, args.vcd, args.out, finest, module_filter=hierarchy[0],
+                    power_window=args.window, normalize=False)
+    counts = [
+        int((cycles - reset_cycles - 1) / finest) + 1
+        for cycles, reset_cycles in zip(vcd_cycle_list, reset_cycle_list)
+    ]
+    assert sum(counts) == toggles.shape[1], "%d != %d" % (sum(counts), toggles.shape[1])
+    logging.info("Cycles: %d", sum(vcd_cycle_list))
+    logging.info("Reset Cycles: %d", sum(reset_cycle_list))
+    logging.info("# Signals: %d", len(bus_signals))
+
+    sys.stdout.flush()
+
+    # Projections are cached for the same traces (hashed once for all windows)
+    key = digest([args.toggle] if args.toggle else args.vcd) if not args.no_cache else None
+
+    global SWEEP
+    SWEEP = (args, bus_signals, np.array(widths), toggles, counts, finest,
+             modules, powers, hierarchy, sum(vcd_cycle_list) - sum(reset_cycle_list), key)
+
+    start_time = time()
+    if args.jobs > 1 and len(args.windows) > 1:
+        with fork_pool(min(args.jobs, len(args.windows)), "window sweep") as pool:
+            rows = PROFILER.gather(pool.map(
+                partial(call_profiled, sweep_window), args.windows, chunksize=1))
+    else:
+        rows = [sweep_window(window) for window in args.windows]
+    end_time = time()
+    logging.info("Total sweep time: %.2f s", end_time - start_time)
+
+    # Select the model with the lowest BIC
+    best = None
+    stat_filename = os.path.join(args.dir, 'model_stats.csv')
+    logging.info("Statistics file: %s", stat_filename)
+    with open(stat_filename, 'w') as _f:
+        writer = csv.writer(_f)
+        writer.writerow(['Window', '#Signals', 'R^2', 'BIC'])
+        for window, num, r2, bic in rows:
+            if bic is None:
+                continue
+            logging.info('Window: %d, #Signals: %d, R2: %f, BIC: %f', window, num, r2, bic)
+            writer.writerow((window, num, r2, bic))
+            if best is None or best[1] > bic:
+                best = (window, bic)
+
+    if best is not None:
+        window = best[0]
+        dirname = os.path.join(args.dir, 'window-%d' % window)
+        logging.info("Selected window: %d", window)
+        shutil.copy(os.path.join(dirname, 'signals_%d.csv' % window),
+                    os.path.join(args.dir, 'signals.csv'))
+        model_filename = os.path.join(dirname, 'model.csv')
+        shutil.copy(model_filename, os.path.join(args.dir, 'model.csv'))
+        shutil.copy(model_bin_filename(model_filename),
+                    model_bin_filename(os.path.join(args.dir, 'model.csv')))
+
+    if args.profile:
+        PROFILER.store(args.profile)
+
+if __name__ == "__main__":
+    np.seterr(divide='raise')
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        logging.captureWarnings(True)
+        main(sys.argv[1:])
@@ -1,5 +1,3 @@
-#!/usr/bin/env python3
-
 # See LICENSE for license details.
 
 import os.path
@@ -7,110 +5,191 @@ import sys
 import csv
 import argparse
 import logging
+from functools import partial
 from time import time
 import numpy as np
-from utils import read_modules, translate_indices
-from utils.toggle import read_toggles
-from utils.power import read_power_files
-from utils.data import plot_power, dump_power_bars, plot_data, store_data
-from model.regression import get_terms
+from .utils import read_modules, translate_indices, set_precision
+from .utils.toggle import read_toggles_csv, read_toggles_bin
+from .utils.vcd import VCDReader
+from .utils.stream import VCDStream, stream_windows
+from .utils.power import split_powers
+from .utils.traces import read_traces
+from .utils.data import plot_power, dump_power_bars, plot_data, store_power_bars, \
+                       store_trace, TraceWriter
+from .model.regression import get_terms
+from .model.evaluator import load_model, Evaluator
+from .utils.resources import fork_pool, set_cpus, log_budget
+from .utils.profile import PROFILER, call_profiled
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description='Power Model Test')
     parser.add_argument("-t", "--toggle", dest="toggle", type=str,
-                        help='toggle file name')
+                        help='toggle file names', nargs='+')
     parser.add_argument("-v", "--vcd", dest="vcd", type=str,
-                        help='vcd file name')
+                        help='vcd file names', nargs='+')
     parser.add_argument("-o", "--out", dest="out", type=str,
-                        help='power out file name', required=True)
+                        help='power out file names', nargs='+')
     parser.add_argument("-m", "--model", dest="model", type=str,
                         help='power model file name', required=True)
     parser.add_argument("-d", "--dir", dest="dir", type=str,
                         help='output directory', default=os.path.curdir)
     parser.add_argument("-w", "--window", dest="window", type=int,
                         help="windows size (in cycle)", default=128)
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int,
+                        help="# of benchmarks tested in parallel", default=1)
     parser.add_argument("--modules", dest="modules", type=str,
                         help="module hierarchy")
     parser.add_argument("--plot-data", dest="plot_data",
                         help="plot data graphs?",
                         action="store_true", default=False)
+    parser.add_argument("--infer", dest="infer",
+                        help="only predict power while reading toggles",
+                        action="store_true", default=False)
+    parser.add_argument("--chunk", dest="chunk", type=int,
+                        help="# of windows evaluated at once for --infer",
+                        default=4096)
+    parser.add_argument("--stream", dest="stream",
+                        help="read VCDs from running simulations (named pipes or files being written) "
+                             "for --infer",
+                        action="store_true", default=False)
+    parser.add_argument("--idle", dest="idle", type=float,
+                        help="seconds without data before a VCD file being written ends for --stream",
+                        default=10.0)
+    parser.add_argument("--csv", dest="csv",
+                        help="dump traces as csv instead of npz",
+                        action="store_true", default=False)
+    parser.add_argument("--plot-update", dest="plot_update",
+                        help="only redraw data graphs whose data changed",
+                        action="store_true", default=False)
+    parser.add_argument("--cpus", dest="cpus", type=int,
+                        help="# of cores for the run (SIMMANI_CPUS or all cores by default)")
+    parser.add_argument("--precision", dest="precision", type=str,
+                        help="floating-point type of toggles and power (float64 or float32)",
+                        default="float64")
+    parser.add_argument("--profile", dest="profile", type=str,
+                        help="profile report file (.json or .csv)")
+    parser.add_argument("--cycles", dest="cycles", type=int, nargs=2, metavar=("BEGIN", "END"),
+                        help="only read cycles [BEGIN, END) after reset from vcd and power files (END 0 for all)")
 
     args, _ = parser.parse_known_args(argv)
+    args.ext = "csv" if args.csv else "npz"
+    assert not args.cycles or args.vcd, "cycle ranges are read only from vcd files"
+    args.cycles = (args.cycles[0], args.cycles[1] or None) if args.cycles else None
     assert args.vcd or args.toggle
+    assert args.out or args.infer, "power out file is required"
+    assert not args.stream or (args.infer and args.vcd and not args.toggle and not args.cycles), \
+        "--stream needs --infer and VCD files"
+    num = len(args.vcd if args.vcd else args.toggle)
+    assert not args.vcd or len(args.vcd) == num
+    assert not args.toggle or len(args.toggle) == num
+    assert not args.out or len(args.out) == num
     os.makedirs(args.dir, exist_ok=True)
-    benchmark = os.path.splitext(os.path.basename(
-        args.vcd if args.vcd else args.toggle))[0]
-    return args, benchmark
-
-def load_model(filename):
-    logging.info("Model file: %s", filename)
-    assert os.path.isfile(filename), "%s not found" % (filename)
-    terms = list()
-    models = list()
-    def _int(lst):
-        return [int(x) for x in lst]
-    def _float(lst):
-        return [float(x) for x in lst]
-    with open(filename, "r") as _f:
-        reader = csv.reader(_f)
-        for line in reader:
-            if line[0] == 'signals':
-                signals = line[1:]
-            elif line[0] == 'widths':
-                widths = _int(line[1:])
-            elif line[0] == 'modules':
-                modules = line[1:]
-            else:
-                assert len(line) == len(modules) + 1
-                if line[0] != 'const':
-                    term = [signals.index(s) for s in line[0].split('*')]
-                    terms.append(term)
-                models.append(_float(line[1:]))
-    models = np.array(models).T
-    assert len(signals) == len(widths)
-    assert models.shape == (len(modules), len(terms)+1)
-    return signals, widths, modules, terms, models
-
-MODULES = []
-Ys = []
-Y_hats = []
-SCORES = []
-
-def test_and_plot(module, A, X, y, benchmark, dirname, cycle, window):
-    y_hat = A.dot(X)
+    benchmarks = [
+        (os.path.splitext(os.path.basename(
+            args.vcd[i] if args.vcd else args.toggle[i]))[0],
+         args.vcd[i] if args.vcd else None,
+         args.toggle[i] if args.toggle else None,
+         args.out[i] if args.out else None)
+        for i in range(num)
+    ]
+    return args, benchmarks
+
+# Shared by all benchmarks (and forked workers)
+MODEL = None
+HIERARCHY = None
+
+def test_and_plot(module, y_hat, y, benchmark, dirname, cycle, window):
     sse = np.sum((y - y_hat) ** 2)
     rmse = np.sqrt(sse / len(y)) / y.mean()
     avge = abs(y_hat.mean() - y.mean()) / y.mean()
-    MODULES.append(module)
-    Ys.append(y)
-    Y_hats.append(y_hat)
-    SCORES.append((rmse, avge))
 
     plot_dirname = os.path.join(dirname, "power", module)
     os.makedirs(plot_dirname, exist_ok=True)
     png_filename = os.path.join(plot_dirname, "test-%s.png" % (benchmark))
     plot_power(png_filename, [y, y_hat], cycle, window)
+    return rmse, avge
 
-def main(argv):
-    args, benchmark = parse_args(argv)
+def _toggle_chunks(vcd, toggle, window, signals, chunk, cycles=None, stream=False, idle=10.0):
+    """
+    Yield normalized toggles (windows x signals) in chunks of windows
+    (as they arrive from a running simulation with stream)
+    """
+    if toggle:
+        # Toggle files are stored signal by signal, so read them at once
+        _window, _, _, bus_signals, toggles, _ = \
+            read_toggles_csv(toggle) if toggle.endswith(".csv") else \
+            read_toggles_bin(toggle)
+        assert window == _window
+        idxs = [list(bus_signals).index(signal) for signal in signals]
+        toggles = toggles[idxs].tocsc()
+        for start in range(0, toggles.shape[1], chunk):
+            yield toggles[:, start:start+chunk].T.toarray()
+    else:
+        reader = VCDStream(vcd, set(signals), window, idle=idle) if stream else \
+                 VCDReader(vcd, set(signals), window, cycles)
+        assert len(reader.signals) == len(signals), "%s != %s" % (
+            str(reader.signals), str(signals))
+        idxs = [reader.signals.index(signal) for signal in signals]
+        denoms = window * np.array(reader.widths)[idxs]
+        if stream:
+            for block in stream_windows(reader, chunk):
+                yield block[:, idxs] / denoms
+        else:
+            block = np.empty((chunk, len(signals)))
+            size = 0
+            for _, cur_toggles in reader.windows():
+                block[size] = cur_toggles[idxs]
+                size += 1
+                if size == chunk:
+                    yield block / denoms
+                    size = 0
+            if size > 0:
+                yield block[:size] / denoms
+        reader.close()
 
-    logging.basicConfig(
-        format="%(message)s",
-        level=logging.INFO
-    )
+def infer_power(args, benchmark, vcd, toggle):
+    """
+    Predict power window by window without reference power,
+    writing predictions as they are computed
+    """
+    signals, _, modules, terms, models = MODEL
+    evaluator = Evaluator(signals, terms, models)
+
+    start_time = time()
+    writer = TraceWriter(os.path.join(
+        args.dir, "infer-power-%s.%s" % (benchmark, args.ext)), modules, args.window)
+    windows = 0
+    total = np.zeros(len(modules))
+    for A0 in _toggle_chunks(vcd, toggle, args.window, signals, args.chunk, args.cycles,
+                              args.stream, args.idle):
+        y_hats = evaluator.predict(A0)
+        writer.append(y_hats)
+        windows += y_hats.shape[0]
+        total += y_hats.sum(axis=0)
+    writer.close()
+    end_time = time()
+    logging.info("Inference time: %.2f s (%d windows)", end_time - start_time, windows)
 
-    signals, _, _modules, _terms, models = load_model(args.model)
-    module_filter, misc_module, children, labels = read_modules(args.modules)
+    means = total / max(windows, 1)
+    for module, mean in zip(modules, means):
+        logging.info("[%s] y_hat = %.2f", module, mean)
+    store_power_bars(
+        os.path.join(args.dir, "power-bars-%s.csv" % benchmark),
+        modules, None, [np.array([mean]) for mean in means])
 
-    vcd_cycle_list, reset_cycle_list, bus_signals, toggles, widths = \
-        read_toggles(args.toggle, [args.vcd], args.window, set(signals))
+def test_benchmark(args, benchmark, vcd, toggle, out):
+    """
+    Test the shared model on one benchmark
+    """
+    signals, _, _modules, _terms, models = MODEL
+    module_filter, misc_module, children, labels = HIERARCHY
+
+    (vcd_cycle_list, reset_cycle_list, bus_signals, toggles, widths, modules, powers) = \
+        read_traces(toggle, [vcd], [out], args.window, set(signals), module_filter,
+                    cycles=args.cycles)
     assert len(bus_signals) == len(signals), "%s != %s" % (
         str(bus_signals), str(signals))
     terms = translate_indices(signals, bus_signals, _terms)
-    modules, powers = read_power_files(
-        [args.out], args.window, vcd_cycle_list, reset_cycle_list, module_filter)
-
-    toggles = toggles.A
 
     logging.info("Cycles: %d", sum(vcd_cycle_list))
     logging.info("Reset Cycles: %d", sum(reset_cycle_list))
@@ -123,79 +202,120 @@ def main(argv):
 
     # Dump toggles
     signal_idxs = translate_indices(signals, bus_signals, [(i,) for i in range(len(signals))])
-    np.savetxt(os.path.join(args.dir, 'test-toggle-%s.csv' % benchmark),
-               get_terms((toggles * (args.window * widths.reshape(-1, 1))).T, signal_idxs),
-               fmt="%d", delimiter=',', header=','.join(signals), comments='')
+    store_trace(os.path.join(args.dir, 'test-toggle-%s.%s' % (benchmark, args.ext)), signals,
+                get_terms((toggles.A * (args.window * widths.reshape(-1, 1))).T, signal_idxs),
+                args.window, fmt="%d")
 
-    # Contruct matrix
+    # Predict power for all modules at once
+    evaluator = Evaluator(signals, _terms, models).bind(bus_signals)
+    y_hats = evaluator.predict(toggles.T.tocsr()).T
     signals = bus_signals.tolist()
-    A0 = toggles.T
-    ones = np.ones((A0.shape[0], 1), dtype=A0.dtype)
-    A = np.append(ones, get_terms(A0, terms), axis=1)
-    ys = list(powers)
 
     # Power plots
-    test_and_plot(
-        modules[0], A, models[0], ys[0],
-        benchmark, args.dir, total_cycles, args.window)
-
-    if children:
-        label_ys = dict()
-        for module, y in zip(modules[1:], ys[1:]):
-            assert module in children
-            idxs = [modules.index(child) for child in children[module]]
-            label = labels[module]
-            if label not in label_ys:
-                label_ys[label] = 0.0
-            y -= np.array(ys)[idxs].sum(axis=0)
-            label_ys[label] += y
-
-        for module, model in zip(_modules[1:-1], models[1:-1]):
-            test_and_plot(
-                module, A, model, label_ys[module],
-                benchmark, args.dir, total_cycles, args.window)
-
-    if misc_module:
-        y = ys[0] - np.sum(ys[1:], axis=0)
-        test_and_plot(
-            misc_module, A, models[-1], y,
-            benchmark, args.dir, total_cycles, args.window)
+    test_modules, test_ys, test_y_hats, scores = list(), list(), list(), list()
+    def _test_and_plot(module, y_hat, y):
+        test_modules.append(module)
+        test_ys.append(y)
+        test_y_hats.append(y_hat)
+        scores.append(test_and_plot(
+            module, y_hat, y, benchmark, args.dir, total_cycles, args.window))
+
+    names, targets = split_powers(modules, powers, children, labels, misc_module)
+    for module, y_hat in zip(_modules, y_hats):
+        _test_and_plot(module, y_hat, targets[names.index(module)])
 
     png_filename = os.path.join(args.dir, "test-%s.png" % benchmark)
-    y = np.sum(Ys[1:], axis=0) if children else Ys[0]
-    y_hat = np.sum(Y_hats[1:], axis=0) if children else Y_hats[0]
+    y = np.sum(test_ys[1:], axis=0) if children else test_ys[0]
+    y_hat = np.sum(test_y_hats[1:], axis=0) if children else test_y_hats[0]
     plot_power(png_filename, [y, y_hat], total_cycles, args.window, benchmark)
-    dump_power_bars(args.dir, benchmark, MODULES, Ys, Y_hats)
+    dump_power_bars(args.dir, benchmark, test_modules, test_ys, test_y_hats)
 
     if args.plot_data:
         start_time = time()
         data_dirname = os.path.join(args.dir, "test-data-%s" % benchmark)
+        A0 = toggles.T.A
+        A = np.append(np.ones((A0.shape[0], 1), dtype=A0.dtype), get_terms(A0, terms), axis=1)
         filters = np.array([abs(X[1:]) > 0.0 for X in models])
-        plot_data(data_dirname, signals, terms, A.T, MODULES, Ys, filters)
+        plot_data(data_dirname, signals, terms, A.T, test_modules, test_ys, filters,
+                  args.jobs, args.plot_update)
         end_time = time()
         logging.info("Data plot time: %.2f s", end_time - start_time)
 
-    header = '\n'.join([
-        ','.join(['window', str(args.window)]),
-        ','.join(MODULES)
-    ])
-
     # Dump power traces
-    power_trace = os.path.join(args.dir, "test-power-%s.csv" % benchmark)
-    np.savetxt(power_trace, np.array(Ys).T, fmt='%f', delimiter=',', comments='', header=header)
-
-    predict_trace = os.path.join(args.dir, "test-predict-%s.csv" % benchmark)
-    np.savetxt(predict_trace, np.array(Y_hats).T, fmt='%f', delimiter=',', comments='', header=header)
+    store_trace(os.path.join(args.dir, "test-power-%s.%s" % (benchmark, args.ext)),
+                test_modules, np.array(test_ys).T, args.window)
+    store_trace(os.path.join(args.dir, "test-predict-%s.%s" % (benchmark, args.ext)),
+                test_modules, np.array(test_y_hats).T, args.window)
 
     stats_filename = os.path.join(args.dir, "test-stats-%s.csv" % benchmark)
     logging.info("Statistics file: %s", stats_filename)
     with open(stats_filename, 'w') as _f:
         writer = csv.writer(_f)
         writer.writerow(['module', 'NRMSE (%)', 'AVGE (%)'])
-        for module, y, y_hat, (rmse, avge) in zip(MODULES, Ys, Y_hats, SCORES):
+        for module, y, y_hat, (rmse, avge) in zip(test_modules, test_ys, test_y_hats, scores):
             writer.writerow([module, "%.2f" % (100 * rmse), "%.2f" % (100 * avge)])
             logging.info("[%s] y = %.2f, y_hat = %.2f, NRMSE = %f %%, AVGE %f %%",
                          module, y.mean(), y_hat.mean(), 100 * rmse, 100 * avge)
 
+    return test_modules, scores
+
+def _run(job):
+    args, benchmark, vcd, toggle, out = job
+    if args.infer:
+        return infer_power(args, benchmark, vcd, toggle)
+    return test_benchmark(args, benchmark, vcd, toggle, out)
+
+def store_summary(filename, benchmarks, results):
+    logging.info("Summary file: %s", filename)
+    modules = results[0][0]
+    with open(filename, 'w') as _f:
+        writer = csv.writer(_f)
+        writer.writerow(['benchmark', 'module', 'NRMSE (%)', 'AVGE (%)'])
+        for (benchmark, _, _, _), (_modules, scores) in zip(benchmarks, results):
+            assert _modules == modules
+            for module, (rmse, avge) in zip(modules, scores):
+                writer.writerow([benchmark, module, "%.2f" % (100 * rmse), "%.2f" % (100 * avge)])
+        scores = np.array([scores for _, scores in results])
+        for module, (rmse, avge) in zip(modules, scores.mean(axis=0)):
+            writer.writerow(['mean', module, "%.2f" % (100 * rmse), "%.2f" % (100 * avge)])
+            logging.info("[%s] mean NRMSE = %f %%, mean AVGE %f %%",
+                         module, 100 * rmse, 100 * avge)
+
+def main(argv):
+    args, benchmarks = parse_args(argv)
+
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.INFO
+    )
+
+    set_precision(args.precision)
+    set_cpus(args.cpus)
+    log_budget()
+    if args.profile:
+        PROFILER.enable()
+
+    # Load the model and the module hierarchy once for all benchmarks
+    global MODEL, HIERARCHY
+    MODEL = load_model(args.model)
+    HIERARCHY = read_modules(args.modules)
+
+    jobs = [(args,) + benchmark for benchmark in benchmarks]
+    start_time = time()
+    if args.jobs > 1 and len(jobs) > 1:
+        with fork_pool(min(args.jobs, len(jobs)), "benchmark test") as pool:
+            results = PROFILER.gather(pool.map(
+                partial(call_profiled, _run), jobs, chunksize=1))
+    else:
+        results = [_run(job) for job in jobs]
+    end_time = time()
+    logging.info("Total test time: %.2f s (%d benchmarks)", end_time - start_time, len(jobs))
+
+    if not args.infer:
+        store_summary(os.path.join(args.dir, "test-stats.csv"), benchmarks, results)
+
+    if args.profile:
+        PROFILER.store(args.profile)
+
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -1,5 +1,3 @@
-#!/usr/bin/env python3
-
 # See LICENSE for license details.
 
 import os.path
@@ -10,24 +8,29 @@ import logging
 import warnings
 from time import time
 import numpy as np
-from utils import read_modules
-from utils.toggle import read_toggles
-from utils.power import read_power_files
-from utils.data import plot_power, dump_power_bars, plot_data, store_data
-from model.regression import polynomial_regression, get_terms
+from .utils import read_modules, set_precision
+from .utils.power import split_powers
+from .utils.traces import read_traces
+from .utils.data import plot_power, dump_power_bars, plot_data, store_data
+from .model.regression import polynomial_regression, polynomial_terms, predict, get_terms
+from .model.coreset import select_windows
+from .model.shards import regression_stats, store_shard, load_shard, merge_shards, \
+    fit_shards, refit_shards, model_state_filename
+from .model.evaluator import store_model_bin, model_bin_filename
+from .utils.resources import set_cpus, log_budget
+from .utils.profile import PROFILER, profiled
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description='Power Model Training')
     parser.add_argument("-s", "--signals", dest="signals", type=str,
-                        help='cache file from signal clustering',
-                        required=True)
+                        help='cache file from signal clustering')
     parser.add_argument("-t", "--toggle", dest="toggle", type=str,
                         help='toggle file name')
     parser.add_argument("-v", "--vcd", dest="vcd", type=str,
                         help='vcd file name', nargs='+')
     parser.add_argument("-o", "--out", dest="out", type=str,
                         help='power waveform from PrimeTime',
-                        nargs='+', required=True)
+                        nargs='+')
     #parser.add_argument("-r", "--rpt", dest="rpt", type=str,
     #                    help='power report from PrimeTime', nargs='+')
     parser.add_argument("-d", "--dir", dest="dir", type=str,
@@ -43,26 +46,61 @@ def parse_args(argv):
     parser.add_argument("--plot-data", dest="plot_data",
                         help="plot data graphs?",
                         action="store_true", default=False)
+    parser.add_argument("--cpus", dest="cpus", type=int,
+                        help="# of cores for the run (SIMMANI_CPUS or all cores by default)")
+    parser.add_argument("--precision", dest="precision", type=str,
+                        help="floating-point type of toggles and power (float64 or float32)",
+                        default="float64")
+    parser.add_argument("--profile", dest="profile", type=str,
+                        help="profile report file (.json or .csv)")
     parser.add_argument("--max", dest="max", type=int,
                         help="max number of signals")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int,
+                        help="# of processes plotting data graphs", default=1)
+    parser.add_argument("--plot-update", dest="plot_update",
+                        help="only redraw data graphs whose data changed",
+                        action="store_true", default=False)
+    parser.add_argument("--coreset", dest="coreset", type=int,
+                        help="# of representative windows for training (all windows by default)")
+    parser.add_argument("--coreset-check", dest="coreset_check",
+                        help="also train on all windows to report errors of the coreset",
+                        action="store_true", default=False)
+    parser.add_argument("--shard", dest="shard", type=str,
+                        help="only store regression statistics of the traces (.npz)")
+    parser.add_argument("--shards", dest="shards", type=str, nargs='+',
+                        help="train from regression statistics instead of traces")
+    parser.add_argument("--save-state", dest="save_state",
+                        help="store the training state (model-state.npz) for --update",
+                        action="store_true", default=False)
+    parser.add_argument("--update", dest="update", type=str,
+                        help="update a model (with its model-state.npz) with the traces")
+    parser.add_argument("--cycles", dest="cycles", type=int, nargs=2, metavar=("BEGIN", "END"),
+                        help="only read cycles [BEGIN, END) after reset from vcd and power files (END 0 for all)")
 
     args, _ = parser.parse_known_args(argv)
-    assert args.vcd or args.toggle
+    assert args.shards or ((args.vcd or args.toggle) and args.out)
     assert args.log in ['info', 'debug']
-    assert os.path.isfile(args.signals)
+    assert not args.cycles or args.vcd, "cycle ranges are read only from vcd files"
+    args.cycles = (args.cycles[0], args.cycles[1] or None) if args.cycles else None
+    assert args.shards or args.update or os.path.isfile(args.signals)
     os.makedirs(args.dir, exist_ok=True)
     return args
 
-Ys = list()
-Y_hats = list()
-MODULES = list()
-MODELS = list()
-SCORES = list()
-TERMS = None
-
-def train_and_plot(module, A, y, degree, dirname, cycles, window, positive=True):
+def train_and_plot(module, A, y, degree, dirname, cycles, window, positive=True, coreset=None):
+    """
+    Train the power model of a module
+    (only on the weighted windows of coreset from `select_windows` if given)
+    Outputs:
+      - model, terms, y_hat, (R^2, BIC), (alpha, l1_ratio)
+    """
     start_time = time()
-    model, terms, df, y_hat = polynomial_regression(A, y, degree, positive)
+    if coreset is None:
+        model, terms, df, y_hat, params = polynomial_regression(A, y, degree, positive)
+    else:
+        idxs, weights = coreset
+        model, terms, df, _, params = polynomial_regression(
+            A[idxs], y[idxs], degree, positive, weights=weights)
+        y_hat = predict(A, terms, model)
     end_time = time()
     logging.info("Training time for %s: %.2fs", module, end_time - start_time)
     sys.stdout.flush()
@@ -73,22 +111,16 @@ def train_and_plot(module, A, y, degree, dirname, cycles, window, positive=True)
     r2 = 1.0 - (sse / np.sum((y - y.mean()) ** 2))
     bic = (sse / sigma2) + np.log(n) * df
 
-    Ys.append(y)
-    Y_hats.append(y_hat)
-    MODULES.append(module)
-    MODELS.append(model)
-    SCORES.append((r2, bic))
-    global TERMS
-    if TERMS is None:
-        TERMS = terms
-
     # Plot
     png_filename = os.path.join(dirname, "train-%s.png" % module)
     plot_power(png_filename, [y, y_hat], cycles, window)
 
-def store_model(filename, signals, widths, modules):
+    return model, terms, y_hat, (r2, bic), params
+
+@profiled("model write")
+def store_model(filename, signals, widths, modules, terms, models):
     logging.info("Model file: %s", filename)
-    models = np.array(MODELS)
+    models = np.array(models)
     with open(filename, "w") as _f:
         writer = csv.writer(_f)
         writer.writerow(['signals'] + signals)
@@ -97,132 +129,335 @@ def store_model(filename, signals, widths, modules):
 
         labels = ['const'] + [
             '*'.join([signals[i] for i in list(term)])
-            for term in TERMS
+            for term in terms
         ]
         assert len(labels) == models.shape[1], "%d != %d" % (len(labels), models.shape[1])
         for label, model in zip(labels, models.T):
             if np.count_nonzero(model) > 0:
                 writer.writerow([label] + model.tolist())
 
-def main(argv):
-    args = parse_args(argv)
-
-    logging.basicConfig(
-        format="%(message)s",
-        level=logging.DEBUG if args.log == 'debug' else logging.INFO
-    )
-
-    # Read signals
-    logging.info("Load signals from %s", args.signals)
-    with open(args.signals, 'r') as _f:
-        _signals = _f.read().splitlines()
-    logging.debug("Signals: %s", ','.join(_signals))
-
-    if args.max and args.max < len(_signals):
-        logging.info("# signal: %d > max: %d", len(_signals), args.max)
-        open(os.path.join(args.dir, "model.csv"), 'w').close()
-        return
-
-    # Read toggle
-    vcd_cycle_list, reset_cycle_list, signals, toggles, widths = \
-        read_toggles(args.toggle, args.vcd, args.window, set(_signals))
-    assert len(signals) == len(_signals), "%s != %s" % (
-        str(signals), str(_signals))
-    A = toggles.A.T
-    logging.info("Cycles: %d", sum(vcd_cycle_list))
-    logging.info("Reset Cycles: %d", sum(reset_cycle_list))
-    logging.info("# Selected Signals: %d", len(signals))
-    for signal, width in zip(signals, widths):
-        logging.info("- %s [%d]", signal, width)
-
-    # Read module hierarchy
-    module_filter, misc_module, children, labels = read_modules(args.modules)
-
-    # Read power waveforms
-    modules, powers = read_power_files(
-        args.out, args.window, vcd_cycle_list, reset_cycle_list, module_filter)
-
+    # Binary model for fast loading, with the same nonzero terms
+    nonzero = np.count_nonzero(models[:, 1:], axis=0) > 0
+    store_model_bin(
+        model_bin_filename(filename), signals, widths, modules,
+        [term for term, f in zip(terms, nonzero) if f],
+        np.append(models[:, :1], models[:, 1:][:, nonzero], axis=1))
+
+def check_coreset(filename, names, A, ys, y_hats, degree, positives):
+    """
+    Report errors of models trained on a coreset against models
+    trained on all windows
+    """
+    logging.info("Coreset statistics file: %s", filename)
+    with open(filename, 'w') as _f:
+        writer = csv.writer(_f)
+        writer.writerow(['module', 'R^2 (coreset)', 'R^2 (full)', 'NRMSE to full (%)', 'time (full)'])
+        for module, y, y_hat, positive in zip(names, ys, y_hats, positives):
+            start_time = time()
+            _, _, _, y_full, _ = polynomial_regression(A, y, degree, positive)
+            end_time = time()
+            sst = np.sum((y - y.mean()) ** 2)
+            r2 = 1.0 - np.sum((y - y_hat) ** 2) / sst
+            r2_full = 1.0 - np.sum((y - y_full) ** 2) / sst
+            nrmse = np.sqrt(np.mean((y_hat - y_full) ** 2)) / max(abs(y.mean()), 1e-30)
+            writer.writerow([module, "%f" % r2, "%f" % r2_full, "%.2f" % (100 * nrmse),
+                             "%.2f" % (end_time - start_time)])
+            logging.info("[%s] coreset R^2 = %f, full R^2 = %f, NRMSE to full = %f %%, "
+                         "full training time: %.2f s",
+                         module, r2, r2_full, 100 * nrmse, end_time - start_time)
+
+def store_empty_model(dirname):
+    """
+    Placeholders for models not trained (e.g. too many signals)
+    """
+    open(os.path.join(dirname, "model.csv"), 'w').close()
+    open(os.path.join(dirname, "model.bin"), 'w').close()
+
+def train_models(dirname, window, signals, widths, A, modules, powers, hierarchy,
+                 degree=2, total_cycles=None, plot_args=None, coreset=None, coreset_check=False,
+                 store_state=False):
+    """
+    Train the power models of all modules and store them in dirname
+    Inputs:
+      - signals, widths: selected signals
+      - A: windows x signals toggles
+      - modules, powers: power traces from `read_power_files`
+      - hierarchy: module hierarchy from `read_modules`
+      - plot_args: (jobs, update) to plot data graphs
+      - coreset: # of representative windows to train on (all windows if None)
+      - coreset_check: compare with models trained on all windows
+      - store_state: store the training state for `update_models`
+    Outputs:
+      - trained modules, (R^2, BIC) for each module
+    """
+    _, misc_module, children, labels = hierarchy
     if labels is None:
         labels = dict()
         for module in modules:
             labels[module] = module
-    logging.info("Regression Window: %d", args.window)
+    logging.info("Regression Window: %d", window)
 
     logging.info("Modules:")
     for module, power in zip(modules, powers):
         logging.info("- %s (%s): %.3f mW", module, labels[module], power.mean())
 
-    ys = list(powers)
-    total_cycles = sum(vcd_cycle_list) - sum(reset_cycle_list)
-    total_cycles = args.window * (
-        int((total_cycles  - 1) / args.window) + 1) # For plots
+    total_cycles = window * (
+        int((total_cycles  - 1) / window) + 1) # For plots
 
     # Train power models
     start_time = time()
-    train_and_plot(
-        modules[0], A, ys[0], args.degree,
-        args.dir, total_cycles, args.window)
-
-    if children:
-        label_ys = dict()
-        for module, y in zip(modules[1:], ys[1:]):
-            assert module in children
-            idxs = [modules.index(child) for child in children[module]]
-            label = labels[module]
-            if label not in label_ys:
-                label_ys[label] = 0.0
-            y -= np.array(ys)[idxs].sum(axis=0)
-            label_ys[label] += y
-
-        for module in label_ys:
-            train_and_plot(
-                module, A, label_ys[module], args.degree,
-                args.dir, total_cycles, args.window)
-
-    if misc_module:
-        y = ys[0] - np.sum(ys[1:], axis=0)
-        train_and_plot(
-            misc_module, A, y, args.degree,
-            args.dir, total_cycles, args.window, False)
+    names, targets = split_powers(modules, powers, children, labels, misc_module)
+    positives = [not misc_module or i < len(names) - 1 for i in range(len(names))]
+    # Windows are stratified by the total power
+    windows = select_windows(A, targets[0], coreset) \
+        if coreset and coreset < A.shape[0] else None
+    ys, y_hats, models, scores, params, terms = list(), list(), list(), list(), list(), None
+    for module, y, positive in zip(names, targets, positives):
+        model, terms, y_hat, score, _params = train_and_plot(
+            module, A, y, degree, dirname, total_cycles, window, positive, windows)
+        ys.append(y)
+        y_hats.append(y_hat)
+        models.append(model)
+        scores.append(score)
+        params.append(_params)
 
     end_time = time()
     logging.info("Total training time: %.2f s", end_time - start_time)
     sys.stdout.flush()
 
-    png_filename = os.path.join(args.dir, "train.png")
+    if windows is not None and coreset_check:
+        check_coreset(os.path.join(dirname, "coreset-stats.csv"),
+                      names, A, ys, y_hats, degree, positives)
+
+    png_filename = os.path.join(dirname, "train.png")
     plot_power(png_filename, [
-        np.sum(Ys[1:], axis=0) if children else Ys[0],
-        np.sum(Y_hats[1:], axis=0) if children else Y_hats[0]
-    ], total_cycles, args.window, "Train")
+        np.sum(ys[1:], axis=0) if children else ys[0],
+        np.sum(y_hats[1:], axis=0) if children else y_hats[0]
+    ], total_cycles, window, "Train")
 
-    dump_power_bars(args.dir, 'train', MODULES, Ys, Y_hats)
+    dump_power_bars(dirname, 'train', names, ys, y_hats)
 
-    if args.plot_data:
+    if plot_args is not None:
         start_time = time()
-        data_dirname = os.path.join(args.dir, "train-data")
-        A_ = get_terms(A, TERMS).T
-        filters = np.array([abs(X[1:]) > 0.0 for X in MODELS])
-        plot_data(data_dirname, signals, TERMS, A_, MODULES, Ys, filters)
+        data_dirname = os.path.join(dirname, "train-data")
+        A_ = get_terms(A, terms).T
+        filters = np.array([abs(X[1:]) > 0.0 for X in models])
+        plot_data(data_dirname, signals, terms, A_, names, ys, filters, *plot_args)
         end_time = time()
         logging.info("Data plot time: %.2f s", end_time - start_time)
 
-    # data_filename = os.path.join(args.dir, "train-data.csv")
+    # data_filename = os.path.join(dirname, "train-data.csv")
     # idxs = [[x] for x in range(len(signals))]
-    # store_data(data_filename, signals, idxs, MODULES, A, Ys, Y_hats)
+    # store_data(data_filename, signals, idxs, names, A, ys, y_hats)
 
-    model_filename = os.path.join(args.dir, "model.csv")
-    store_model(model_filename, signals.tolist(), widths.tolist(), MODULES)
+    model_filename = os.path.join(dirname, "model.csv")
+    store_model(model_filename, list(signals), list(widths), names, terms, models)
 
-    stats_filename = os.path.join(args.dir, "model-stats.csv")
+    stats_filename = os.path.join(dirname, "model-stats.csv")
     logging.info("Statistics file: %s", stats_filename)
     with open(stats_filename, 'w') as _f:
         writer = csv.writer(_f)
         writer.writerow(['module', 'R^2', 'BIC'])
-        for module, y, y_hat, (r2, bic) in zip(MODULES, Ys, Y_hats, SCORES):
+        for module, y, y_hat, (r2, bic) in zip(names, ys, y_hats, scores):
             writer.writerow([module, "%f" % r2, "%f" % bic])
             logging.info("[%s] y = %.2f, y_hat = %.2f, std = %.2f, R^2 = %f, BIC = %f",
                          module, np.mean(y), np.mean(y_hat), np.std(y), r2, bic)
 
+    if store_state:
+        store_shard(model_state_filename(model_filename), 'model', list(signals), list(widths),
+                    window, names, bool(misc_module), terms,
+                    regression_stats(A, targets, terms), models, params)
+
+    return names, scores
+
+def store_stats(filename, name, window, signals, widths, A, modules, powers, hierarchy, degree=2):
+    """
+    Store regression statistics of traces as a shard for `train_shards`
+    """
+    _, misc_module, children, labels = hierarchy
+    if labels is None:
+        labels = dict((module, module) for module in modules)
+    names, targets = split_powers(modules, powers, children, labels, misc_module)
+    terms = polynomial_terms(len(signals), degree)
+    start_time = time()
+    stats = regression_stats(A, targets, terms)
+    end_time = time()
+    logging.info("Statistics time: %.2f s (%d windows, %d terms)",
+                 end_time - start_time, A.shape[0], len(terms))
+    store_shard(filename, name, list(signals), list(widths), window, names,
+                bool(misc_module), terms, stats)
+
+def store_models(dirname, state, models, scores, params):
+    """
+    Store models trained from statistics with their statistics and
+    the training state (merged statistics) for `update_models`
+    """
+    names = state['modules']
+    store_model(os.path.join(dirname, "model.csv"), state['signals'], state['widths'],
+                names, state['terms'], models)
+
+    stats_filename = os.path.join(dirname, "model-stats.csv")
+    logging.info("Statistics file: %s", stats_filename)
+    with open(stats_filename, 'w') as _f:
+        writer = csv.writer(_f)
+        writer.writerow(['module', 'R^2', 'BIC'])
+        for module, (r2, bic) in zip(names, scores):
+            writer.writerow([module, "%f" % r2, "%f" % bic])
+            logging.info("[%s] R^2 = %f, BIC = %f", module, r2, bic)
+
+    store_shard(model_state_filename(os.path.join(dirname, "model.csv")), state['name'],
+                state['signals'], state['widths'], state['window'], names, state['misc'],
+                state['terms'], (state['gram'], state['xy'], state['y_sq']), models, params)
+
+def train_shards(dirname, filenames):
+    """
+    Train the power models of all modules from shards of regression
+    statistics (e.g. one per benchmark) without reading traces
+    Outputs:
+      - trained modules, (R^2, BIC) for each module
+    """
+    shards = [load_shard(filename) for filename in filenames]
+    shard = shards[0]
+    for _shard in shards[1:]:
+        for key in ['signals', 'widths', 'window', 'modules', 'misc', 'terms']:
+            assert _shard[key] == shard[key], "%s mismatch: %s, %s" % (
+                key, shard['name'], _shard['name'])
+    names = shard['modules']
+    logging.info("Regression Window: %d", shard['window'])
+    logging.info("Shards: %s", ','.join(_shard['name'] for _shard in shards))
+
+    start_time = time()
+    models, scores, params, nrmses = list(), list(), list(), list()
+    for i, module in enumerate(names):
+        model, _, score, _params, _nrmses = fit_shards(
+            shards, i, not shard['misc'] or i < len(names) - 1)
+        models.append(model)
+        scores.append(score)
+        params.append(_params)
+        nrmses.append(_nrmses)
+    end_time = time()
+    logging.info("Total training time: %.2f s", end_time - start_time)
+
+    store_models(dirname, merge_shards(shards, 'model'), models, scores, params)
+
+    if len(shards) > 1:
+        # Errors of each shard held out in leave-one-shard-out CV
+        stats_filename = os.path.join(dirname, "shard-stats.csv")
+        logging.info("Shard statistics file: %s", stats_filename)
+        with open(stats_filename, 'w') as _f:
+            writer = csv.writer(_f)
+            writer.writerow(['benchmark', 'module', 'NRMSE (held out)'])
+            for module, _nrmses in zip(names, nrmses):
+                for _shard, nrmse in zip(shards, _nrmses):
+                    writer.writerow([_shard['name'], module, "%.2f" % (100 * nrmse)])
+                    logging.info("[%s] %s held out: NRMSE = %f %%",
+                                 module, _shard['name'], 100 * nrmse)
+
+    return names, scores
+
+def update_models(dirname, state, window, signals, A, modules, powers, hierarchy):
+    """
+    Update the models of a training state with new traces. Statistics of
+    the new traces are merged into the state, and the models are refit
+    with their alpha and l1_ratio, warm-started from their coefficients.
+    Outputs:
+      - trained modules, (R^2, BIC) for each module
+    """
+    assert window == state['window'], "window: %d != %d" % (window, state['window'])
+    assert list(signals) == state['signals']
+    _, misc_module, children, labels = hierarchy
+    if labels is None:
+        labels = dict((module, module) for module in modules)
+    names, targets = split_powers(modules, powers, children, labels, misc_module)
+    assert names == state['modules'], "%s != %s" % (str(names), str(state['modules']))
+
+    start_time = time()
+    gram, xy, y_sq = regression_stats(A, targets, state['terms'])
+    state = merge_shards([state, dict(gram=gram, xy=xy, y_sq=y_sq)], state['name'])
+    logging.info("Windows: %d new, %d total", A.shape[0], int(state['gram'][0, 0]))
+    models, scores = list(), list()
+    for i, (model, params) in enumerate(zip(state['models'], state['params'])):
+        model, _, score = refit_shards(
+            [state], i, model, params, not state['misc'] or i < len(names) - 1)
+        models.append(model)
+        scores.append(score)
+    end_time = time()
+    logging.info("Total update time: %.2f s", end_time - start_time)
+
+    store_models(dirname, state, models, scores, state['params'])
+    return names, scores
+
+def main(argv):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.DEBUG if args.log == 'debug' else logging.INFO
+    )
+
+    set_precision(args.precision)
+    set_cpus(args.cpus)
+    log_budget()
+    if args.profile:
+        PROFILER.enable()
+
+    if args.shards:
+        train_shards(args.dir, args.shards)
+        if args.profile:
+            PROFILER.store(args.profile)
+        return
+
+    # Read signals
+    if args.update:
+        state = load_shard(model_state_filename(args.update))
+        _signals = state['signals']
+        args.window = state['window']
+    else:
+        logging.info("Load signals from %s", args.signals)
+        with open(args.signals, 'r') as _f:
+            _signals = _f.read().splitlines()
+    logging.debug("Signals: %s", ','.join(_signals))
+
+    if args.max and args.max < len(_signals):
+        logging.info("# signal: %d > max: %d", len(_signals), args.max)
+        store_empty_model(args.dir)
+        if args.profile:
+            PROFILER.store(args.profile)
+        return
+
+    # Read module hierarchy
+    hierarchy = read_modules(args.modules)
+
+    # Read toggles and power waveforms
+    (vcd_cycle_list, reset_cycle_list, signals, toggles, widths, modules, powers) = \
+        read_traces(args.toggle, args.vcd, args.out, args.window, set(_signals), hierarchy[0],
+                    cycles=args.cycles)
+    assert len(signals) == len(_signals), "%s != %s" % (
+        str(signals), str(_signals))
+    A = toggles.A.T
+    logging.info("Cycles: %d", sum(vcd_cycle_list))
+    logging.info("Reset Cycles: %d", sum(reset_cycle_list))
+    logging.info("# Selected Signals: %d", len(signals))
+    for signal, width in zip(signals, widths):
+        logging.info("- %s [%d]", signal, width)
+
+    if args.update:
+        update_models(args.dir, state, args.window, signals, A, modules, powers, hierarchy)
+    elif args.shard:
+        name = os.path.splitext(os.path.basename(
+            args.vcd[0] if args.vcd else args.toggle))[0]
+        store_stats(args.shard, name, args.window, signals, widths, A,
+                    modules, powers, hierarchy, args.degree)
+    else:
+        train_models(
+            args.dir, args.window, signals, widths, A, modules, powers, hierarchy,
+            args.degree, sum(vcd_cycle_list) - sum(reset_cycle_list),
+            (args.jobs, args.plot_update) if args.plot_data else None,
+            args.coreset, args.coreset_check, args.save_state)
+
+    if args.profile:
+        PROFILER.store(args.profile)
+
 if __name__ == "__main__":
     np.seterr(divide='raise')
     with warnings.catch_warnings():
@@ -1,7 +1,9 @@
 import os.path
 import csv
+import hashlib
 import numpy as np
 from scipy.sparse import csr_matrix, isspmatrix_csr, issparse
+from .profile import profiled
 
 def _average_rows_dense(A, window):
     """
@@ -62,6 +64,7 @@ def _average_rows_csr(A, window):
     shape = (m, int((n - 1) / window) + 1)
     return csr_matrix((values, indices, indptr), shape=shape)
 
+@profiled("averaging")
 def average_rows(A, window):
     if window == 1:
         return A
@@ -70,26 +73,80 @@ def average_rows(A, window):
     assert not issparse(A)
     return _average_rows_dense(A, window)
 
+def sum_rows(A, window, dtype=None):
+    """
+    Sum intervals of each row of a CSR matrix (e.g. raw toggle counts)
+    Inputs:
+      - A: m x n CSR matrix
+      - window: window size
+      - dtype: type of sums (A.dtype by default), wide enough not to overflow
+    Outputs:
+      - m x (n / window) CSR matrix
+    """
+    if window == 1 and dtype is None:
+        return A
+    m, n = A.shape
+    B = csr_matrix((A.data.astype(dtype or A.dtype), A.indices // window, A.indptr.copy()),
+                   shape=(m, int((n - 1) / window) + 1))
+    B.sum_duplicates()
+    return B
+
+# Numeric representation:
+# - raw toggle counts: the smallest unsigned integers (count_dtype)
+# - sparse indices: int32 unless shapes require int64 (index_dtype)
+# - normalized toggles, power traces, and features: float_dtype()
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+
+def set_precision(precision):
+    """
+    Set the floating-point type of toggles, power traces, and features
+    """
+    assert precision in PRECISIONS, "unknown precision: %s" % precision
+    set_precision.dtype = PRECISIONS[precision]
+
+set_precision.dtype = np.float64
+
+def float_dtype():
+    return set_precision.dtype
+
+def count_dtype(max_count):
+    """ Smallest unsigned integer type for counts up to max_count """
+    if max_count < (1 << 16):
+        return np.uint16
+    if max_count < (1 << 32):
+        return np.uint32
+    return np.uint64
+
+def index_dtype(max_index):
+    """ Index type for sparse matrices """
+    return np.int32 if max_index < (1 << 31) else np.int64
+
 def divide_csr(A, denoms):
     """
     Divide the CSR matrix by a vector
     """
     assert A.shape[0] == len(denoms)
-    data = np.empty(A.data.shape, dtype=float)
-    for i in range(len(A.indptr)-1):
-        low, high = A.indptr[i], A.indptr[i+1]
-        data[low:high] = A.data[low:high] / denoms[i]
+    denoms = np.repeat(np.asarray(denoms, dtype=float).reshape(-1), np.diff(A.indptr))
+    data = (A.data / denoms).astype(float_dtype(), copy=False)
     return csr_matrix((data, A.indices, A.indptr), shape=A.shape)
 
+def normalize_toggles(counts, window, widths):
+    """
+    Toggle rates from raw toggle counts (CSR) of windows in cycles,
+    e.g. when readers are called with normalize=False
+    """
+    return divide_csr(counts, window * np.asarray(widths).reshape(-1, 1))
+
 def translate_indices(from_signals, to_signals, terms):
     """
     A utility function to get new indices in terms
     """
     assert len(from_signals) >= len(to_signals)
 
+    from_map = dict((signal, i) for i, signal in enumerate(from_signals))
     signal_map = dict()
     for i, signal in enumerate(to_signals):
-        signal_map[from_signals.index(signal)] = i
+        signal_map[from_map[signal]] = i
 
     return [
         [
@@ -99,6 +156,19 @@ def translate_indices(from_signals, to_signals, terms):
         for term in terms
     ]
 
+def digest(filenames, *params):
+    """
+    Hash file contents and parameters to key cached results
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for filename in filenames:
+        with open(filename, "rb") as _f:
+            for chunk in iter(lambda: _f.read(1 << 20), b""):
+                h.update(chunk)
+    for param in params:
+        h.update(str(param).encode("utf-8"))
+    return h.hexdigest()
+
 def find_children(modules):
     """
     Find children for modules
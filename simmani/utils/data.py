@@ -1,40 +1,139 @@
 import os
+import io
+import re
 import csv
+import json
+import mmap
 import shutil
+import hashlib
 import logging
+import zipfile
+import multiprocessing
 import numpy as np
-import matplotlib
-matplotlib.use('Agg') # No DISPLAY
-import matplotlib.pyplot as plt
-plt.rcParams.update({'font.size': 16})
-plt.rcParams.update({'agg.path.chunksize': 10000})
-
-def plot_data(dirname, signals, terms, A, modules, ys, filters=None):
-    if os.path.exists(dirname):
-        shutil.rmtree(dirname)
-    os.makedirs(dirname)
+from .profile import profiled
+from .resources import fork_pool
+
+def _pyplot():
+    """
+    matplotlib is imported when the first plot is drawn,
+    so that commands without plots start fast
+    """
+    if _pyplot.plt is None:
+        import matplotlib
+        matplotlib.use('Agg') # No DISPLAY
+        import matplotlib.pyplot as plt
+        plt.rcParams.update({'font.size': 16})
+        plt.rcParams.update({'agg.path.chunksize': 10000})
+        _pyplot.plt = plt
+    return _pyplot.plt
+_pyplot.plt = None
 
+def _figure(**kwargs):
+    """ Figure drawn without pyplot """
+    _pyplot()
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+@profiled("plot data")
+def plot_data(dirname, signals, terms, A, modules, ys, filters=None, jobs=1, update=False):
+    """
+    Plot power against each term for all modules
+    Inputs:
+      - jobs: # of rendering processes
+      - update: keep plots whose data are unchanged since the last run
+    """
     if filters is None:
         filters = np.ones((len(modules), len(terms)), dtype=bool)
     assert filters.shape == (len(modules), len(terms)), \
         "%s != (%s, %s)" % (str(filters.shape), len(modules), len(terms))
 
-    for module, y, f in zip(modules, ys, filters):
-        mod_dirname = os.path.join(dirname, module)
-        os.makedirs(mod_dirname)
+    manifest_filename = os.path.join(dirname, "manifest.json")
+    manifest = dict()
+    if update and os.path.isfile(manifest_filename):
+        with open(manifest_filename, "r") as _f:
+            manifest = json.load(_f)
+    elif os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname, exist_ok=True)
 
-        for i, (term, a) in enumerate(zip(terms, A)):
+    plots = list()
+    digests = dict()
+    for k, (module, y, f) in enumerate(zip(modules, ys, filters)):
+        mod_dirname = os.path.join(dirname, module)
+        os.makedirs(mod_dirname, exist_ok=True)
+        for i, term in enumerate(terms):
             if f[i]:
                 ts = [signals[x] for x in list(term)]
-                filename = os.path.join(mod_dirname, "-".join(ts) + ".png")
-                plt.figure(i)
-                plt.title("*".join(ts))
-                plt.xlabel("toggles", fontsize="large")
-                plt.ylabel("Power(mW)", fontsize="large")
-                plt.plot(a, y, 'o')
-                plt.savefig(filename, format="png")
-                plt.close(i)
+                name = os.path.join(module, "-".join(ts) + ".png")
+                h = hashlib.blake2b(digest_size=16)
+                h.update("*".join(ts).encode("utf-8"))
+                h.update(np.ascontiguousarray(A[i]).tobytes())
+                h.update(np.ascontiguousarray(y).tobytes())
+                digests[name] = h.hexdigest()
+                if manifest.get(name) != digests[name] or \
+                   not os.path.isfile(os.path.join(dirname, name)):
+                    plots.append((os.path.join(dirname, name), "*".join(ts), i, k))
+
+    # Remove plots of terms not in the model anymore
+    for name in set(manifest) - set(digests):
+        if os.path.isfile(os.path.join(dirname, name)):
+            os.remove(os.path.join(dirname, name))
+    logging.info("Data plots: %d (%d unchanged)", len(plots), len(digests) - len(plots))
+
+    # Forked workers share the data
+    _plot_scatter.data = (A, ys)
+    # Pool workers cannot have their own pools
+    if jobs > 1 and len(plots) > 1 and not multiprocessing.current_process().daemon:
+        with fork_pool(jobs, "data plot") as pool:
+            pool.map(_plot_scatter, plots, chunksize=-(-len(plots) // (4 * jobs)))
+    else:
+        for plot in plots:
+            _plot_scatter(plot)
+    _plot_scatter.data = None
+
+    with open(manifest_filename, "w") as _f:
+        json.dump(digests, _f, indent=0, sort_keys=True)
 
+def _plot_scatter(plot):
+    filename, title, i, k = plot
+    A, ys = _plot_scatter.data
+    if _plot_scatter.figure is None:
+        _plot_scatter.figure = _figure()
+        _plot_scatter.figure.add_subplot(111)
+    fig = _plot_scatter.figure
+    ax = fig.axes[0]
+    ax.cla()
+    ax.set_title(title)
+    ax.set_xlabel("toggles", fontsize="large")
+    ax.set_ylabel("Power(mW)", fontsize="large")
+    x, y = np.asarray(A[i]).reshape(-1), np.asarray(ys[k]).reshape(-1)
+    # markers overlapping by more than half are drawn only once
+    cells = fig.get_size_inches() * 144 / _pyplot().rcParams['lines.markersize']
+    ax.plot(*thin_scatter(x, y, cells), 'o', rasterized=True)
+    fig.savefig(filename, format="png")
+_plot_scatter.data = None
+_plot_scatter.figure = None
+
+def thin_scatter(x, y, cells, limit=4096):
+    """
+    Keep one point per cell of a (width x height) grid for dense
+    scatter plots, which draws nearly the same image with far fewer markers
+    """
+    if len(x) <= limit:
+        return x, y
+    def _bins(v, n):
+        low, high = v.min(), v.max()
+        return np.zeros(len(v), dtype=np.int64) if high == low else \
+               ((v - low) * ((n - 1) / (high - low))).astype(np.int64)
+    width, height = int(cells[0]), int(cells[1])
+    _, idxs = np.unique(_bins(x, width) * height + _bins(y, height), return_index=True)
+    idxs.sort()
+    return x[idxs], y[idxs]
+
+@profiled("data write")
 def store_data(filename, signals, terms, modules, A, ys, y_hats):
     logging.info("Data file: %s", filename)
     headers = list()
@@ -47,6 +146,9 @@ def store_data(filename, signals, terms, modules, A, ys, y_hats):
     for y, y_hat in zip(ys, y_hats):
         powers.extend([y, y_hat])
     powers = np.array(powers)
+    if not filename.endswith(".csv"):
+        store_trace(filename, headers, np.append(np.asarray(A), powers.T, axis=1))
+        return
     with open(filename, "w") as f:
         writer = csv.writer(f)
         writer.writerow(headers)
@@ -55,6 +157,16 @@ def store_data(filename, signals, terms, modules, A, ys, y_hats):
 
 def load_data(filename, signals, modules):
     logging.info("Data file: %s", filename)
+    if not filename.endswith(".csv"):
+        trace = load_trace(filename)
+        headers = trace.columns
+        assert all(x == y for x, y in zip(signals, headers[:len(signals)]))
+        for i, module in enumerate(modules):
+            assert headers[len(signals) + 2*i] == "power-%s" % (module)
+            assert headers[len(signals) + 2*i + 1] == "predict-%s" % (module)
+        data = trace.data
+        n = len(signals)
+        return data[:, :n], data[:, n::2].T, data[:, n+1::2].T
     A = list()
     ys = list()
     y_hats = list()
@@ -80,6 +192,185 @@ def load_data(filename, signals, modules):
 
     return np.array(A), np.array(ys), np.array(y_hats)
 
+def _csv_header(columns, window):
+    lines = [','.join(['window', str(window)])] if window is not None else []
+    return '\n'.join(lines + [','.join(columns)])
+
+@profiled("trace write")
+def store_trace(filename, columns, data, window=None, fmt='%f'):
+    """
+    Store a trace (windows x columns) in .npz, or in .csv if requested.
+    The .npz file keeps each column contiguous with the window size
+    and column names in small separate arrays.
+    """
+    logging.info("Trace file: %s", filename)
+    assert data.shape[1] == len(columns), "%d != %d" % (data.shape[1], len(columns))
+    if filename.endswith(".csv"):
+        np.savetxt(filename, data, fmt=fmt, delimiter=',', comments='',
+                   header=_csv_header(columns, window))
+    else:
+        with open(filename, "wb") as _f:
+            np.savez(_f, window=np.array(-1 if window is None else window),
+                     columns=np.array(columns), data=np.asfortranarray(data))
+
+class TraceWriter(object):
+    """
+    Append rows to a trace file in constant memory. For .npz, rows are
+    written to a temporary file, and transposed in blocks of rows on
+    `close()` into the same column-major layout as `store_trace`.
+    """
+    BLOCK_SIZE = 1 << 24 # bytes of rows transposed at once
+
+    def __init__(self, filename, columns, window=None, fmt='%f'):
+        logging.info("Trace file: %s", filename)
+        self.filename = filename
+        self.columns = list(columns)
+        self.window = window
+        self.fmt = fmt
+        self.rows = 0
+        if filename.endswith(".csv"):
+            self._f = open(filename, "w")
+            self._f.write(_csv_header(columns, window) + '\n')
+        else:
+            self._f = open(filename + ".rows", "wb")
+
+    def append(self, rows):
+        assert rows.shape[1] == len(self.columns)
+        if self.filename.endswith(".csv"):
+            np.savetxt(self._f, rows, fmt=self.fmt, delimiter=',')
+        else:
+            self._f.write(np.ascontiguousarray(rows, dtype='<f8').tobytes())
+        self.rows += rows.shape[0]
+
+    def close(self):
+        self._f.close()
+        if not self.filename.endswith(".csv"):
+            shape = (self.rows, len(self.columns))
+            data_filename = self.filename + ".data.npy"
+            data = np.lib.format.open_memmap(
+                data_filename, mode="w+", dtype='<f8', shape=shape, fortran_order=True)
+            if self.rows > 0 and shape[1] > 0:
+                rows = np.memmap(self._f.name, dtype='<f8', mode="r", shape=shape)
+                block = max(1, self.BLOCK_SIZE // (8 * shape[1]))
+                for begin in range(0, self.rows, block):
+                    data[begin:begin+block] = rows[begin:begin+block]
+                del rows
+            data.flush()
+            del data
+            with zipfile.ZipFile(self.filename, "w", zipfile.ZIP_STORED, allowZip64=True) as _z:
+                for name, array in (
+                        ('window', np.array(-1 if self.window is None else self.window)),
+                        ('columns', np.array(self.columns))):
+                    buf = io.BytesIO()
+                    np.save(buf, array)
+                    _z.writestr(name + ".npy", buf.getvalue())
+                _z.write(data_filename, "data.npy")
+            os.remove(data_filename)
+            os.remove(self._f.name)
+
+class Trace(object):
+    """
+    Trace loaded from `store_trace`/`TraceWriter` outputs (.npz or .csv).
+    The window size and column names are read eagerly, while the data
+    are only loaded on first access. No file is kept open.
+    """
+
+    def __init__(self, filename):
+        logging.info("Trace file: %s", filename)
+        assert os.path.isfile(filename), "%s not found" % (filename)
+        self.filename = filename
+        self._data = None
+        if filename.endswith(".csv"):
+            with open(filename, "r") as _f:
+                line = _f.readline().strip().split(',')
+                self._skip = 1
+                self.window = None
+                if line[0] == 'window' and len(line) == 2:
+                    self.window = int(line[1])
+                    line = _f.readline().strip().split(',')
+                    self._skip = 2
+                self.columns = line
+        else:
+            with np.load(filename) as npz:
+                window = int(npz['window'])
+                self.columns = [str(column) for column in npz['columns']]
+            self.window = window if window >= 0 else None
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self.filename.endswith(".csv"):
+                self._data = _decode_csv(self.filename, self._skip, len(self.columns))
+            else:
+                with np.load(self.filename) as npz:
+                    self._data = npz['data']
+        return self._data
+
+    def __getitem__(self, column):
+        return self.data[:, self.columns.index(column)]
+
+CSV_CHUNK = 1 << 24
+# blank lines after the first line of a chunk
+_CSV_BLANK = re.compile(rb"\n[ \t\r\f\v]*(?=\n)")
+
+def _csv_rows(chunk):
+    """ # of lines of a chunk, except blank lines (e.g. trailing newlines) """
+    first = chunk.find(b"\n")
+    blank = len(_CSV_BLANK.findall(chunk)) + (first >= 0 and not chunk[:first].strip())
+    last = chunk[chunk.rfind(b"\n")+1:]
+    return chunk.count(b"\n") - blank + (last.strip() != b"")
+
+def _csv_chunks(buf, begin, size):
+    """ Byte ranges of up to CSV_CHUNK bytes that end at line boundaries """
+    while begin < size:
+        end = buf.rfind(b"\n", begin, begin + CSV_CHUNK) + 1
+        if end <= begin:
+            end = buf.find(b"\n", begin) + 1 or size
+        if begin + CSV_CHUNK >= size:
+            end = size
+        yield begin, end
+        begin = end
+
+def _decode_csv(filename, skip, columns):
+    """
+    Decode a numeric csv body from the mapped file in chunks of lines,
+    so that memory is the decoded array and O(CSV_CHUNK) for any file
+    """
+    with open(filename, "rb") as _f:
+        size = os.fstat(_f.fileno()).st_size
+        if size == 0:
+            return np.empty((0, columns))
+        buf = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = 0
+    for _ in range(skip):
+        offset = buf.find(b"\n", offset) + 1
+        if offset == 0:
+            buf.close()
+            return np.empty((0, columns))
+
+    data = np.empty((sum(_csv_rows(buf[begin:end])
+                         for begin, end in _csv_chunks(buf, offset, size)), columns))
+    row = 0
+    for begin, end in _csv_chunks(buf, offset, size):
+        chunk = buf[begin:end]
+        rows = _csv_rows(chunk)
+        if rows == 0:
+            # fromstring does not return an empty array for whitespace
+            continue
+        values = np.fromstring(chunk.replace(b",", b" "), sep=" ")
+        assert values.size == rows * columns, \
+            "%s: %d values in %d rows x %d columns after row %d" % (
+                filename, values.size, rows, columns, row)
+        data[row:row+rows] = values.reshape(rows, columns)
+        row += rows
+    buf.close()
+    assert row == data.shape[0], "%s: %d != %d rows" % (filename, row, data.shape[0])
+    return data
+
+def load_trace(filename):
+    return Trace(filename)
+
+@profiled("plot power")
 def plot_power(filename, ys, cycles, window, title=""):
     """
     Plot time-based power
@@ -110,34 +401,64 @@ def plot_power(filename, ys, cycles, window, title=""):
     ymin = 0.95 * (min(np.min(ys[0]), np.min(ys[1])) \
         if ys[0] is not None else np.min(ys[1]))
 
-    plt.figure(figsize=(24, 8))
+    # One figure is reused for all plots
+    if plot_power.figure is None:
+        plot_power.figure = _figure(figsize=(24, 8))
+        plot_power.figure.add_subplot(211)
+        plot_power.figure.add_subplot(212)
+    fig = plot_power.figure
+    top, bottom = fig.axes
+    pixels = int(fig.get_figwidth() * fig.dpi)
 
+    top.cla()
+    top.set_visible(ys[0] is not None)
     if ys[0] is not None:
-        plt.subplot(211)
-        # plt.title("[Power] " + title)
-        plt.xlim((0.0, xmax))
-        plt.ylim((ymin, ymax))
-        plt.plot(intervals, ys[0][:len(intervals)], 'b-')
-        plt.ylabel("Actual Power (mW)")
-
-    plt.subplot(212)
-    # plt.title("[Predict] " + title)
-    plt.xlim((0.0, xmax))
-    plt.ylim((ymin, ymax))
+        # top.set_title("[Power] " + title)
+        top.set_xlim((0.0, xmax))
+        top.set_ylim((ymin, ymax))
+        top.plot(*decimate(intervals, ys[0][:len(intervals)], pixels), 'b-')
+        top.set_ylabel("Actual Power (mW)")
+
+    bottom.cla()
+    # bottom.set_title("[Predict] " + title)
+    bottom.set_xlim((0.0, xmax))
+    bottom.set_ylim((ymin, ymax))
     if ys[0] is not None:
-        plt.plot(intervals, ys[0][:len(intervals)], 'b-')
-    plt.plot(intervals, ys[1][:len(intervals)], 'g-')
-    plt.ylabel("Predicted Power (mW)")
-    plt.xlabel("Cycles %s" % unit)
+        bottom.plot(*decimate(intervals, ys[0][:len(intervals)], pixels), 'b-')
+    bottom.plot(*decimate(intervals, ys[1][:len(intervals)], pixels), 'g-')
+    bottom.set_ylabel("Predicted Power (mW)")
+    bottom.set_xlabel("Cycles %s" % unit)
 
-    plt.savefig(filename, format="png", bbox_inches='tight')
-    plt.close('all')
+    fig.savefig(filename, format="png", bbox_inches='tight')
+plot_power.figure = None
+
+def decimate(x, y, n):
+    """
+    Min/max envelope of a trace in n buckets, keeping its peaks
+    Inputs:
+      - x, y: trace
+      - n: # of buckets (e.g. pixels)
+    Outputs:
+      - at most 2n points of the trace in order
+    """
+    if len(y) <= 2 * n:
+        return x, y
+    size = -(-len(y) // n)
+    buckets = np.append(y, np.repeat(y[-1], n * size - len(y))).reshape(n, size)
+    offsets = np.arange(n).reshape(-1, 1) * size
+    idxs = np.sort(np.stack([
+        buckets.argmin(axis=1),
+        buckets.argmax(axis=1)], axis=1), axis=1) + offsets
+    idxs = np.minimum(idxs.reshape(-1), len(y) - 1)
+    return x[idxs], y[idxs]
 
+@profiled("plot power bars")
 def plot_power_bars(filename, modules, ys, y_hats, title=None):
     """
     Plot Power Breakdown
     """
     logging.info("Power Break-down: %s", filename)
+    plt = _pyplot()
     plt.figure(figsize=(8, 6))
     if title is not None:
         plt.title(title)
@@ -175,6 +496,7 @@ plot_power_bars.colors = [
     "salmon",
     "lime"]
 
+@profiled("power bars write")
 def store_power_bars(filename, modules, ys, y_hats):
     logging.info("Power Bars in CSV: %s", filename)
     def _mean(y):
@@ -0,0 +1,49 @@
+import logging
+import numpy as np
+from .data import load_trace
+
+def load_power_trace(filename):
+    """
+    Load a power trace sampled on FPGA
+    Inputs:
+      - filename: .csv ('window,N', module names, then one row per window)
+                  or .npz written by `store_trace`
+    Outputs:
+      - window size, module names, power trace (mW) of each module
+    """
+    logging.info("FPGA Power Trace: %s", filename)
+    trace = load_trace(filename)
+    assert trace.window is not None, "%s: no window size" % (filename)
+    data = np.asarray(trace.data, dtype=float)
+    # one contiguous array per module
+    ps = list(np.ascontiguousarray(data.T))
+    logging.info("Windows: %d, Modules: %d", data.shape[0], len(trace.columns))
+    return trace.window, trace.columns, ps
+
+def align_powers(ps, ys):
+    """
+    Truncate predicted and reference traces to their common length
+    Outputs:
+      - modules x windows arrays of predicted and reference power
+    """
+    assert len(ps) == len(ys), "%d != %d" % (len(ps), len(ys))
+    size = min(min(len(p) for p in ps), min(len(y) for y in ys))
+    P = np.empty((len(ps), size))
+    Y = np.empty((len(ys), size))
+    for i, (p, y) in enumerate(zip(ps, ys)):
+        P[i] = p[:size]
+        Y[i] = y[:size]
+    return P, Y
+
+def power_errors(P, Y):
+    """
+    Normalized RMS errors and average power errors of all modules
+    Inputs:
+      - P, Y: modules x windows predicted and reference power
+    Outputs:
+      - NRMSE, AVGE for each module
+    """
+    y_means = Y.mean(axis=1)
+    rmses = np.sqrt(np.mean((P - Y) ** 2, axis=1)) / y_means
+    avges = np.abs(P.mean(axis=1) - y_means) / y_means
+    return rmses, avges
@@ -1,8 +1,11 @@
 import os
 import logging
+from array import array
 from time import time
 import numpy as np
-from . import average_rows
+from . import average_rows, float_dtype
+from .seek import load_index, store_index, find_checkpoint
+from .profile import profiled
 
 def read_power_report(filename):
     """
@@ -69,12 +72,20 @@ def read_power_report(filename):
     return modules, total_powers, extra_powers
 
 
-def read_power_out(filename, module_filter=None):
+@profiled("power parse")
+def read_power_out(filename, module_filter=None, cycles=None):
     """
     Read PrimeTime-PX output_format to return cycle-by-cycle power
+    (modules x cycles in float_dtype())
+    cycles: (begin, end) range of cycles after reset. Reading stops at
+    end, and resumes from the seek index of the file (see utils/seek.py)
+    with the power of all modules checkpointed into it.
     """
     logging.info("Power Waveform: %s", filename)
+    # per-cycle powers are kept in typed arrays rather than lists of floats
+    typecode = 'f' if float_dtype() == np.float32 else 'd'
     assert os.path.isfile(filename), "%s not found" % (filename)
+    assert cycles is None or cycles[1] is None or cycles[0] < cycles[1], str(cycles)
     time = 0
     cycle = 0
     modules = list()
@@ -86,6 +97,21 @@ def read_power_out(filename, module_filter=None):
     energy = list()
     last_power = list()
 
+    # With a cycle range, all modules are kept for checkpoints
+    # and only wanted modules are returned
+    ranged = cycles is not None
+    begin, end = cycles if ranged else (0, None)
+    wanted = list()
+    base = 0 # # of cycles dropped from powers
+    stopped = False
+    if ranged:
+        interval, checkpoints = load_index(filename)
+        indexed = len(checkpoints)
+        last = checkpoints[-1]['cycle'] if checkpoints else 0
+        k = find_checkpoint(checkpoints, begin)
+        boundary = None
+        offset = 0
+
     class PowerState: reset, skip, init, run = range(4)
     power_state = PowerState.reset
     updated, allzero = False, False
@@ -99,8 +125,10 @@ def read_power_out(filename, module_filter=None):
             elif pwr_cycles == len(p):
                 del p[-1]
 
-    with open(filename) as _f:
+    with open(filename, encoding="latin-1", newline="") as _f:
         for line in _f:
+            if ranged:
+                offset += len(line)
             tokens = line.split()
             if not tokens:
                 pass
@@ -119,27 +147,48 @@ def read_power_out(filename, module_filter=None):
                 assert tokens[-1] == "Pc"
                 assert tokens[1][0:3] == "Pc(" and tokens[1][-1] == ")"
                 module = tokens[1][3:-1].replace(hier_delim, '.')
-                if (module_filter and module in module_filter) or \
-                   (not module_filter and 'clk_gate' not in module and \
-                    'pp_root' not in module and '_ext' not in module):
+                keep = (module_filter and module in module_filter) or \
+                       (not module_filter and 'clk_gate' not in module and \
+                        'pp_root' not in module and '_ext' not in module)
+                if keep or ranged:
                     lookup[tokens[2]] = len(modules)
                     modules.append(module)
-                    powers.append(list())
+                    wanted.append(keep)
+                    powers.append(array(typecode))
                     last_power.append(0.0)
                     energy.append(0.0)
 
             elif len(tokens) == 3 and tokens[0] == 'module:':
                 # Module Declarating
                 module = tokens[1]
-                if (module_filter and module in module_filter) or \
-                   (not module_filter and 'clk_gate' not in module and \
-                    'pp_root' not in module and '_ext' not in module):
+                keep = (module_filter and module in module_filter) or \
+                       (not module_filter and 'clk_gate' not in module and \
+                        'pp_root' not in module and '_ext' not in module)
+                if keep or ranged:
                     lookup[tokens[2]] = len(modules)
                     modules.append(module)
-                    powers.append(list())
+                    wanted.append(keep)
+                    powers.append(array(typecode))
                     last_power.append(0.0)
                     energy.append(0.0)
 
+            elif len(tokens) == 1 and ranged and k >= 0:
+                # Resume from the checkpoint after module declarations
+                checkpoint = checkpoints[k]
+                for _id, i in lookup.items():
+                    powers[i] = array(typecode, checkpoint['tails'][_id])
+                    last_power[i] = checkpoint['last_power'][_id]
+                base = checkpoint['cycle'] - len(checkpoint['tails'][_id])
+                cycle = checkpoint['clock']
+                prev_cycle = checkpoint['prev_clock']
+                reset_latency = checkpoint['reset_latency']
+                power_state = PowerState.run
+                updated, allzero = False, True
+                boundary = checkpoint['cycle']
+                offset = checkpoint['offset']
+                _f.seek(offset)
+                k = -1
+
             elif len(tokens) == 1:
                 # This is a cycle-accurate power trace
                 prev_cycle = cycle
@@ -173,41 +222,85 @@ def read_power_out(filename, module_filter=None):
                               power_state, tokens[0], cycle, prev_cycle, prev_cycle - pwr_cycles, pwr_cycles)
                 updated = False
                 allzero = True
+
+                if ranged and power_state == PowerState.run and powers:
+                    # powers of base + len(powers[0]) cycles are complete
+                    pwr_cycles = base + len(powers[0])
+                    if pwr_cycles % interval == 0 and pwr_cycles != boundary:
+                        if pwr_cycles > last:
+                            checkpoints.append(dict(
+                                cycle=pwr_cycles, offset=offset, clock=cycle,
+                                prev_clock=prev_cycle, reset_latency=reset_latency,
+                                last_power=dict((_id, last_power[i]) for _id, i in lookup.items()),
+                                tails=dict((_id, list(powers[i][-2:])) for _id, i in lookup.items())))
+                            last = pwr_cycles
+                        if pwr_cycles <= begin:
+                            # keep only the tails of powers before the cycle range
+                            for p in powers:
+                                del p[:-2]
+                            base = pwr_cycles - len(powers[0])
+                        boundary = pwr_cycles
+                    if end is not None and pwr_cycles >= end:
+                        # as if the file ended with the last cycle
+                        cycle -= 1
+                        stopped = True
+                        break
             elif len(tokens) == 2:
                 # Module Power
                 idx = tokens[0]
                 pwr = float(tokens[1]) * 1e3 # W -> mW
                 if idx in lookup:
                     # This is a cycle-accurate power trace
+                    i = lookup[idx]
                     if power_state == PowerState.run:
                         if cycle > prev_cycle:
-                            powers[lookup[idx]].append(pwr)
+                            powers[i].append(pwr)
                         else:
-                            last_power[lookup[idx]] = pwr
-                    allzero &= pwr < 1e-13
+                            last_power[i] = pwr
+                    allzero &= pwr < 1e-13 or not wanted[i]
                     updated = True
 
-    if power_state == PowerState.run:
+    if power_state == PowerState.run and not stopped:
         _power_update()
         if allzero:
             cycle -= 1
 
-    powers = np.array(powers)
-    reset_cycles = cycle - powers.shape[1]
+    powers = np.array([np.frombuffer(p, dtype=float_dtype()) for p in powers])
+    reset_cycles = cycle - base - powers.shape[1]
     logging.debug("Inferred Reset Cycles: %d", reset_cycles)
-    assert powers.shape[0] == len(modules) and powers.shape[1] < cycle, \
+    assert powers.shape[0] == len(modules) and base + powers.shape[1] < cycle, \
         "%s" % str(powers.shape)
+    if ranged:
+        if len(checkpoints) > indexed:
+            store_index(filename, interval, checkpoints)
+        modules = [module for module, keep in zip(modules, wanted) if keep]
+        powers = powers[np.array(wanted, dtype=bool)]
+        powers = powers[:, begin-base:None if end is None else end-base]
+        cycle = reset_cycles + powers.shape[1]
     return cycle, reset_cycles, modules, powers
 
-def read_power_files(out_files, window, vcd_cycle_list=None, reset_cycle_list=None, module_filter=None):
+def read_power_files(out_files, window, vcd_cycle_list=None, reset_cycle_list=None, module_filter=None,
+                     cycles=None):
     """
     Read multiple power out files
+    (in the same range of cycles after reset if cycles is given)
     """
     start_time = time()
+    results = [read_power_out(out_file, module_filter, cycles) for out_file in out_files]
+    end_time = time()
+    logging.info("Power read time: %.2f s", end_time - start_time)
+
+    return merge_power_files(out_files, results, window, vcd_cycle_list, reset_cycle_list)
+
+def merge_power_files(out_files, results, window, vcd_cycle_list=None, reset_cycle_list=None):
+    """
+    Check power traces from `read_power_out` against toggles
+    and concatenate them in windows
+    """
     assert vcd_cycle_list is None or len(vcd_cycle_list) == len(out_files)
     modules = None
-    for i, out_file in enumerate(out_files):
-        pwr_cycles, reset_cycles, _modules, _powers = read_power_out(out_file, module_filter)
+    for i, (out_file, result) in enumerate(zip(out_files, results)):
+        pwr_cycles, reset_cycles, _modules, _powers = result
         logging.debug("%s => cycles: %d, reset cycles: %d", out_file, pwr_cycles, reset_cycles)
         vcd_cycles = vcd_cycle_list[i] if vcd_cycle_list is not None else -1
         if reset_cycle_list is not None:
@@ -227,7 +320,34 @@ def read_power_files(out_files, window, vcd_cycle_list=None, reset_cycle_list=No
         else:
             assert all(x == y for x, y in zip(modules, _modules))
             powers = np.append(powers, _powers, axis=1)
-    end_time = time()
-    logging.info("Power read time: %.2f s", end_time - start_time)
 
     return modules, average_rows(powers, window)
+
+def split_powers(modules, powers, children=None, labels=None, misc_module=None):
+    """
+    Split power traces into the targets of per-module power models:
+    the top module, the exclusive power of each label, and the rest (misc)
+    Outputs:
+      - target names, target power traces
+    """
+    ys = list(powers)
+    names = [modules[0]]
+    targets = [ys[0]]
+    if children:
+        label_ys = dict()
+        for module, y in zip(modules[1:], ys[1:]):
+            assert module in children
+            idxs = [modules.index(child) for child in children[module]]
+            label = labels[module]
+            if label not in label_ys:
+                label_ys[label] = 0.0
+            y -= np.array(ys)[idxs].sum(axis=0)
+            label_ys[label] += y
+        names.extend(label_ys.keys())
+        targets.extend(label_ys.values())
+
+    if misc_module:
+        names.append(misc_module)
+        targets.append(ys[0] - np.sum(ys[1:], axis=0))
+
+    return names, targets
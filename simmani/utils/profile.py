@@ -0,0 +1,137 @@
+import os
+import csv
+import json
+import logging
+import resource
+import functools
+from contextlib import contextmanager
+from time import time, process_time
+
+class Profiler(object):
+    """
+    Named spans around pipeline stages, each recording wall time,
+    CPU time, peak RSS, and sizes of the data it works on.
+    Spans are not recorded unless enabled (e.g. by --profile).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = list()
+        self._stack = list()
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def span(self, name, **sizes):
+        """
+        Record a span, more sizes can be added to the yielded record
+        """
+        if not self.enabled:
+            yield dict()
+            return
+        record = {
+            'name': name,
+            'parent': '/'.join(self._stack),
+            'pid': os.getpid()
+        }
+        self._stack.append(name)
+        start_time, start_cpu = time(), process_time()
+        try:
+            yield sizes
+        finally:
+            record['sizes'] = dict((key, size_of(value)) for key, value in sizes.items())
+            record['wall'] = time() - start_time
+            record['cpu'] = process_time() - start_cpu
+            record['peak_rss_mb'] = peak_rss_mb()
+            self._stack.pop()
+            self.spans.append(record)
+
+    def store(self, filename):
+        """
+        Store spans in .json or .csv
+        """
+        logging.info("Profile file: %s", filename)
+        if filename.endswith(".csv"):
+            with open(filename, "w") as _f:
+                writer = csv.writer(_f)
+                writer.writerow(['name', 'parent', 'pid', 'wall (s)', 'cpu (s)',
+                                 'peak RSS (MB)', 'sizes'])
+                for span in self.spans:
+                    writer.writerow([
+                        span['name'], span['parent'], span['pid'],
+                        "%.6f" % span['wall'], "%.6f" % span['cpu'],
+                        "%.1f" % span['peak_rss_mb'],
+                        ' '.join("%s=%s" % (key, value) for key, value in sorted(span['sizes'].items()))
+                    ])
+        else:
+            with open(filename, "w") as _f:
+                json.dump({'spans': self.spans}, _f, indent=2)
+
+        logging.info("Profile:")
+        totals = dict()
+        for span in self.spans:
+            wall, cpu, count = totals.get(span['name'], (0.0, 0.0, 0))
+            totals[span['name']] = (wall + span['wall'], cpu + span['cpu'], count + 1)
+        for name, (wall, cpu, count) in sorted(totals.items(), key=lambda x: -x[1][0]):
+            logging.info("- %s: %.2f s wall, %.2f s cpu (%d)", name, wall, cpu, count)
+
+    def gather(self, outputs):
+        """
+        Merge spans from pool workers running `call_profiled`
+        """
+        results = list()
+        for result, spans in outputs:
+            results.append(result)
+            self.spans.extend(spans)
+        return results
+
+def call_profiled(func, *args):
+    """
+    Run func (e.g. in a pool worker) returning its spans with the result
+    """
+    start = len(PROFILER.spans)
+    result = func(*args)
+    return result, PROFILER.spans[start:]
+
+def peak_rss_mb():
+    """ Peak RSS of this process and its finished children """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+def size_of(value):
+    """ Shape (and nnz of sparse matrices) of arrays, or the value itself """
+    if hasattr(value, 'nnz'):
+        return list(value.shape) + [value.nnz]
+    if hasattr(value, 'shape'):
+        return list(value.shape)
+    return value
+
+PROFILER = Profiler()
+
+def span(name, **sizes):
+    return PROFILER.span(name, **sizes)
+
+def profiled(name):
+    """
+    Decorator recording a span for each call with the sizes of
+    array arguments and results
+    """
+    def _profiled(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            names = func.__code__.co_varnames
+            sizes = dict(
+                (names[i] if i < len(names) else 'arg%d' % i, arg)
+                for i, arg in enumerate(args) if hasattr(arg, 'shape'))
+            with PROFILER.span(name, **sizes) as sizes:
+                result = func(*args, **kwargs)
+                outputs = result if isinstance(result, tuple) else (result,)
+                for i, output in enumerate(outputs):
+                    if hasattr(output, 'shape'):
+                        sizes['out%d' % i] = output
+            return result
+        return wrapper
+    return _profiled
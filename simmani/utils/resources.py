@@ -0,0 +1,109 @@
+"""
+CPU budget of a run
+
+The budget (# of cores) is given by --cpus or SIMMANI_CPUS, and is
+all cores available to the process by default. Process pools split it
+between their workers, and solvers split their share between joblib
+workers and BLAS/OpenMP threads (or use it all in threads), so that nested parallel stages, and
+runs sharing a machine (e.g. under scons -j), do not oversubscribe it.
+BLAS/OpenMP threads are limited only if threadpoolctl is installed.
+"""
+
+import os
+import logging
+import multiprocessing
+from contextlib import contextmanager
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+CPUS_ENV = "SIMMANI_CPUS"
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def set_cpus(cpus=None):
+    """
+    Set the CPU budget and limit BLAS/OpenMP threads to it
+    Inputs:
+      - cpus: # of cores (SIMMANI_CPUS or all available cores if None)
+    """
+    if cpus is None:
+        cpus = int(os.environ.get(CPUS_ENV, 0)) or available_cpus()
+    assert cpus > 0, "invalid CPU budget: %d" % cpus
+    set_cpus.cpus = cpus
+    set_cpus.logged = set()
+    if threadpool_limits is not None:
+        threadpool_limits(limits=cpus)
+    return cpus
+
+set_cpus.cpus = None
+set_cpus.logged = set()
+
+def cpu_budget():
+    if set_cpus.cpus is None:
+        set_cpus()
+    return set_cpus.cpus
+
+def log_budget():
+    logging.info("CPU budget: %d cores (%d available), BLAS threads %s",
+                 cpu_budget(), available_cpus(),
+                 "limited" if threadpool_limits is not None else
+                 "not limited (threadpoolctl not found)")
+
+def _log_layout(stage, processes, threads):
+    # Stages run many times (e.g. solvers of every module) are logged once
+    if stage not in set_cpus.logged:
+        set_cpus.logged.add(stage)
+        logging.info("[CPU] %s: %d workers x %d cores", stage, processes, threads)
+
+def fork_pool(processes, stage):
+    """
+    Fork context pool whose workers share the CPU budget
+    Inputs:
+      - processes: # of processes (e.g. min(jobs, # of tasks))
+      - stage: name of the parallel stage for logs
+    """
+    share = max(1, cpu_budget() // processes)
+    _log_layout(stage, processes, share)
+    return multiprocessing.get_context("fork").Pool(
+        processes, initializer=set_cpus, initargs=(share,))
+
+@contextmanager
+def threads(stage):
+    """
+    Give the CPU budget to BLAS/OpenMP threads of solvers
+    parallel only in threads (e.g. k-means of sklearn)
+    Outputs:
+      - # of threads
+    """
+    cpus = cpu_budget()
+    if stage not in set_cpus.logged:
+        set_cpus.logged.add(stage)
+        logging.info("[CPU] %s: %d threads", stage, cpus)
+    if threadpool_limits is None:
+        yield cpus
+    else:
+        with threadpool_limits(limits=cpus):
+            yield cpus
+
+@contextmanager
+def parallel(tasks, stage):
+    """
+    Split the CPU budget between joblib workers of at most tasks
+    and BLAS/OpenMP threads of each worker
+    Outputs:
+      - n_jobs for joblib (e.g. of sklearn estimators)
+    """
+    n_jobs = max(1, min(tasks, cpu_budget()))
+    threads = max(1, cpu_budget() // n_jobs)
+    _log_layout(stage, n_jobs, threads)
+    if threadpool_limits is None:
+        yield n_jobs
+    else:
+        with threadpool_limits(limits=threads):
+            yield n_jobs
@@ -0,0 +1,78 @@
+"""
+Persistent seek indices of traces
+
+An index keeps checkpoints of a trace reader every `interval` cycles
+after reset: the byte offset to resume from and the reader state at
+that point, so that reads of a cycle range start from the last
+checkpoint before it instead of the beginning. Readers extend the
+index whenever they read past its last checkpoint, and an index is
+ignored once its trace changes. Indices are kept in a cache directory
+($XDG_CACHE_HOME/simmani or ~/.cache/simmani), not next to the traces,
+which may be read-only.
+"""
+
+import os
+import json
+import logging
+from bisect import bisect_right
+from . import digest
+
+INDEX_INTERVAL = 1 << 14
+
+def cache_dirname():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                        os.path.join(os.path.expanduser("~"), ".cache"), "simmani")
+
+def index_filename(filename):
+    """ Index of a trace, named after its absolute path """
+    return os.path.join(cache_dirname(), "%s.idx" % digest([], os.path.abspath(filename)))
+
+def _stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+def load_index(filename):
+    """
+    Outputs:
+      - interval, checkpoints (in cycle order) of a trace,
+        or a new empty index if there is no valid index
+    """
+    idx_filename = index_filename(filename)
+    if os.path.isfile(idx_filename):
+        try:
+            with open(idx_filename, "r") as _f:
+                index = json.load(_f)
+        except (OSError, ValueError) as e:
+            logging.warning("Seek index: %s is unreadable (%s)", idx_filename, e)
+            return INDEX_INTERVAL, list()
+        if tuple(index['stamp']) == _stamp(filename):
+            logging.info("Seek index: %s (%d checkpoints)",
+                         idx_filename, len(index['checkpoints']))
+            return index['interval'], index['checkpoints']
+        logging.info("Seek index: %s is stale", idx_filename)
+    return INDEX_INTERVAL, list()
+
+def store_index(filename, interval, checkpoints):
+    """
+    Store the index of a trace. Reads do not need the index,
+    so failing to store it is not an error.
+    """
+    idx_filename = index_filename(filename)
+    logging.info("Seek index: %s (%d checkpoints)", idx_filename, len(checkpoints))
+    try:
+        os.makedirs(os.path.dirname(idx_filename), exist_ok=True)
+        with open(idx_filename, "w") as _f:
+            json.dump({
+                'trace': os.path.abspath(filename),
+                'stamp': _stamp(filename),
+                'interval': interval,
+                'checkpoints': checkpoints
+            }, _f)
+    except OSError as e:
+        logging.warning("Seek index: cannot store %s (%s)", idx_filename, e)
+
+def find_checkpoint(checkpoints, cycle):
+    """
+    Position of the last checkpoint at or before cycle (-1 if none)
+    """
+    return bisect_right([checkpoint['cycle'] for checkpoint in checkpoints], cycle) - 1
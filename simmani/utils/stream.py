@@ -0,0 +1,148 @@
+"""
+Streaming VCDs from running simulations
+
+A simulation writes its VCD into a named pipe (mkfifo) or a file still
+being written (tail mode), and windows of toggles are parsed as the
+VCD arrives, without storing the trace. Windows are handed over in
+blocks through a bounded queue: once the consumer (e.g. a sketch or
+an evaluator) falls behind, the parser stops reading, and a simulation
+writing a pipe blocks until the consumer catches up.
+"""
+
+import os
+import stat
+import logging
+import threading
+from queue import Queue, Full
+from time import time, sleep
+import numpy as np
+from . import count_dtype
+from .vcd import VCDReader
+
+def is_fifo(filename):
+    return os.path.exists(filename) and stat.S_ISFIFO(os.stat(filename).st_mode)
+
+class _Tail(object):
+    """
+    Lines of a file being written, which ends once
+    no data is written for `idle` seconds
+    """
+
+    def __init__(self, filename, poll, idle):
+        start_time = time()
+        while not os.path.exists(filename):
+            assert time() - start_time < idle, "%s not found" % (filename)
+            sleep(poll)
+        self._f = open(filename, "r", encoding="latin-1", newline="")
+        self.poll = poll
+        self.idle = idle
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._f.readline()
+        start_time = time()
+        while not line.endswith('\n'):
+            # wait for the rest of the line
+            if time() - start_time >= self.idle:
+                if line:
+                    return line
+                raise StopIteration
+            sleep(self.poll)
+            more = self._f.readline()
+            if more:
+                line += more
+                start_time = time()
+        return line
+
+    def close(self):
+        self._f.close()
+
+class VCDStream(VCDReader):
+    """
+    VCD reader of a running simulation
+
+    Reads a named pipe until the simulation closes it, or a file being
+    written until no data is written for `idle` seconds (the file may
+    not exist yet). Reads wait for the simulation, so `windows()` yields
+    windows as they complete. Cycle ranges are not supported.
+    """
+
+    # pipes and files being written are read only once
+    scannable = False
+
+    def __init__(self, vcd_filename, signal_filter=None, window=1, poll=0.1, idle=10.0):
+        self.poll = poll
+        self.idle = idle
+        super(VCDStream, self).__init__(vcd_filename, signal_filter, window)
+
+    def _open(self, vcd_filename):
+        if is_fifo(vcd_filename):
+            # waits for the simulation to open the pipe
+            logging.info("VCD stream: %s (named pipe)", vcd_filename)
+            return open(vcd_filename, "r", encoding="latin-1", newline="")
+        logging.info("VCD stream: %s (tail, idle: %.1f s)", vcd_filename, self.idle)
+        return _Tail(vcd_filename, self.poll, self.idle)
+
+def stream_windows(reader, block_size=256, queue_size=16):
+    """
+    Parse windows of a reader in a thread, and yield them in blocks as
+    they complete. At most queue_size blocks are buffered, so memory is
+    O(queue_size x block_size x signals) for any trace length.
+    Outputs:
+      - windows x signals raw toggle counts (see VCDReader.windows)
+    """
+    queue = Queue(queue_size)
+    stop = threading.Event()
+    stats = dict(windows=0, stalls=0)
+    dtype = count_dtype(reader.window * max(reader.widths, default=1))
+
+    def _put(item):
+        if queue.full():
+            stats['stalls'] += 1
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _parse():
+        try:
+            block = np.empty((block_size, len(reader.signals)), dtype=dtype)
+            size = 0
+            for _, cur_toggles in reader.windows():
+                block[size] = cur_toggles
+                size += 1
+                stats['windows'] += 1
+                if size == block_size:
+                    if not _put(block):
+                        return
+                    block = np.empty_like(block)
+                    size = 0
+            if size > 0 and not _put(block[:size]):
+                return
+            _put(None)
+        except Exception as e: # pylint: disable=broad-except
+            _put(e)
+
+    start_time = time()
+    thread = threading.Thread(target=_parse, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = queue.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        # also stops the parser if the consumer stops early
+        stop.set()
+    thread.join()
+    end_time = time()
+    logging.info("Stream time: %.2f s (%d windows, %d stalls on a full queue)",
+                 end_time - start_time, stats['windows'], stats['stalls'])
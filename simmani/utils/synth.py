@@ -0,0 +1,154 @@
+import logging
+import numpy as np
+
+# bumped whenever the same parameters generate a different trace
+SYNTH_VERSION = 2
+
+def _symbol(i):
+    """ VCD identifier code of the i-th variable """
+    code = ''
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 94)
+        code += chr(33 + r)
+    return code
+
+def _popcount(x):
+    """ # of set bits of 64-bit values """
+    x = x.astype(np.uint64)
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def synth_modules(depth):
+    """
+    Binary module tree of the given depth (1 = top only)
+    Outputs:
+      - module names, parent index of each module (-1 for top)
+    """
+    modules = ['Top']
+    parents = [-1]
+    level = [0]
+    for _ in range(depth - 1):
+        _level = list()
+        for i in level:
+            for j in range(2):
+                _level.append(len(modules))
+                modules.append("%s.m%d" % (modules[i], j))
+                parents.append(i)
+        level = _level
+    return modules, parents
+
+def synth_trace(vcd_filename, out_filename, signals=64, cycles=10000, density=0.2,
+                depth=2, widths=(1, 1, 4, 8, 16, 32), reset=5, seed=0,
+                modules_filename=None, chunk=4096):
+    """
+    Write a deterministic synthetic VCD and its PrimeTime-PX style
+    power waveform (.out). Signals are spread over a module tree and
+    the power of each module is linear in the toggles of its own
+    signals plus the power of its children.
+    Inputs:
+      - signals: # of signals
+      - cycles: # of cycles including reset
+      - density: average fraction of signals changing every cycle
+      - depth: depth of the module hierarchy
+      - widths: bus widths to choose from
+    Outputs:
+      - signal names (in the VCD order), module names
+    """
+    logging.info("Synthetic trace: %s, %s (%d signals, %d cycles)",
+                 vcd_filename, out_filename, signals, cycles)
+    assert all(0 < width <= 64 for width in widths), "widths must be in 1..64: %s" % str(widths)
+    rs = np.random.RandomState(seed)
+    modules, parents = synth_modules(depth)
+    _widths = rs.choice(widths, size=signals)
+    owners = rs.randint(0, len(modules), size=signals)
+    densities = np.clip(rs.uniform(0.0, 2.0 * density, size=signals), 0.0, 1.0)
+    # all bits of each bus (1 << 64 would overflow)
+    masks = np.uint64(0xFFFFFFFFFFFFFFFF) >> (np.uint64(64) - _widths.astype(np.uint64))
+    coefs = rs.uniform(0.0, 1e-4, size=signals) * (rs.uniform(size=signals) < 0.5) / _widths
+    consts = rs.uniform(1e-4, 1e-3, size=len(modules))
+    # cumulative toggle coefficients: power of a module includes its children
+    inclusive = np.zeros((signals, len(modules)))
+    inclusive[np.arange(signals), owners] = coefs
+    for m in reversed(range(1, len(modules))):
+        inclusive[:, parents[m]] += inclusive[:, m]
+    offsets = np.array([
+        consts[[n for n in range(len(modules)) if modules[n].startswith(module)]].sum()
+        for module in modules
+    ])
+
+    with open(vcd_filename, "w") as _f:
+        _f.write("$timescale 1ps $end\n")
+        _f.write("$scope module TestHarness $end\n")
+        _f.write("$var wire 1 %s clock $end\n" % _symbol(0))
+        _f.write("$var wire 1 %s reset $end\n" % _symbol(1))
+        # one scope per module with its signals
+        names = list()
+        def _scope(m):
+            name = modules[m].split('.')[-1] if m > 0 else 'dut'
+            _f.write("$scope module %s $end\n" % name)
+            for i in np.flatnonzero(owners == m):
+                _f.write("$var wire %d %s sig_%d $end\n" % (_widths[i], _symbol(i + 2), i))
+                names.append("%s.sig_%d" % (modules[m].replace('Top', 'dut', 1), i))
+            for child in range(len(modules)):
+                if parents[child] == m:
+                    _scope(child)
+            _f.write("$upscope $end\n")
+        _scope(0)
+        _f.write("$upscope $end\n$enddefinitions $end\n")
+        _f.write("#0\n$dumpvars\n0%s\n1%s\n" % (_symbol(0), _symbol(1)))
+        for i in range(signals):
+            _f.write(("b0 %s\n" if _widths[i] > 1 else "0%s\n") % _symbol(i + 2))
+        _f.write("$end\n")
+
+        with open(out_filename, "w") as _o:
+            for m, module in enumerate(modules):
+                _o.write("module: %s %d\n" % (module, m + 1))
+            _o.write("0\n%d\n" % reset)
+
+            symbols = [_symbol(i + 2) for i in range(signals)]
+            values = np.zeros(signals, dtype=np.uint64)
+            for begin in range(1, cycles + 1, chunk):
+                end = min(begin + chunk, cycles + 1)
+                n = end - begin
+                # forward-fill new values for signals changing in each cycle
+                changes = rs.uniform(size=(n, signals)) < densities
+                _values = rs.randint(0, 2 ** 64, size=(n, signals), dtype=np.uint64) & masks
+                rows = np.where(changes, np.arange(1, n + 1).reshape(-1, 1), 0)
+                rows = np.maximum.accumulate(rows, axis=0)
+                _values = np.append(values.reshape(1, -1), _values, axis=0)
+                _values = np.take_along_axis(_values, rows, axis=0)
+                toggles = _popcount(np.append(values.reshape(1, -1), _values, axis=0)[:-1] ^ _values)
+                powers = toggles.dot(inclusive) + offsets
+                values = _values[-1]
+
+                for r in range(n):
+                    cycle = begin + r
+                    lines = ["#%d" % (cycle * 1000), "1" + _symbol(0)]
+                    if cycle == reset + 1:
+                        lines.append("0" + _symbol(1))
+                    for i in np.flatnonzero(changes[r]):
+                        value = int(_values[r, i])
+                        lines.append("b%s %s" % (format(value, 'b'), symbols[i])
+                                     if _widths[i] > 1 else "%d%s" % (value, symbols[i]))
+                    lines.append("#%d\n0%s\n" % (cycle * 1000 + 500, _symbol(0)))
+                    _f.write("\n".join(lines))
+                    if cycle > reset:
+                        _o.write("%d\n" % cycle)
+                        _o.write("".join("%d  %.4e\n" % (m + 1, power)
+                                         for m, power in enumerate(powers[r])))
+            _f.write("#%d\n" % (cycles * 1000 + 1000))
+            # the power of the last cycle is dumped twice
+            _o.write("%d\n" % (cycles + 1))
+            _o.write("".join("%d  %.4e\n" % (m + 1, power)
+                             for m, power in enumerate(powers[-1])))
+
+    if modules_filename:
+        with open(modules_filename, "w") as _f:
+            for module in modules:
+                _f.write("%s\n" % module)
+            _f.write("Misc\n")
+
+    return names, modules
@@ -6,10 +6,22 @@ import struct
 from time import time
 import numpy as np
 from scipy.sparse import csr_matrix, hstack
-from . import divide_csr
-from .vcd import read_toggles_vcd
+from . import normalize_toggles, count_dtype, index_dtype
+from .vcd import VCDReader, read_toggles_vcd
+from .stream import VCDStream, stream_windows
+from .profile import profiled
 
-def read_toggles_csv(csv_filename):
+def _toggle_matrix(toggles, indices, indptr, shape, window, widths, normalize):
+    """ CSR matrix of raw toggle counts, normalized unless normalize is False """
+    toggles = np.array(toggles, dtype=np.uint64)
+    toggles = toggles.astype(count_dtype(toggles.max() if len(toggles) else 0))
+    dtype = index_dtype(max(max(shape), len(toggles)))
+    data = csr_matrix((toggles, np.array(indices, dtype=dtype), np.array(indptr, dtype=dtype)),
+                      shape=shape)
+    return normalize_toggles(data, window, widths) if normalize else data
+
+@profiled("toggle read")
+def read_toggles_csv(csv_filename, normalize=True):
     logging.info("CSV file: %s", csv_filename)
     assert os.path.isfile(csv_filename), "%s not found" % (csv_filename)
     indices = list()
@@ -34,41 +46,47 @@ def read_toggles_csv(csv_filename):
                 indices.append(int(line[0]))
                 toggles.append(int(line[1]))
 
-    indptr = np.array(indptr, dtype=np.int64)
-    indices = np.array(indices, dtype=np.int64)
     shape = len(signals), int((sum(cycles) - sum(reset_cycles) - 1) / window) + 1
-    data = csr_matrix((toggles, indices, indptr), shape=shape)
-    data = divide_csr(data, window * widths.reshape(-1, 1))
+    data = _toggle_matrix(toggles, indices, indptr, shape, window, widths, normalize)
 
     return window, cycles, reset_cycles, signals, data, widths
 
-def read_toggles_bin(bin_filename):
+def _read_bin_header(_f):
+    """
+    Outputs:
+      - window, cycles, reset cycles, signals, widths of a binary toggle file
+    """
+    window = struct.unpack("N", _f.read(8))[0]
+
+    cycles_len = struct.unpack("N", _f.read(8))[0]
+    cycles = [x[0] for x in struct.iter_unpack("N", _f.read(8 * cycles_len))]
+
+    reset_cycles_len = struct.unpack("N", _f.read(8))[0]
+    reset_cycles = [x[0] for x in struct.iter_unpack("N", _f.read(8 * reset_cycles_len))]
+
+    signals = list()
+    signals_len = struct.unpack("N", _f.read(8))[0]
+    for _ in range(signals_len):
+        signal_len = struct.unpack("N", _f.read(8))[0]
+        signal = _f.read(signal_len).decode("utf-8")
+        signals.append(signal)
+
+    widths_len = struct.unpack("N", _f.read(8))[0]
+    widths = [x[0] for x in struct.iter_unpack("N", _f.read(8 * widths_len))]
+
+    assert len(signals) == len(widths)
+    return window, cycles, reset_cycles, signals, widths
+
+@profiled("toggle read")
+def read_toggles_bin(bin_filename, normalize=True):
     logging.info("Binary file: %s", bin_filename)
     assert os.path.isfile(bin_filename), "%s not found" % (bin_filename)
-    signals = list()
     indices = list()
     toggles = list()
 
     with open(bin_filename, "rb") as _f:
-        window = struct.unpack("N", _f.read(8))[0]
+        window, cycles, reset_cycles, signals, widths = _read_bin_header(_f)
         logging.debug("window: %d", window)
-
-        cycles_len = struct.unpack("N", _f.read(8))[0]
-        cycles = [x[0] for x in struct.iter_unpack("N", _f.read(8 * cycles_len))]
-
-        reset_cycles_len = struct.unpack("N", _f.read(8))[0]
-        reset_cycles = [x[0] for x in struct.iter_unpack("N", _f.read(8 * reset_cycles_len))]
-
-        signals_len = struct.unpack("N", _f.read(8))[0]
-        for _ in range(signals_len):
-            signal_len = struct.unpack("N", _f.read(8))[0]
-            signal = _f.read(signal_len).decode("utf-8")
-            signals.append(signal)
-
-        widths_len = struct.unpack("N", _f.read(8))[0]
-        widths = [x[0] for x in struct.iter_unpack("N", _f.read(8 * widths_len))]
-
-        assert len(signals) == len(widths)
         for signal, width in zip(signals, widths):
             logging.debug("signal: %s[%d]", signal, width)
 
@@ -84,26 +102,102 @@ def read_toggles_bin(bin_filename):
                 toggles.append(toggle)
 
     widths = np.array(widths)
-    indptr = np.array(indptr, dtype=np.int64)
-    indices = np.array(indices, dtype=np.int64)
     shape = len(signals), int((sum(cycles) - sum(reset_cycles) - 1) / window) + 1
-    data = csr_matrix((toggles, indices, indptr), shape=shape)
-    data = divide_csr(data, window * widths.reshape(-1, 1))
+    data = _toggle_matrix(toggles, indices, indptr, shape, window, widths, normalize)
 
     return window, cycles, reset_cycles, signals, data, widths
 
-def read_toggles(toggle_file=None, vcd_files=None, window=1, signal_filter=None):
-    """ Get signal toggles from toggle file or vcd """
+def read_toggle_header(filename):
+    """
+    Read only the header of a toggle file (.csv or binary)
+    Outputs:
+      - window, cycles, reset cycles, signals, widths
+    """
+    assert os.path.isfile(filename), "%s not found" % (filename)
+    if not filename.endswith(".csv"):
+        with open(filename, "rb") as _f:
+            return _read_bin_header(_f)
+    with open(filename, "r") as _f:
+        reader = csv.reader(_f)
+        window = int(next(reader)[0])
+        cycles = [int(x) for x in next(reader)]
+        reset_cycles = [int(x) for x in next(reader)]
+        signals = next(reader)
+        widths = [int(x) for x in next(reader)]
+    return window, cycles, reset_cycles, signals, widths
+
+@profiled("toggle write")
+def store_toggles(filename, window, cycles, reset_cycles, signals, toggles, widths):
+    """
+    Store raw toggle counts as a toggle file (.csv or binary) of `read_toggles`
+    Inputs:
+      - toggles: raw toggle counts, signals x windows (e.g. normalize=False)
+    """
+    logging.info("Toggle file: %s", filename)
+    toggles = csr_matrix(toggles)
+    toggles.sort_indices()
+    assert toggles.shape[0] == len(signals) == len(widths)
+    if filename.endswith(".csv"):
+        with open(filename, "w") as _f:
+            writer = csv.writer(_f)
+            writer.writerow([window])
+            writer.writerow(cycles)
+            writer.writerow(reset_cycles)
+            writer.writerow(signals)
+            writer.writerow(widths)
+            writer.writerow(toggles.indptr)
+            writer.writerows(zip(toggles.indices.tolist(), toggles.data.tolist()))
+        return
+
+    assert toggles.nnz == 0 or toggles.data.max() < (1 << 32)
+    def _array(values):
+        return struct.pack("N", len(values)) + struct.pack("%dN" % len(values), *values)
+    with open(filename, "wb") as _f:
+        _f.write(struct.pack("N", window))
+        _f.write(_array(cycles))
+        _f.write(_array(reset_cycles))
+        _f.write(struct.pack("N", len(signals)))
+        for signal in signals:
+            signal = signal.encode("utf-8")
+            _f.write(struct.pack("N", len(signal)) + signal)
+        _f.write(_array([int(x) for x in widths]))
+        _f.write(_array(toggles.indptr.tolist()))
+        # (index, toggle) records as struct "NI"
+        records = np.empty(toggles.nnz, dtype=[('index', np.uintp), ('toggle', np.uint32)])
+        records['index'] = toggles.indices
+        records['toggle'] = toggles.data
+        _f.write(records.tobytes())
+
+def _signal_mask(bus_signals, bus_widths, signal_filter=None):
+    """ Mask out wide signals unless they are explicitly selected """
+    # FIXME: filter from vcd_reader
+    bus_signal_filter = [
+        "_ext" not in bus_signal or "_reg" not in bus_signal for bus_signal in bus_signals]
+    width_filter = np.array(bus_widths) < (sys.maxsize if signal_filter else 96)
+    width_filter &= np.array(bus_signal_filter, dtype=bool) # FIMXE: remove
+    logging.info("Remove %d wide signals:", np.count_nonzero(~width_filter))
+    for signal in np.array(bus_signals)[~width_filter]:
+        logging.info("- %s", signal)
+    return width_filter
+
+def read_toggles(toggle_file=None, vcd_files=None, window=1, signal_filter=None, normalize=True,
+                 cycles=None):
+    """
+    Get signal toggles from toggle file or vcd
+    (raw toggle counts if normalize is False, see normalize_toggles)
+    cycles: (begin, end) range of cycles after reset read from vcd files
+    """
     start_time = time()
     if toggle_file:
+        assert cycles is None, "cycle ranges are read only from vcd files"
         (_window,
          vcd_cycle_list,
          reset_cycle_list,
          bus_signals,
          bus_toggles,
          bus_widths) = \
-        read_toggles_csv(toggle_file) if toggle_file.endswith(".csv") else \
-        read_toggles_bin(toggle_file)
+        read_toggles_csv(toggle_file, normalize) if toggle_file.endswith(".csv") else \
+        read_toggles_bin(toggle_file, normalize)
         if signal_filter:
             _filter = np.array([s in signal_filter for s in bus_signals])
             bus_toggles = bus_toggles[_filter]
@@ -120,7 +214,8 @@ def read_toggles(toggle_file=None, vcd_files=None, window=1, signal_filter=None)
              _bus_signals,
              _bus_toggles,
              _bus_widths) = read_toggles_vcd(
-                 vcd_file, signal_filter=signal_filter, window=window)
+                 vcd_file, signal_filter=signal_filter, window=window, normalize=normalize,
+                 cycles=cycles)
             vcd_cycle_list.append(vcd_cycles)
             reset_cycle_list.append(reset_cycles)
             if bus_signals is None:
@@ -134,17 +229,59 @@ def read_toggles(toggle_file=None, vcd_files=None, window=1, signal_filter=None)
     end_time = time()
     logging.info("Toggle read time: %.2f s", end_time - start_time)
 
-    # FIXME: filter from vcd_reader
-    bus_signal_filter = [
-        "_ext" not in bus_signal or "_reg" not in bus_signal for bus_signal in bus_signals]
     bus_signals = np.array(bus_signals)
-    width_filter = bus_widths < (sys.maxsize if signal_filter else 96)
-    width_filter &= np.array(bus_signal_filter) # FIMXE: remove
-    logging.info("Remove %d wide signals:", np.count_nonzero(~width_filter))
-    for signal in bus_signals[~width_filter]:
-        logging.info("- %s", signal)
+    width_filter = _signal_mask(bus_signals, bus_widths, signal_filter)
     bus_signals = bus_signals[width_filter]
     bus_toggles = bus_toggles[width_filter]
     bus_widths = bus_widths[width_filter]
 
     return vcd_cycle_list, reset_cycle_list, bus_signals, bus_toggles, bus_widths
+
+@profiled("vcd sketch")
+def sketch_toggles(vcd_files, window, new_sketch, block_size=256, stream=False, idle=10.0):
+    """
+    Stream signal toggles from VCDs into a sketch of the signals x windows
+    matrix without materializing it. `new_sketch(m)` creates the sketch
+    once the number of signals is known. Windows are appended in blocks,
+    so memory is O(signals x sketch) for any trace length.
+    With stream, VCDs are read from running simulations (see utils/stream.py).
+    """
+    start_time = time()
+    vcd_cycle_list = list()
+    reset_cycle_list = list()
+    bus_signals = None
+    for vcd_file in vcd_files:
+        reader = VCDStream(vcd_file, window=window, idle=idle) if stream else \
+                 VCDReader(vcd_file, window=window)
+        if bus_signals is None:
+            bus_signals = np.array(reader.signals)
+            bus_widths = np.array(reader.widths)
+            width_filter = _signal_mask(bus_signals, bus_widths)
+            denoms = window * bus_widths[width_filter].reshape(-1, 1)
+            toggles = new_sketch(np.count_nonzero(width_filter))
+        else:
+            assert all(x == y for x, y in zip(bus_signals, reader.signals))
+            assert all(x == y for x, y in zip(bus_widths, reader.widths))
+        if stream:
+            for block in stream_windows(reader, block_size):
+                toggles.append(block[:, width_filter].T / denoms)
+        else:
+            block = np.empty((len(denoms), block_size))
+            size = 0
+            for _, cur_toggles in reader.windows():
+                block[:, size] = cur_toggles[width_filter]
+                size += 1
+                if size == block_size:
+                    toggles.append(block / denoms)
+                    size = 0
+            if size > 0:
+                toggles.append(block[:, :size] / denoms)
+        reader.close()
+        vcd_cycle_list.append(reader.cycle)
+        reset_cycle_list.append(reader.reset_cycle)
+    end_time = time()
+    logging.info("Toggle sketch time: %.2f s (%d windows)",
+                 end_time - start_time, toggles.n)
+
+    return (vcd_cycle_list, reset_cycle_list,
+            bus_signals[width_filter], toggles, bus_widths[width_filter])
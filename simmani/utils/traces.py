@@ -0,0 +1,42 @@
+import logging
+import multiprocessing
+from time import time
+from .toggle import read_toggles
+from .power import read_power_out, merge_power_files
+from .profile import PROFILER, call_profiled
+from .resources import fork_pool
+
+def read_traces(toggle_file, vcd_files, out_files, window, signal_filter=None,
+                module_filter=None, power_window=None, normalize=True, cycles=None):
+    """
+    Read toggles and power waveforms concurrently. Toggles are parsed in
+    a forked process while power waveforms are parsed in this process
+    (both are CPU-bound), and cycles and reset cycles are checked once
+    both finish. Falls back to reading one after another in daemonic
+    processes (e.g. pool workers), which cannot fork.
+    Inputs:
+      - window: toggle window (and power window unless power_window is given)
+      - cycles: (begin, end) range of cycles after reset read from both traces
+    Outputs:
+      - same as `read_toggles`, then modules and powers as `read_power_files`
+    """
+    start_time = time()
+    toggle_args = (toggle_file, vcd_files, window, signal_filter, normalize, cycles)
+    if multiprocessing.current_process().daemon:
+        toggles = read_toggles(*toggle_args)
+        results = [read_power_out(out_file, module_filter, cycles) for out_file in out_files]
+    else:
+        with fork_pool(1, "toggle read") as pool:
+            future = pool.apply_async(call_profiled, (read_toggles,) + toggle_args)
+            results = [read_power_out(out_file, module_filter, cycles) for out_file in out_files]
+            power_time = time()
+            toggles = PROFILER.gather([future.get()])[0]
+        logging.info("Power read time: %.2f s", power_time - start_time)
+    end_time = time()
+    logging.info("Trace read time: %.2f s", end_time - start_time)
+
+    vcd_cycle_list, reset_cycle_list = toggles[:2]
+    modules, powers = merge_power_files(
+        out_files, results, window if power_window is None else power_window,
+        vcd_cycle_list, reset_cycle_list)
+    return toggles + (modules, powers)
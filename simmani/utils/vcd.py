@@ -1,77 +1,226 @@
 import os.path
+import re
 import logging
-from collections import deque
+from itertools import chain
 import numpy as np
 from scipy.sparse import csr_matrix
-from . import divide_csr
-
-def read_toggles_vcd(vcd_filename, signal_filter=None, clock=1000, window=1):
-    logging.info("VCD file: %s, Window: %d", vcd_filename, window)
-    assert os.path.isfile(vcd_filename), "%s not found" % (vcd_filename)
-    cycle = 0
-    reset_cycle = 0
-    bus_signals = list()
-    bus_toggles = list()
-    bus_indices = list()
-    time = -1
-    path = list()
-    symbols = dict() # symbol -> idx
-    widths = list()
-    clock_value = None
-    reset_value = None
-    is_prefix = True
-    with open(vcd_filename, "r") as _f:
-        for line in _f:
+from . import normalize_toggles, count_dtype
+from .seek import load_index, store_index, find_checkpoint
+from .profile import profiled
+
+def _value(value):
+    try:
+        return int(value, 2)
+    except ValueError:
+        return int(value.replace('x', '0'), 2)
+
+SCAN_CHUNK = 1 << 22
+SCAN_RATIO = 8
+
+def _trie(symbols):
+    """
+    Regex matching any of symbols, branching on one character
+    at a time so that a record is checked against all symbols at once
+    """
+    branches = dict()
+    for symbol in symbols:
+        branches.setdefault(symbol[:1], list()).append(symbol[1:])
+    ends = '' in branches
+    parts = [re.escape(c) + _trie(rest) for c, rest in sorted(branches.items()) if c]
+    if not parts:
+        return ''
+    if len(parts) == 1 and not ends:
+        return parts[0]
+    return '(?:' + '|'.join(parts) + ('|' if ends else '') + ')'
+
+class VCDReader(object):
+    """
+    Incremental VCD reader
+
+    Definitions are decoded when the reader is created, so `signals` and
+    `widths` are available before any value change is parsed.
+    `windows()` then yields raw toggle counts for every completed window,
+    so callers can consume a trace without materializing the whole matrix.
+
+    With a cycle range (begin, end) of cycles after reset, windows start
+    at begin and reading stops at end. Such reads resume from the seek
+    index of the VCD (see utils/seek.py) and checkpoint the values of
+    all signals into it as they go.
+
+    Otherwise, with a signal filter selecting a few signals, value changes
+    of other signals are skipped by a regex scan of the trace text (see
+    `_changes`), so parsing scales with the activity of selected signals.
+    """
+
+    # the VCD can be reopened to scan its value changes
+    scannable = True
+
+    def __init__(self, vcd_filename, signal_filter=None, window=1, cycles=None):
+        logging.info("VCD file: %s, Window: %d", vcd_filename, window)
+        assert cycles is None or cycles[1] is None or cycles[0] < cycles[1], str(cycles)
+        self.filename = vcd_filename
+        self.window = window
+        self.cycles = cycles
+        self.cycle = 0
+        self.reset_cycle = 0
+        self.signals = list()
+        self.widths = list()
+        self.symbols = dict() # symbol -> idx
+        self.data_symbols = set() # symbols of all signals (before signal_filter)
+        self.clock_symbol = None
+        self.reset_symbol = None
+        self.clock_value = None
+        self._f = self._open(vcd_filename)
+        self._offset = 0
+        self._read_definitions(signal_filter)
+
+    def _open(self, vcd_filename):
+        """
+        Lines of the VCD (iterable with close())
+        """
+        assert os.path.isfile(vcd_filename), "%s not found" % (vcd_filename)
+        # one byte per character, so that offsets of lines are file offsets
+        return open(vcd_filename, "r", encoding="latin-1", newline="")
+
+    def close(self):
+        self._f.close()
+
+    def _read_definitions(self, signal_filter):
+        path = list()
+        is_prefix = True
+        for line in self._f:
+            self._offset += len(line)
             tokens = line.split()
-            if not tokens:
+            if not tokens or tokens[0][0] != "$":
                 pass
-            elif tokens[0][0] == "$":
-                ######################
-                # Decode Definitions #
-                ######################
-                if tokens[0] == "$scope":
-                    assert tokens[1] == "module"
-                    assert tokens[3] == "$end"
-                    # module instance
-                    path.append(tokens[2])
-                    if is_prefix:
-                        prefix = '.'.join(path) + '.'
-                    is_prefix = True
-                elif tokens[0] == "$upscope":
-                    # move up to the upper module instance
-                    path = path[:-1]
-                elif tokens[0] == "$var":
-                    is_prefix = False
-                    # signal definition """
-                    width = int(tokens[2])
-                    symbol = tokens[3]
-                    signal = ("%s.%s" % (".".join(path), tokens[4])).replace(prefix, "")
-                    if signal == "clock":
-                        clock_symbol = symbol
-                        clock_value = '0'
-                    elif signal == "reset":
-                        reset_symbol = symbol
-                    elif ("clock" in signal or "reset" in signal
-                          or "_clk" in signal or "_rst" in signal
-                          or "initvar" in signal or "_RAND" in signal
-                          or "_GEN_" in signal): # FIXME: due to circuit mismatch
-                        pass
-                    elif signal_filter and signal not in signal_filter:
+            elif tokens[0] == "$scope":
+                assert tokens[1] == "module"
+                assert tokens[3] == "$end"
+                # module instance
+                path.append(tokens[2])
+                if is_prefix:
+                    prefix = '.'.join(path) + '.'
+                is_prefix = True
+            elif tokens[0] == "$upscope":
+                # move up to the upper module instance
+                path = path[:-1]
+            elif tokens[0] == "$var":
+                is_prefix = False
+                # signal definition
+                width = int(tokens[2])
+                symbol = tokens[3]
+                signal = ("%s.%s" % (".".join(path), tokens[4])).replace(prefix, "")
+                if signal == "clock":
+                    self.clock_symbol = symbol
+                    self.clock_value = '0'
+                elif signal == "reset":
+                    self.reset_symbol = symbol
+                elif ("clock" in signal or "reset" in signal
+                      or "_clk" in signal or "_rst" in signal
+                      or "initvar" in signal or "_RAND" in signal
+                      or "_GEN_" in signal): # FIXME: due to circuit mismatch
+                    pass
+                else:
+                    self.data_symbols.add(symbol)
+                    if signal_filter and signal not in signal_filter:
                         pass
-                    elif symbol not in symbols:
-                        symbols[symbol] = len(bus_signals)
-                        widths.append(width)
-                        bus_signals.append(signal)
-                        bus_toggles.append(deque())
-                        bus_indices.append(deque())
-                elif tokens[0] == "$enddefinitions":
-                    # no more variable definitions """
-                    has_toggled = [False] * len(bus_signals)
-                    cur_toggles = [0] * len(bus_signals)
-                    cur_values = [0] * len(bus_signals)
-                    prev_values = [0] * len(bus_signals)
-                    path = list()
+                    elif symbol not in self.symbols:
+                        self.symbols[symbol] = len(self.signals)
+                        self.widths.append(width)
+                        self.signals.append(signal)
+            elif tokens[0] == "$enddefinitions":
+                # no more variable definitions
+                break
+
+    def _resume(self, checkpoints, prev_values):
+        """
+        Seek to the last of checkpoints, restoring the values of signals
+        Outputs:
+          - time, cycle, reset cycle, clock value, reset value at the checkpoint
+        """
+        values = dict()
+        for checkpoint in checkpoints:
+            values.update(checkpoint['values'])
+        checkpoint = checkpoints[-1]
+        for symbol, i in self.symbols.items():
+            prev_values[i] = _value(values.get(symbol, '0'))
+        self._f.seek(checkpoint['offset'])
+        return (checkpoint['time'], checkpoint['clock'], checkpoint['reset'],
+                checkpoint['clock_value'], checkpoint['reset_value'])
 
+    def _changes(self):
+        """
+        Lists of lines of simulation times and value changes of `symbols`,
+        the clock, and the reset after the definitions, chunk by chunk.
+        Other lines are neither split nor dispatched.
+        """
+        symbols = set(self.symbols) | set([self.clock_symbol, self.reset_symbol])
+        pattern = re.compile(
+            r'\n[ \t]*(#\d+|(?:b\S+[ \t]+|[^\s#$b])' +
+            _trie(sorted(symbol for symbol in symbols if symbol)) +
+            r')[ \t\r]*(?=\n)')
+        with open(self.filename, "r", encoding="latin-1", newline="") as _f:
+            _f.seek(self._offset)
+            rest = '\n'
+            while True:
+                chunk = _f.read(SCAN_CHUNK)
+                if not chunk:
+                    break
+                buf = rest + chunk
+                # records up to the last complete line
+                end = buf.rfind('\n')
+                yield pattern.findall(buf, 0, end + 1)
+                rest = buf[end:]
+            yield pattern.findall(rest + '\n')
+
+    def windows(self):
+        """
+        Parse value changes and yield (window index, toggle counts)
+        for each completed window. Toggle counts are raw bit toggles
+        (not normalized) in the order of `signals`.
+        """
+        window = self.window
+        symbols = self.symbols
+        clock_symbol = self.clock_symbol
+        reset_symbol = self.reset_symbol
+        clock_value = self.clock_value
+        reset_value = None
+        cycle = 0
+        reset_cycle = 0
+        time = -1
+        num_signals = len(self.signals)
+        cur_toggles = [0] * num_signals
+        prev_values = [0] * num_signals
+        cur_values = dict() # idx -> value updated since the last clock tick
+
+        ranged = self.cycles is not None
+        begin, end = self.cycles if ranged else (0, None)
+        if ranged:
+            data_symbols = self.data_symbols
+            interval, checkpoints = load_index(self.filename)
+            indexed = len(checkpoints)
+            last = checkpoints[-1]['cycle'] if checkpoints else 0
+            changed = dict() # symbol -> value changed since the last checkpoint
+            boundary = None
+            k = find_checkpoint(checkpoints, begin)
+            if k >= 0:
+                time, cycle, reset_cycle, clock_value, reset_value = \
+                    self._resume(checkpoints[:k+1], prev_values)
+                self._offset = checkpoints[k]['offset']
+                boundary = checkpoints[k]['cycle']
+        offset = self._offset
+        # scanning pays off only if most value changes are skipped
+        if not ranged and self.scannable and SCAN_RATIO * len(symbols) <= len(self.data_symbols):
+            lines = chain.from_iterable(self._changes())
+        else:
+            lines = self._f
+
+        for line in lines:
+            if ranged:
+                offset += len(line)
+            tokens = line.split()
+            if not tokens or tokens[0][0] == "$":
+                pass
             elif tokens[0][0] == '#':
                 # simulation time
                 time = int(tokens[0][1:])
@@ -83,25 +232,33 @@ def read_toggles_vcd(vcd_filename, signal_filter=None, clock=1000, window=1):
                     if reset_value == '1':
                         reset_cycle += 1
                     # update toggles
-                    for i, _t in enumerate(has_toggled):
-                        if _t:
-                            width = widths[i]
-                            value = cur_values[i]
-                            bus_diff = bin(value ^ prev_values[i]).count('1')
-                            cur_toggles[i] += bus_diff
-                            prev_values[i] = value
-                            has_toggled[i] = False
-
-                    if reset_value == '0' and ((cycle - reset_cycle) % window == 0):
-                        idx = (cycle - reset_cycle) / window - 1
-                        for i, (ids, ts, width) in enumerate(
-                                zip(bus_indices, bus_toggles, widths)):
-                            if cur_toggles[i] > 0:
-                                ids.append(idx)
-                                ts.append(cur_toggles[i])
-                                # ts.append(float(cur_toggles[i]) / (window * width))
-                                cur_toggles[i] = 0
-            elif time >= 0 and tokens:
+                    for i, value in cur_values.items():
+                        cur_toggles[i] += bin(value ^ prev_values[i]).count('1')
+                        prev_values[i] = value
+                    cur_values.clear()
+
+                    if reset_value == '0':
+                        post = cycle - reset_cycle
+                        if ranged and post % interval == 0 and post != boundary:
+                            # checkpoint values of all signals
+                            if post > last:
+                                checkpoints.append(dict(
+                                    cycle=post, offset=offset, time=time, clock=cycle,
+                                    reset=reset_cycle, clock_value=clock_value,
+                                    reset_value=reset_value, values=changed))
+                                last = post
+                            changed = dict()
+                            boundary = post
+                        if post <= begin:
+                            # before the cycle range
+                            cur_toggles = [0] * num_signals
+                        elif (post - begin) % window == 0:
+                            self.cycle, self.reset_cycle = reset_cycle + post - begin, reset_cycle
+                            yield (post - begin) // window - 1, np.array(cur_toggles)
+                            cur_toggles = [0] * num_signals
+                        if end is not None and post >= end:
+                            break
+            elif time >= 0:
                 #################
                 # Update Values #
                 #################
@@ -112,9 +269,8 @@ def read_toggles_vcd(vcd_filename, signal_filter=None, clock=1000, window=1):
                 elif len(tokens) == 1:
                     value = tokens[0][0]
                     symbol = tokens[0][1:]
-                #assert cycle == 0 or time % clock == 0 or \
-                #  symbol == clock_symbol or symbol == reset_symbol, \
-                #  "time: %d, clock: %d, symbol: %s" % (time, clock, symbol)
+                else:
+                    continue
                 if symbol == clock_symbol:
                     clock_value = value
                     if time > 0 and clock_value == '1':
@@ -122,42 +278,59 @@ def read_toggles_vcd(vcd_filename, signal_filter=None, clock=1000, window=1):
                         cycle += 1
                 if symbol == reset_symbol:
                     reset_value = value
-                elif cycle > 0 and clock_value == '1' and symbol in symbols:
+                elif cycle > 0 and clock_value == '1':
                     # RTL signals tick at clock pos edges
-                    idx = symbols[symbol]
-                    try:
-                        cur_values[idx] = int(value, 2)
-                    except ValueError:
-                        cur_values[idx] = int(value.replace('x', '0'), 2)
-                    has_toggled[idx] = True
-
-    # Leftovers
-    tail = (cycle - reset_cycle) % window
-    if tail != 0:
-        idx = (cycle - reset_cycle - 1) / window
-        for i, (ids, ts, width) in enumerate(zip(bus_indices, bus_toggles, widths)):
-            if cur_toggles[i] > 0:
-                ids.append(idx)
-                ts.append(cur_toggles[i])
-                # ts.append(float(cur_toggles[i]) / (width * tail))
-                cur_toggles[i] = 0
-
-    indptr = [0]
-    for bus_index in bus_indices:
-        indptr.append(indptr[-1] + len(bus_index))
-
-    indices = list()
+                    if symbol in symbols:
+                        try:
+                            cur_values[symbols[symbol]] = int(value, 2)
+                        except ValueError:
+                            cur_values[symbols[symbol]] = int(value.replace('x', '0'), 2)
+                    if ranged and symbol in data_symbols:
+                        changed[symbol] = value
+
+        cycles = cycle - reset_cycle
+        if ranged:
+            cycles = max(min(cycles, end) if end is not None else cycles, begin) - begin
+            if len(checkpoints) > indexed:
+                store_index(self.filename, interval, checkpoints)
+        self.cycle, self.reset_cycle = reset_cycle + cycles, reset_cycle
+
+        # Leftovers
+        if cycles % window != 0:
+            yield (cycles - 1) // window, np.array(cur_toggles)
+
+    def num_windows(self):
+        return int((self.cycle - self.reset_cycle - 1) / self.window) + 1
+
+@profiled("vcd parse")
+def read_toggles_vcd(vcd_filename, signal_filter=None, clock=1000, window=1, normalize=True,
+                     cycles=None):
+    """
+    Toggles of a VCD in windows. Raw toggle counts are kept in the
+    smallest unsigned integer type and normalized by window * width
+    unless normalize is False.
+    cycles: (begin, end) range of cycles after reset (see VCDReader)
+    """
+    reader = VCDReader(vcd_filename, signal_filter, window, cycles)
+    dtype = count_dtype(window * max(reader.widths, default=1))
+    rows = list()
+    cols = list()
     toggles = list()
-    for bus_index in bus_indices:
-        indices.extend(bus_index)
-    for bus_toggle in bus_toggles:
-        toggles.extend(bus_toggle)
-
-    widths = np.array(widths)
-    indptr = np.array(indptr, dtype=np.int64)
-    indices = np.array(indices, dtype=np.int64)
-    shape = len(bus_signals), int((cycle - reset_cycle - 1) / window) + 1
-    data = csr_matrix((toggles, indices, indptr), shape=shape)
-    data = divide_csr(data, window * widths.reshape(-1, 1))
-
-    return cycle, reset_cycle, bus_signals, data, widths
+    for idx, cur_toggles in reader.windows():
+        nonzero = np.flatnonzero(cur_toggles)
+        rows.append(nonzero.astype(np.int32))
+        cols.append(np.full(len(nonzero), idx, dtype=np.int32))
+        toggles.append(cur_toggles[nonzero].astype(dtype))
+    reader.close()
+
+    def _concat(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+
+    widths = np.array(reader.widths)
+    shape = len(reader.signals), reader.num_windows()
+    data = csr_matrix((_concat(toggles, dtype), (_concat(rows, np.int32), _concat(cols, np.int32))),
+                      shape=shape)
+    if normalize:
+        data = normalize_toggles(data, window, widths)
+
+    return reader.cycle, reader.reset_cycle, reader.signals, data, widths
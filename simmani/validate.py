@@ -0,0 +1,159 @@
+# See LICENSE for license details.
+
+import os.path
+import sys
+import csv
+import argparse
+import logging
+from functools import reduce
+from math import gcd
+from time import time
+import numpy as np
+from .utils import read_modules, average_rows, sum_rows, count_dtype, normalize_toggles, \
+    set_precision
+from .utils.power import split_powers
+from .utils.traces import read_traces
+from .utils.resources import set_cpus, log_budget
+from .model.evaluator import load_model, Evaluator
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Power Model Validation')
+    parser.add_argument("-m", "--model", dest="model", type=str,
+                        help='candidate power model file names', nargs='+', required=True)
+    parser.add_argument("-v", "--vcd", dest="vcd", type=str,
+                        help='vcd file names', nargs='+', required=True)
+    parser.add_argument("-o", "--out", dest="out", type=str,
+                        help='power out file names', nargs='+', required=True)
+    parser.add_argument("-d", "--dir", dest="dir", type=str,
+                        help='output directory', default=os.path.curdir)
+    parser.add_argument("-w", "--window", dest="window", type=int,
+                        help="window size (in cycle) for all candidates", default=128)
+    parser.add_argument("--windows", dest="windows", type=int, nargs='+',
+                        help="window size (in cycle) of each candidate")
+    parser.add_argument("--modules", dest="modules", type=str,
+                        help="module hierarchy")
+    parser.add_argument("--cpus", dest="cpus", type=int,
+                        help="# of cores for the run (SIMMANI_CPUS or all cores by default)")
+    parser.add_argument("--precision", dest="precision", type=str,
+                        help="floating-point type of toggles and power (float64 or float32)",
+                        default="float64")
+
+    args, _ = parser.parse_known_args(argv)
+    assert len(args.vcd) == len(args.out)
+    if not args.windows:
+        args.windows = [args.window] * len(args.model)
+    assert len(args.windows) == len(args.model)
+    os.makedirs(args.dir, exist_ok=True)
+    return args
+
+def score(y, y_hat):
+    rmse = np.sqrt(np.mean((y - y_hat) ** 2)) / y.mean()
+    avge = abs(y_hat.mean() - y.mean()) / y.mean()
+    return rmse, avge
+
+def validate_benchmark(vcd, out, candidates, hierarchy):
+    """
+    Score all candidates on a benchmark, parsing its trace only once
+    at the finest window and aggregating for coarser windows
+    """
+    module_filter, misc_module, children, labels = hierarchy
+    windows = sorted(set(window for window, _, _ in candidates))
+    finest = reduce(gcd, windows)
+    signals = set()
+    for _, model, _ in candidates:
+        signals.update(model[0])
+
+    (vcd_cycle_list, reset_cycle_list, bus_signals, toggles, widths, modules, powers) = \
+        read_traces(None, [vcd], [out], finest, signals, module_filter,
+                    power_window=1, normalize=False)
+    logging.info("Cycles: %d", sum(vcd_cycle_list))
+    logging.info("Reset Cycles: %d", sum(reset_cycle_list))
+
+    scores = list()
+    cache = dict()
+    for window, model, evaluator in candidates:
+        if window not in cache:
+            cache[window] = (
+                normalize_toggles(sum_rows(
+                    toggles, window // finest, count_dtype(window * int(np.max(widths)))),
+                    window, widths).T.tocsr(),
+                split_powers(modules, average_rows(powers, window),
+                             children, labels, misc_module))
+        A0, (names, targets) = cache[window]
+        y_hats = evaluator.bind(bus_signals).predict(A0).T
+        scores.append([
+            score(targets[names.index(module)], y_hat)
+            for module, y_hat in zip(model[2], y_hats)
+        ])
+    return scores
+
+def main(argv):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.INFO
+    )
+
+    set_precision(args.precision)
+    set_cpus(args.cpus)
+    log_budget()
+    hierarchy = read_modules(args.modules)
+    candidates = list()
+    filenames = list()
+    for window, filename in zip(args.windows, args.model):
+        if os.path.getsize(filename) == 0:
+            # placeholders of windows not trained (see store_empty_model)
+            logging.info("Skip %s (window: %d): model not trained", filename, window)
+            continue
+        model = load_model(filename)
+        signals, _, _, terms, models = model
+        candidates.append((window, model, Evaluator(signals, terms, models)))
+        filenames.append(filename)
+    assert candidates, "no trained models in %s" % ' '.join(args.model)
+    finest = reduce(gcd, [window for window, _, _ in candidates])
+    logging.info("Candidates: %d, finest window: %d", len(candidates), finest)
+
+    benchmarks = [
+        os.path.splitext(os.path.basename(vcd))[0]
+        for vcd in args.vcd
+    ]
+    start_time = time()
+    scores = [
+        validate_benchmark(vcd, out, candidates, hierarchy)
+        for vcd, out in zip(args.vcd, args.out)
+    ]
+    end_time = time()
+    logging.info("Total validation time: %.2f s", end_time - start_time)
+
+    stats_filename = os.path.join(args.dir, "validate-stats.csv")
+    logging.info("Statistics file: %s", stats_filename)
+    with open(stats_filename, 'w') as _f:
+        writer = csv.writer(_f)
+        writer.writerow(['model', 'window', 'benchmark', 'module', 'NRMSE (%)', 'AVGE (%)'])
+        for i, (window, model, _) in enumerate(candidates):
+            for benchmark, _scores in zip(benchmarks, scores):
+                for module, (rmse, avge) in zip(model[2], _scores[i]):
+                    writer.writerow([filenames[i], window, benchmark, module,
+                                     "%.2f" % (100 * rmse), "%.2f" % (100 * avge)])
+
+    # Total power model of each candidate
+    summary_filename = os.path.join(args.dir, "validate-summary.csv")
+    logging.info("Summary file: %s", summary_filename)
+    with open(summary_filename, 'w') as _f:
+        writer = csv.writer(_f)
+        writer.writerow(['model', 'window', '#signals'] + [
+            "%s %s" % (benchmark, metric)
+            for benchmark in benchmarks for metric in ['NRMSE (%)', 'AVGE (%)']
+        ] + ['NRMSE (%)', 'AVGE (%)'])
+        for i, (window, model, _) in enumerate(candidates):
+            totals = np.array([_scores[i][0] for _scores in scores])
+            rmse, avge = totals.mean(axis=0)
+            writer.writerow([filenames[i], window, len(model[0])] + [
+                "%.2f" % (100 * e) for e in totals.reshape(-1)
+            ] + ["%.2f" % (100 * rmse), "%.2f" % (100 * avge)])
+            logging.info("[%s] window: %d, NRMSE = %f %%, AVGE = %f %%",
+                         filenames[i], window, 100 * rmse, 100 * avge)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])